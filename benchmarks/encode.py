@@ -0,0 +1,66 @@
+"""Benchmark encoding of metrics in text and OpenMetrics formats.
+
+The exporter encoders are compared with `generate_latest()` functions from
+the Prometheus client library, on a registry with the specified number of
+series.  Run as:
+
+  python benchmarks/encode.py --series 10000
+
+"""
+
+import timeit
+import typing as t
+
+import click
+from prometheus_client import Gauge, generate_latest
+from prometheus_client.openmetrics import exposition as openmetrics
+
+from prometheus_aioexporter import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._exposition import OpenMetricsEncoder, TextEncoder
+
+
+def make_registry(series: int) -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [
+            MetricConfig(
+                "bench_gauge",
+                "a benchmark gauge",
+                "gauge",
+                labels=("id", "kind"),
+            )
+        ]
+    )
+    gauge = t.cast(Gauge, registry.get_metric("bench_gauge"))
+    for i in range(series):
+        gauge.labels(id=str(i), kind="bench").set(i)
+    return registry
+
+
+@click.command()
+@click.option("--series", type=int, default=10000, show_default=True)
+@click.option("--iterations", type=int, default=50, show_default=True)
+def main(series: int, iterations: int) -> None:
+    """Compare encoding time with the client library encoder."""
+    registry = make_registry(series).registry
+    text_encoder = TextEncoder()
+    openmetrics_encoder = OpenMetricsEncoder()
+    assert text_encoder.encode(registry) == generate_latest(registry)
+    assert openmetrics_encoder.encode(registry) == openmetrics.generate_latest(
+        registry
+    )
+    for name, encode in [
+        ("generate_latest", generate_latest),
+        ("TextEncoder", text_encoder.encode),
+        ("openmetrics", openmetrics.generate_latest),
+        ("OpenMetricsEncoder", openmetrics_encoder.encode),
+    ]:
+        elapsed = timeit.timeit(lambda: encode(registry), number=iterations)
+        click.echo(
+            f"{name:18} {elapsed / iterations * 1000:8.2f} ms/encoding "
+            f"({series} series)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark memory used by series with repeated label values.
+
+Series are created with label values built at runtime (as when parsed from
+an external source), for a plain client library metric and for a metric
+from a default `MetricsRegistry`, which interns label values.  Each
+case runs in a new process, reporting the increase in resident memory.  Run
+as:
+
+  python benchmarks/labels.py --series 1000000
+
+"""
+
+import multiprocessing
+import typing as t
+
+import click
+from prometheus_client import Gauge
+
+from prometheus_aioexporter import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._cardinality import resident_memory
+
+REGIONS = ("us-east-1", "us-west-2", "eu-central-1", "ap-southeast-2")
+STATUSES = ("ok", "degraded", "failed")
+
+
+def make_gauge(kind: str) -> Gauge:
+    labels = ("id", "host", "region", "status")
+    if kind == "client":
+        return Gauge("bench_gauge", "a benchmark gauge", labels, registry=None)
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [MetricConfig("bench_gauge", "a benchmark gauge", "gauge", labels)]
+    )
+    return t.cast(Gauge, registry.get_metric("bench_gauge"))
+
+
+def measure(kind: str, series: int, hosts: int) -> int:
+    gauge = make_gauge(kind)
+    start = resident_memory()
+    for i in range(series):
+        # build values, so that strings are not shared across series
+        gauge.labels(
+            id=str(i),
+            host=f"host-{i % hosts}",
+            region=REGIONS[i % len(REGIONS)].upper().lower(),
+            status=STATUSES[i % len(STATUSES)].upper().lower(),
+        ).set(i)
+    return resident_memory() - start
+
+
+@click.command()
+@click.option("--series", type=int, default=200000, show_default=True)
+@click.option("--hosts", type=int, default=1000, show_default=True)
+def main(series: int, hosts: int) -> None:
+    """Compare memory used by series with the client library metrics."""
+    context = multiprocessing.get_context("spawn")
+    for kind in ("client", "registry"):
+        with context.Pool(1) as pool:
+            memory = pool.apply(measure, (kind, series, hosts))
+        click.echo(
+            f"{kind:10} {memory / 2**20:8.1f} MiB "
+            f"({memory / series:6.1f} bytes/series, {series} series)"
+        )
+
+
+if __name__ == "__main__":
+    main()
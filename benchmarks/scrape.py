@@ -0,0 +1,146 @@
+"""Benchmark scrape throughput of an exporter.
+
+The exporter is run in a separate process with the selected event loop, and
+scraped with concurrent requests for the specified time.  Run as:
+
+  python benchmarks/scrape.py --event-loop asyncio --event-loop uvloop
+
+"""
+
+import asyncio
+from collections.abc import Mapping
+import importlib.util
+import multiprocessing
+import socket
+import time
+import typing as t
+
+from aiohttp import ClientError, ClientSession, TCPConnector
+import click
+from prometheus_client import Gauge
+from prometheus_client.metrics import MetricWrapperBase
+import structlog
+
+from prometheus_aioexporter import (
+    EventLoop,
+    MetricConfig,
+    MetricsRegistry,
+    PrometheusExporter,
+    PrometheusExporterConfig,
+)
+from prometheus_aioexporter._log import LogLevel, setup_logging
+
+
+def run_exporter(port: int, event_loop: EventLoop, series: int) -> None:
+    setup_logging(log_level=LogLevel.ERROR)
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [
+            MetricConfig(
+                "bench_gauge", "a benchmark gauge", "gauge", labels=("id",)
+            )
+        ]
+    )
+    gauge = t.cast(Gauge, registry.get_metric("bench_gauge"))
+    for i in range(series):
+        gauge.labels(id=str(i)).set(i)
+
+    async def update_handler(metrics: Mapping[str, MetricWrapperBase]) -> None:
+        # simulate an update involving I/O
+        await asyncio.sleep(0)
+
+    config = PrometheusExporterConfig(
+        "benchmark",
+        "0",
+        "benchmark exporter",
+        ["127.0.0.1"],
+        port,
+        event_loop=event_loop,
+    )
+    exporter = PrometheusExporter(
+        config, registry, logger=structlog.get_logger()
+    )
+    exporter.set_metric_update_handler(update_handler)
+    exporter.run()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return int(sock.getsockname()[1])
+
+
+async def wait_ready(session: ClientSession, url: str) -> None:
+    for _ in range(100):
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                return
+        except ClientError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("exporter didn't start")
+
+
+async def scrape(url: str, concurrency: int, duration: float) -> int:
+    connector = TCPConnector(limit=concurrency)
+    async with ClientSession(connector=connector) as session:
+        await wait_ready(session, url)
+        count = 0
+        deadline = time.monotonic() + duration
+
+        async def worker() -> None:
+            nonlocal count
+            while time.monotonic() < deadline:
+                async with session.get(url) as response:
+                    await response.read()
+                    count += 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return count
+
+
+@click.command()
+@click.option(
+    "--event-loop",
+    "event_loops",
+    type=click.Choice(EventLoop, case_sensitive=False),
+    multiple=True,
+    default=list(EventLoop),
+    show_default=True,
+)
+@click.option("--series", type=int, default=1000, show_default=True)
+@click.option("--concurrency", type=int, default=16, show_default=True)
+@click.option("--duration", type=float, default=10.0, show_default=True)
+def main(
+    event_loops: tuple[EventLoop, ...],
+    series: int,
+    concurrency: int,
+    duration: float,
+) -> None:
+    """Compare scrape throughput between event loop implementations."""
+    for event_loop in event_loops:
+        if not importlib.util.find_spec(event_loop.value):
+            click.echo(f"{event_loop:10} not available, skipping")
+            continue
+        port = free_port()
+        process = multiprocessing.Process(
+            target=run_exporter, args=(port, event_loop, series)
+        )
+        process.start()
+        try:
+            count = asyncio.run(
+                scrape(
+                    f"http://127.0.0.1:{port}/metrics", concurrency, duration
+                )
+            )
+        finally:
+            process.terminate()
+            process.join()
+        click.echo(
+            f"{event_loop:10} {count / duration:10.1f} scrapes/s "
+            f"({series} series, {concurrency} concurrent clients)"
+        )
+
+
+if __name__ == "__main__":
+    main()
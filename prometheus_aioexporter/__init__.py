@@ -1,26 +1,74 @@
 """Asyncio library for creating Prometheus exporters."""
 
+from ._cardinality import (
+    FamilyCardinality,
+    LabelCardinality,
+    SeriesBudget,
+)
+from ._catalog import (
+    InvalidMetricsConfig,
+    MetricsConfigReloader,
+    load_metric_configs,
+)
+from ._federation import FederationCollector
+from ._ingest import UpdateWriter
 from ._metric import (
+    AsyncCollector,
     InvalidMetricType,
+    MetricChanges,
     MetricConfig,
+    MetricDelta,
+    MetricRemoval,
     MetricsRegistry,
+    MetricUpdate,
 )
+from ._probe import CLIENT_SESSION_APP_KEY, Prober, RegistryCache
+from ._push import MetricsPusher, PushError
+from ._remote_write import RemoteWriteError, RemoteWriter
 from ._script import Arguments, PrometheusExporterScript
+from ._shared_values import SharedValueStore, SharedValueStoreError
+from ._snapshot import MetricsSnapshotter, SnapshotError
 from ._web import (
     EXPORTER_APP_KEY,
+    EventLoop,
     PrometheusExporter,
     PrometheusExporterConfig,
 )
 
 __all__ = [
+    "CLIENT_SESSION_APP_KEY",
     "EXPORTER_APP_KEY",
     "Arguments",
+    "AsyncCollector",
+    "EventLoop",
+    "FamilyCardinality",
+    "FederationCollector",
     "InvalidMetricType",
+    "InvalidMetricsConfig",
+    "LabelCardinality",
+    "MetricChanges",
     "MetricConfig",
+    "MetricDelta",
+    "MetricRemoval",
+    "MetricUpdate",
+    "MetricsConfigReloader",
+    "MetricsPusher",
     "MetricsRegistry",
+    "MetricsSnapshotter",
+    "Prober",
     "PrometheusExporter",
     "PrometheusExporterConfig",
     "PrometheusExporterScript",
+    "PushError",
+    "RegistryCache",
+    "RemoteWriteError",
+    "RemoteWriter",
+    "SeriesBudget",
+    "SharedValueStore",
+    "SharedValueStoreError",
+    "SnapshotError",
+    "UpdateWriter",
+    "load_metric_configs",
 ]
 
 __version__ = "3.2.0"
@@ -0,0 +1,148 @@
+"""Admission control for scrape requests."""
+
+import asyncio
+from collections import Counter
+from collections.abc import AsyncGenerator, Iterator
+from contextlib import asynccontextmanager
+import math
+import time
+
+from aiohttp.web import (
+    HTTPServiceUnavailable,
+    HTTPTooManyRequests,
+    Request,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+
+# Number of tracked clients above which stale ones are pruned
+_MAX_TRACKED_CLIENTS = 10000
+
+
+class ScrapeAdmission(Collector):
+    """Limit concurrent and frequent scrape requests.
+
+    At most `concurrency` requests are processed at once (unlimited if 0),
+    with up to `queue_size` requests waiting for at most `queue_timeout`
+    seconds; other requests are rejected with a 503.  Requests from the same
+    client IP within `min_interval` seconds of the previous one are rejected
+    with a 429.  Rejected responses include a Retry-After header.
+
+    Clients are identified by the peer address, unless `client_header` is
+    set, in which case the last address in the header (e.g.
+    X-Forwarded-For, as appended by a reverse proxy) is used.
+
+
+    The object is a collector exposing in-flight, queued and rejected
+    requests.
+
+    """
+
+    def __init__(
+        self,
+        concurrency: int = 0,
+        queue_size: int = 0,
+        queue_timeout: float = 10.0,
+        min_interval: float = 0.0,
+        client_header: str | None = None,
+    ) -> None:
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.min_interval = min_interval
+        self.client_header = client_header
+        self._semaphore = asyncio.Semaphore(concurrency or 1)
+        self._in_flight = 0
+        self._queued = 0
+        self._last_seen: dict[str, float] = {}
+        self._rejected: Counter[str] = Counter(
+            rate_limited=0, queue_full=0, queue_timeout=0
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any limit is set."""
+        return bool(self.concurrency or self.min_interval)
+
+    @asynccontextmanager
+    async def admit(self, request: Request) -> AsyncGenerator[None]:
+        """Context manager admitting a request, or raising an HTTP error."""
+        if self.min_interval:
+            self._check_interval(self._client(request))
+        if not self.concurrency:
+            yield
+            return
+        await self._acquire()
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def collect(self) -> Iterator[Metric]:
+        yield GaugeMetricFamily(
+            "exporter_scrapes_in_flight",
+            "Scrape requests being processed",
+            value=self._in_flight,
+        )
+        yield GaugeMetricFamily(
+            "exporter_scrapes_queued",
+            "Scrape requests waiting to be processed",
+            value=self._queued,
+        )
+        rejected = CounterMetricFamily(
+            "exporter_scrapes_rejected",
+            "Scrape requests rejected by admission control",
+            labels=["reason"],
+        )
+        for reason, count in self._rejected.items():
+            rejected.add_metric([reason], count)
+        yield rejected
+
+    def _client(self, request: Request) -> str:
+        if self.client_header and (
+            header := request.headers.get(self.client_header)
+        ):
+            return header.rsplit(",", 1)[-1].strip()
+        return request.remote or ""
+
+    def _check_interval(self, client: str) -> None:
+        now = time.monotonic()
+        last = self._last_seen.get(client)
+        if last is not None and (wait := last + self.min_interval - now) > 0:
+            self._rejected["rate_limited"] += 1
+            raise HTTPTooManyRequests(
+                headers={"Retry-After": str(math.ceil(wait))},
+                text="Too many requests",
+            )
+        if len(self._last_seen) >= _MAX_TRACKED_CLIENTS:
+            self._last_seen = {
+                client: seen
+                for client, seen in self._last_seen.items()
+                if seen + self.min_interval > now
+            }
+        self._last_seen[client] = now
+
+    async def _acquire(self) -> None:
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()
+            return
+        if self._queued >= self.queue_size:
+            self._rejected["queue_full"] += 1
+            raise self._unavailable()
+        self._queued += 1
+        try:
+            async with asyncio.timeout(self.queue_timeout):
+                await self._semaphore.acquire()
+        except TimeoutError:
+            self._rejected["queue_timeout"] += 1
+            raise self._unavailable() from None
+        finally:
+            self._queued -= 1
+
+    def _unavailable(self) -> HTTPServiceUnavailable:
+        return HTTPServiceUnavailable(
+            headers={"Retry-After": "1"}, text="Too many concurrent requests"
+        )
@@ -0,0 +1,357 @@
+"""Track series cardinality of metrics."""
+
+import collections
+from collections.abc import Callable
+from dataclasses import dataclass
+import functools
+import os
+import sys
+import threading
+import typing as t
+
+from prometheus_client.metrics import MetricWrapperBase
+
+
+@dataclass(frozen=True)
+class LabelCardinality:
+    """Cardinality of a metric label."""
+
+    name: str
+    # Number of distinct values
+    values: int
+    # Most common values, with the number of series for each
+    top: tuple[tuple[str, int], ...]
+
+
+@dataclass(frozen=True)
+class FamilyCardinality:
+    """Cardinality of a metric family."""
+
+    name: str
+    type: str
+    series: int
+    # Change in the number of series since the previous report
+    growth: int
+    # Rough estimate of memory used by series
+    estimated_bytes: int
+    labels: tuple[LabelCardinality, ...]
+
+
+@dataclass(frozen=True)
+class SeriesBudget:
+    """Limits for series and memory used by metrics.
+
+    Above soft limits, metrics are shed, while above hard limits new series
+    are refused.  Memory limits are for the resident set size of the
+    process, in bytes.  Limits set to 0 are disabled.
+
+    """
+
+    soft_max_series: int = 0
+    max_series: int = 0
+    soft_max_memory: int = 0
+    max_memory: int = 0
+
+    @property
+    def enabled(self) -> bool:
+        return any(
+            (
+                self.soft_max_series,
+                self.max_series,
+                self.soft_max_memory,
+                self.max_memory,
+            )
+        )
+
+    @property
+    def memory_limited(self) -> bool:
+        return bool(self.soft_max_memory or self.max_memory)
+
+
+class SeriesTotal:
+    """Running total of series across multiple metrics."""
+
+    def __init__(self) -> None:
+        self.series = 0
+        self._lock = threading.Lock()
+
+    def add(self, count: int) -> None:
+        with self._lock:
+            self.series += count
+
+
+class SeriesStats:
+    """Statistics for series of a metric, updated as series change.
+
+    If a `guard` is set, it's called before a new series is added, and the
+    series is refused if it returns False.  The `blocked` flag is set while
+    the metric is shed by the guard owner.
+
+    Changes in the number of series are also applied to the `total`, if
+    set (see `set_total()`).
+
+    """
+
+    guard: Callable[["SeriesStats"], bool] | None = None
+    blocked: bool = False
+    total: SeriesTotal | None = None
+
+    def __init__(self, labelnames: t.Sequence[str]) -> None:
+        self.labelnames = tuple(labelnames)
+        self.series = 0
+        self._lock = threading.Lock()
+        self._label_values = [
+            collections.Counter[str]() for _ in self.labelnames
+        ]
+        self._label_bytes = 0
+        # size of a single series object, measured on the first one
+        self._series_size = 0
+        self._reported = 0
+
+    @property
+    def estimated_bytes(self) -> int:
+        """Rough estimate of memory used by series."""
+        return self.series * self._series_size + self._label_bytes
+
+    def set_total(self, total: SeriesTotal | None) -> None:
+        """Set the total which series of the metric count towards."""
+        with self._lock:
+            if self.total:
+                self.total.add(-self.series)
+            self.total = total
+            if total:
+                total.add(self.series)
+
+    def admit(self) -> bool:
+        """Return whether a new series can be added."""
+        return self.guard is None or self.guard(self)
+
+    def add(self, labelvalues: tuple[str, ...], series: t.Any) -> None:
+        """Account for a new series."""
+        with self._lock:
+            if not self._series_size:
+                self._series_size = _object_size(series)
+            self.series += 1
+            if self.total:
+                self.total.add(1)
+            # label values are interned, so each distinct value is only
+            # stored once
+            self._label_bytes += sys.getsizeof(labelvalues)
+            for counts, value in zip(
+                self._label_values, labelvalues, strict=True
+            ):
+                if not counts[value]:
+                    self._label_bytes += sys.getsizeof(value)
+                counts[value] += 1
+
+    def remove(self, labelvalues: tuple[str, ...]) -> None:
+        """Account for a removed series."""
+        with self._lock:
+            self.series -= 1
+            if self.total:
+                self.total.add(-1)
+            self._label_bytes -= sys.getsizeof(labelvalues)
+            for counts, value in zip(
+                self._label_values, labelvalues, strict=True
+            ):
+                counts[value] -= 1
+                if not counts[value]:
+                    del counts[value]
+                    self._label_bytes -= sys.getsizeof(value)
+
+    def clear(self) -> None:
+        """Account for removal of all series."""
+        with self._lock:
+            if self.total:
+                self.total.add(-self.series)
+            self.series = 0
+            self._label_bytes = 0
+            for counts in self._label_values:
+                counts.clear()
+
+    def report(self, name: str, type: str, top: int) -> FamilyCardinality:
+        """Return cardinality details, with the `top` values for labels.
+
+        The growth in series is relative to the previous call.
+
+        """
+        with self._lock:
+            growth = self.series - self._reported
+            self._reported = self.series
+            return FamilyCardinality(
+                name=name,
+                type=type,
+                series=self.series,
+                growth=growth,
+                estimated_bytes=self.estimated_bytes,
+                labels=tuple(
+                    LabelCardinality(
+                        name=label,
+                        values=len(counts),
+                        top=tuple(counts.most_common(top)),
+                    )
+                    for label, counts in zip(
+                        self.labelnames, self._label_values, strict=True
+                    )
+                ),
+            )
+
+
+_Metric = t.TypeVar("_Metric", bound=MetricWrapperBase)
+
+
+class _SeriesRefused(Exception):
+    """Raised when a new series is refused."""
+
+    def __init__(self, series: t.Any):
+        self.series = series
+        super().__init__("Series refused")
+
+
+class _InternedSeries(dict[t.Sequence[str], t.Any]):
+    """Series of a metric, with interned label values.
+
+    Label values for new series are interned, since they're mostly repeated
+    across series, and the labels tuple is shared between the key and the
+    series.
+
+    """
+
+    def __setitem__(self, key: t.Sequence[str], value: t.Any) -> None:
+        if key not in self:
+            key = self._add(key, value)
+        super().__setitem__(key, value)
+
+    def _add(self, key: t.Sequence[str], value: t.Any) -> tuple[str, ...]:
+        """Return the interned key for a new series."""
+        interned = tuple(map(sys.intern, key))
+        value._labelvalues = interned
+        return interned
+
+
+class _TrackedSeries(_InternedSeries):
+    """Interned series of a metric, updating stats as they change."""
+
+    def __init__(self, stats: SeriesStats) -> None:
+        super().__init__()
+        self.stats = stats
+
+    def _add(self, key: t.Sequence[str], value: t.Any) -> tuple[str, ...]:
+        if not self.stats.admit():
+            raise _SeriesRefused(value)
+        interned = super()._add(key, value)
+        self.stats.add(interned, value)
+        return interned
+
+    def __delitem__(self, key: t.Sequence[str]) -> None:
+        super().__delitem__(key)
+        self.stats.remove(tuple(key))
+
+    def pop(self, key: t.Any, /, *default: t.Any) -> t.Any:
+        if key in self:
+            self.stats.remove(tuple(key))
+        return super().pop(key, *default)
+
+
+class InternedMetric(MetricWrapperBase):
+    """Mixin for metrics interning label values of their series."""
+
+    def __init__(self, *args: t.Any, **kwargs: t.Any) -> None:
+        super().__init__(*args, **kwargs)
+        if not self._labelvalues:
+            # not a child series
+            self._init_series()
+
+    def clear(self) -> None:
+        if not self._labelnames:
+            return
+        with self._lock:
+            self._metrics = self._new_series()
+
+    def _init_series(self) -> None:
+        if self._labelnames:
+            self._metrics = self._new_series()
+
+    def _new_series(self) -> _InternedSeries:
+        return _InternedSeries()
+
+
+class TrackedMetric(InternedMetric):
+    """Mixin for metrics keeping `SeriesStats` up to date.
+
+    If a new series is refused, `labels()` returns a series which is not
+    part of the metric, so its values are discarded.
+
+    """
+
+    series_stats: SeriesStats
+
+    def labels(self, *labelvalues: t.Any, **labelkwargs: t.Any) -> t.Any:
+        try:
+            return super().labels(*labelvalues, **labelkwargs)
+        except _SeriesRefused as refused:
+            return refused.series
+
+    def clear(self) -> None:
+        if not self._labelnames:
+            return
+        with self._lock:
+            self._metrics = self._new_series()
+            self.series_stats.clear()
+
+    def _init_series(self) -> None:
+        self.series_stats = SeriesStats(self._labelnames)
+        super()._init_series()
+        if not self._labelnames:
+            self.series_stats.add((), self)
+
+    def _new_series(self) -> _InternedSeries:
+        return _TrackedSeries(self.series_stats)
+
+
+@functools.cache
+def interned_metric_class(cls: type[_Metric]) -> type[_Metric]:
+    """Return a subclass of a metric class which interns label values."""
+    return t.cast(type[_Metric], type(cls.__name__, (InternedMetric, cls), {}))
+
+
+@functools.cache
+def tracked_metric_class(cls: type[_Metric]) -> type[_Metric]:
+    """Return a subclass of a metric class which tracks cardinality."""
+    return t.cast(type[_Metric], type(cls.__name__, (TrackedMetric, cls), {}))
+
+
+def resident_memory() -> int:
+    """Return the resident set size of the process, or 0 if unknown."""
+    try:
+        with open("/proc/self/statm") as fd:
+            pages = int(fd.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _object_size(obj: t.Any) -> int:
+    """Return a shallow estimate of the memory used by an object.
+
+    This includes the object, its attributes and their attributes, except
+    strings, which are usually shared with the parent metric.
+
+    """
+    size = 0
+    seen: set[int] = set()
+    objects = [obj]
+    for _ in range(3):
+        attributes = []
+        for item in objects:
+            if id(item) in seen or isinstance(item, str | type):
+                continue
+            seen.add(id(item))
+            size += sys.getsizeof(item)
+            if isinstance(item, list | tuple):
+                attributes.extend(item)
+            elif hasattr(item, "__dict__"):
+                size += sys.getsizeof(vars(item))
+                attributes.extend(vars(item).values())
+        objects = attributes
+    return size
@@ -0,0 +1,305 @@
+"""Load metric configurations from a file."""
+
+import asyncio
+from collections.abc import Callable
+from dataclasses import asdict
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import signal
+import tempfile
+import tomllib
+import typing as t
+
+from aiohttp.web import Application
+import structlog
+
+from ._metric import (
+    InvalidMetricType,
+    MetricChanges,
+    MetricConfig,
+    MetricsRegistry,
+)
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover
+    yaml = None
+
+# Bumped when the cached format changes, to invalidate existing entries
+_CACHE_VERSION = 3
+
+_METRIC_NAME_RE = re.compile(r"^[a-zA-Z_:][a-zA-Z0-9_:]*$")
+_LABEL_NAME_RE = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
+
+_REQUIRED_KEYS = frozenset(("name", "description", "type"))
+_OPTIONAL_KEYS = frozenset(("labels", "config", "priority"))
+
+
+class InvalidMetricsConfig(Exception):
+    """Raised when a metrics configuration file is invalid."""
+
+    def __init__(self, path: Path, details: str):
+        self.path = path
+        self.details = details
+        super().__init__(f"Invalid metrics config {path}: {details}")
+
+
+def _load_yaml(content: bytes) -> t.Any:
+    if yaml is None:  # pragma: no cover
+        raise RuntimeError("PyYAML is required to load YAML files")
+    return yaml.safe_load(content)
+
+
+# Map file extensions to parsers
+_PARSERS: dict[str, Callable[[bytes], t.Any]] = {
+    ".json": json.loads,
+    ".toml": lambda content: tomllib.loads(content.decode()),
+    ".yaml": _load_yaml,
+    ".yml": _load_yaml,
+}
+
+
+def load_metric_configs(
+    path: Path, cache_dir: Path | None = None
+) -> list[MetricConfig]:
+    """Load MetricConfigs from a JSON, YAML or TOML file.
+
+    The file must contain a "metrics" list, with an entry for each metric
+    with "name", "description", "type" and optionally "labels", "config" and
+    "priority" keys.
+
+    If `cache_dir` is provided, the validated configuration is cached there,
+    keyed by the hash of the file content, so it's not parsed and validated
+    again if the file doesn't change.  Only the latest entry is kept.
+
+    """
+    content = path.read_bytes()
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha256(content).hexdigest()
+        cache_file = cache_dir / f"metrics-v{_CACHE_VERSION}-{digest}.json"
+        if (configs := _read_cache(cache_file)) is not None:
+            return configs
+
+    configs = _parse_metric_configs(path, content)
+    if cache_file is not None:
+        _write_cache(cache_file, configs)
+    return configs
+
+
+def _parse_metric_configs(path: Path, content: bytes) -> list[MetricConfig]:
+    parser = _PARSERS.get(path.suffix.lower())
+    if parser is None:
+        formats = ", ".join(sorted(_PARSERS))
+        raise InvalidMetricsConfig(
+            path, f"unsupported file extension, must be one of {formats}"
+        )
+    try:
+        data = parser(content)
+    except Exception as e:
+        raise InvalidMetricsConfig(path, f"parse error: {e}") from e
+
+    if not isinstance(data, dict) or not isinstance(data.get("metrics"), list):
+        raise InvalidMetricsConfig(path, "must contain a 'metrics' list")
+
+    configs: list[MetricConfig] = []
+    names: set[str] = set()
+    for index, entry in enumerate(data["metrics"]):
+        config = _parse_metric_config(path, index, entry)
+        if config.name in names:
+            raise InvalidMetricsConfig(
+                path, f"duplicated metric name: {config.name}"
+            )
+        names.add(config.name)
+        configs.append(config)
+    return configs
+
+
+def _parse_metric_config(path: Path, index: int, entry: t.Any) -> MetricConfig:
+    def fail(details: str) -> t.NoReturn:
+        raise InvalidMetricsConfig(path, f"metric #{index}: {details}")
+
+    if not isinstance(entry, dict):
+        fail("must be a mapping")
+    if missing := _REQUIRED_KEYS - entry.keys():
+        fail(f"missing keys: {', '.join(sorted(missing))}")
+    if unknown := entry.keys() - _REQUIRED_KEYS - _OPTIONAL_KEYS:
+        fail(f"unknown keys: {', '.join(sorted(unknown))}")
+
+    name = entry["name"]
+    if not isinstance(name, str) or not _METRIC_NAME_RE.match(name):
+        fail(f"invalid name: {name!r}")
+    if not isinstance(entry["description"], str):
+        fail("description must be a string")
+    if not isinstance(entry["type"], str):
+        fail("type must be a string")
+    labels = entry.get("labels", [])
+    if not isinstance(labels, list) or not all(
+        isinstance(label, str) and _LABEL_NAME_RE.match(label)
+        for label in labels
+    ):
+        fail("labels must be a list of valid label names")
+    config = entry.get("config", {})
+    if not isinstance(config, dict):
+        fail("config must be a mapping")
+    priority = entry.get("priority", 0)
+    if not isinstance(priority, int) or isinstance(priority, bool):
+        fail("priority must be an integer")
+
+    try:
+        return MetricConfig(
+            name,
+            entry["description"],
+            entry["type"],
+            labels=labels,
+            config=config,
+            priority=priority,
+        )
+    except InvalidMetricType as e:
+        fail(str(e))
+
+
+def _read_cache(cache_file: Path) -> list[MetricConfig] | None:
+    try:
+        with cache_file.open("rb") as fd:
+            entries = json.load(fd)
+        if not isinstance(entries, list):
+            return None
+        return [MetricConfig(**entry) for entry in entries]
+    except Exception:
+        # missing, corrupted or incompatible entry, it will be replaced
+        return None
+
+
+def _write_cache(cache_file: Path, configs: list[MetricConfig]) -> None:
+    # caching is best-effort, failing to write the file is not an error
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "w") as tmp_file:
+            json.dump([asdict(config) for config in configs], tmp_file)
+        os.replace(tmp_path, cache_file)
+    except (OSError, TypeError, ValueError):
+        # values in the config might not be serializable
+        os.unlink(tmp_path)
+        return
+    # entries for previous contents of the file are no longer needed
+    for old_file in cache_file.parent.glob(
+        f"metrics-v{_CACHE_VERSION}-*.json"
+    ):
+        if old_file == cache_file:
+            continue
+        try:
+            old_file.unlink()
+        except OSError:
+            pass
+
+
+class MetricsConfigReloader:
+    """Keep metrics in a registry in sync with a metrics config file.
+
+    Once started, the file is reloaded on SIGHUP and, if `watch_interval` is
+    set, when the file changes.  Metrics whose definition is unchanged keep
+    their values.
+
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        path: Path,
+        cache_dir: Path | None = None,
+        watch_interval: float = 0.0,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.registry = registry
+        self.path = path
+        self.cache_dir = cache_dir
+        self.watch_interval = watch_interval
+        self.logger = logger or structlog.get_logger()
+        self._names: set[str] = set()
+        # ID of the file last loaded, or that failed to load, so that each
+        # change is only attempted once by the watcher
+        self._file_id: tuple[int, ...] | None = None
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task[None]] = set()
+
+    def load(self) -> MetricChanges:
+        """Load metrics from the file, applying changes to the registry."""
+        file_id = self._get_file_id()
+        configs = load_metric_configs(self.path, cache_dir=self.cache_dir)
+        return self._apply(configs, file_id)
+
+    async def reload(self) -> None:
+        """Reload metrics from the file, logging errors."""
+        async with self._lock:
+            file_id = self._get_file_id()
+            try:
+                configs = await asyncio.to_thread(
+                    load_metric_configs, self.path, cache_dir=self.cache_dir
+                )
+                changes = self._apply(configs, file_id)
+            except Exception as e:
+                self._file_id = file_id
+                self.logger.error(
+                    "metrics config reload failed",
+                    path=str(self.path),
+                    error=str(e),
+                )
+                return
+        self.logger.info(
+            "metrics config reloaded",
+            path=str(self.path),
+            added=changes.added,
+            updated=changes.updated,
+            removed=changes.removed,
+        )
+
+    async def start(self, app: Application) -> None:
+        """Start reloading on SIGHUP and file changes."""
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self._schedule_reload)
+        if self.watch_interval:
+            self._create_task(self._watch())
+
+    async def stop(self, app: Application) -> None:
+        """Stop reloading."""
+        asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _apply(
+        self, configs: list[MetricConfig], file_id: tuple[int, ...] | None
+    ) -> MetricChanges:
+        changes = self.registry.reconcile_metrics(configs, managed=self._names)
+        self._names = {config.name for config in configs}
+        self._file_id = file_id
+        return changes
+
+    def _schedule_reload(self) -> None:
+        self._create_task(self.reload())
+
+    def _create_task(self, coro: t.Coroutine[t.Any, t.Any, None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            if self._get_file_id() != self._file_id:
+                await self.reload()
+
+    def _get_file_id(self) -> tuple[int, ...] | None:
+        try:
+            stat = self.path.stat()
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
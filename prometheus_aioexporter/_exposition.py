@@ -0,0 +1,234 @@
+"""Text and OpenMetrics exposition formats encoding."""
+
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
+
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics.exposition import (
+    ALLOWUTF8,
+    UNDERSCORES,
+    _compose_exemplar_string,
+    _escape,
+    _is_legacy_labelname_rune,
+    _is_valid_legacy_metric_name,
+    escape_label_name,
+    escape_metric_name,
+)
+from prometheus_client.registry import Collector
+from prometheus_client.utils import floatToGoString
+
+# Samples specific to OpenMetrics, exposed as separate gauges
+_OPENMETRICS_SUFFIXES = ("_created", "_gsum", "_gcount")
+
+# Exposed names and types for OpenMetrics types
+_TYPES = {
+    "counter": ("_total", "counter"),
+    "info": ("_info", "gauge"),
+    "stateset": ("", "gauge"),
+    "gaugehistogram": ("", "histogram"),
+    "unknown": ("", "untyped"),
+}
+
+# Key for a series, from sample name and labels
+_SeriesKey = tuple[str, tuple[tuple[str, str], ...]]
+
+
+class _CachingEncoder(ABC):
+    """Base class for encoders caching series prefixes and headers.
+
+    Cached entries are dropped when they outnumber twice the samples (or
+    headers) of the last encoded output, so that the cache doesn't grow
+    unbounded as series come and go.
+
+    """
+
+    def __init__(self) -> None:
+        self._prefixes: dict[_SeriesKey, str] = {}
+        self._headers: dict[tuple[str, ...], str] = {}
+
+    def encode(self, registry: Collector) -> bytes:
+        """Return metrics from the registry, encoded."""
+        return self.encode_metrics(registry.collect())
+
+    @abstractmethod
+    def encode_metrics(self, metrics: Iterable[Metric]) -> bytes:
+        """Return metrics, encoded."""
+
+    def _prune(self, samples_count: int, headers_count: int) -> None:
+        if len(self._prefixes) > 2 * samples_count:
+            self._prefixes.clear()
+        if len(self._headers) > 2 * headers_count:
+            self._headers.clear()
+
+
+class TextEncoder(_CachingEncoder):
+    """Encode metrics in the Prometheus text format (version 0.0.4).
+
+    The output is the same as `prometheus_client.generate_latest()`, but
+    the escaped series prefix (metric name and labels) of each sample, as
+    well as family headers, are cached across calls, since label sets rarely
+    change between scrapes.
+
+    """
+
+    def encode_metrics(self, metrics: Iterable[Metric]) -> bytes:
+        """Return metrics in text format."""
+        output: list[str] = []
+        append = output.append
+        prefixes = self._prefixes
+        samples_count = headers_count = 0
+        for metric in metrics:
+            name = metric.name
+            append(self._header(name, metric.documentation, metric.type))
+            headers_count += 1
+            openmetrics_lines: dict[str, list[str]] = {}
+            for sample in metric.samples:
+                samples_count += 1
+                key = (sample.name, tuple(sample.labels.items()))
+                prefix = prefixes.get(key)
+                if prefix is None:
+                    prefix = prefixes[key] = _series_prefix(
+                        sample.name, sample.labels
+                    )
+                line = prefix + floatToGoString(sample.value)
+                if sample.timestamp is not None:
+                    line += f" {int(float(sample.timestamp) * 1000):d}"
+                line += "\n"
+                suffix = sample.name[len(name) :]
+                if (
+                    suffix in _OPENMETRICS_SUFFIXES
+                    and sample.name[: len(name)] == name
+                ):
+                    openmetrics_lines.setdefault(suffix, []).append(line)
+                else:
+                    append(line)
+            for suffix, lines in sorted(openmetrics_lines.items()):
+                headers_count += 1
+                append(
+                    self._header(name + suffix, metric.documentation, "gauge")
+                )
+                output.extend(lines)
+        self._prune(samples_count, headers_count)
+        return "".join(output).encode()
+
+    def _header(self, name: str, documentation: str, type: str) -> str:
+        key = (name, documentation, type)
+        header = self._headers.get(key)
+        if header is None:
+            suffix, type = _TYPES.get(type, ("", type))
+            name = escape_metric_name(name + suffix)
+            documentation = documentation.replace("\\", r"\\").replace(
+                "\n", r"\n"
+            )
+            header = self._headers[key] = (
+                f"# HELP {name} {documentation}\n# TYPE {name} {type}\n"
+            )
+        return header
+
+
+class OpenMetricsEncoder(_CachingEncoder):
+    """Encode metrics in the OpenMetrics text format (version 1.0.0).
+
+    The output is the same as
+    `prometheus_client.openmetrics.exposition.generate_latest()` with the
+    specified `escaping` for names, with series prefixes and family headers
+    cached as for `TextEncoder`.
+
+    """
+
+    def __init__(self, escaping: str = UNDERSCORES) -> None:
+        super().__init__()
+        self.escaping = escaping
+
+    def encode_metrics(self, metrics: Iterable[Metric]) -> bytes:
+        """Return metrics in OpenMetrics format."""
+        output: list[str] = []
+        append = output.append
+        prefixes = self._prefixes
+        samples_count = headers_count = 0
+        for metric in metrics:
+            append(
+                self._header(
+                    metric.name, metric.documentation, metric.type, metric.unit
+                )
+            )
+            headers_count += 1
+            for sample in metric.samples:
+                # native histograms are not supported by the format version
+                if sample.native_histogram:
+                    continue
+                samples_count += 1
+                key = (sample.name, tuple(sample.labels.items()))
+                prefix = prefixes.get(key)
+                if prefix is None:
+                    prefix = prefixes[key] = _openmetrics_series_prefix(
+                        sample.name, sample.labels, self.escaping
+                    )
+                line = prefix
+                if sample.value is not None:
+                    line += floatToGoString(sample.value)
+                if sample.timestamp is not None:
+                    line += f" {sample.timestamp}"
+                if sample.exemplar:
+                    line += _compose_exemplar_string(
+                        metric, sample, sample.exemplar
+                    )
+                append(line + "\n")
+        append("# EOF\n")
+        self._prune(samples_count, headers_count)
+        return "".join(output).encode()
+
+    def _header(
+        self, name: str, documentation: str, type: str, unit: str
+    ) -> str:
+        key = (name, documentation, type, unit)
+        header = self._headers.get(key)
+        if header is None:
+            name = escape_metric_name(name, self.escaping)
+            documentation = _escape(
+                documentation, ALLOWUTF8, _is_legacy_labelname_rune
+            )
+            header = f"# HELP {name} {documentation}\n# TYPE {name} {type}\n"
+            if unit:
+                header += f"# UNIT {name} {unit}\n"
+            self._headers[key] = header
+        return header
+
+
+def _series_prefix(name: str, labels: dict[str, str]) -> str:
+    """Return the escaped name and labels for a sample, up to the value."""
+    name = escape_metric_name(name)
+    if not labels:
+        return name + " "
+    labels_text = ",".join(
+        f'{escape_label_name(label)}="{_escape_label_value(value)}"'
+        for label, value in sorted(labels.items())
+    )
+    return f"{name}{{{labels_text}}} "
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _openmetrics_series_prefix(
+    name: str, labels: dict[str, str], escaping: str
+) -> str:
+    """Return the escaped name and labels for an OpenMetrics sample."""
+    labels_text = ""
+    if escaping == ALLOWUTF8 and not _is_valid_legacy_metric_name(name):
+        # the name is quoted inside braces, along with labels
+        labels_text = escape_metric_name(name, escaping)
+        if labels:
+            labels_text += ","
+        name = ""
+    else:
+        name = _escape(name, escaping, _is_legacy_labelname_rune)
+    labels_text += ",".join(
+        f"{escape_label_name(label, escaping)}="
+        f'"{_escape(value, ALLOWUTF8, _is_legacy_labelname_rune)}"'
+        for label, value in sorted(labels.items())
+    )
+    if labels_text:
+        labels_text = f"{{{labels_text}}}"
+    return f"{name}{labels_text} "
@@ -0,0 +1,191 @@
+"""Merge metrics scraped from other exporters."""
+
+import asyncio
+from collections.abc import Iterator, Mapping
+from dataclasses import dataclass, field
+import io
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from aiohttp.web import Application
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.parser import text_fd_to_metric_families
+from prometheus_client.registry import Collector, CollectorRegistry
+import structlog
+
+
+@dataclass
+class _UpstreamState:
+    """Metrics last scraped from an upstream exporter."""
+
+    families: list[Metric] = field(default_factory=list)
+    # Monotonic time of the last successful scrape
+    updated: float | None = None
+    up: bool = False
+    duration: float = 0.0
+
+
+class FederationCollector(Collector):
+    """Collector merging metrics scraped from upstream exporters.
+
+    Upstreams are scraped concurrently every `interval` seconds, each with a
+    `timeout`, and samples are labelled with the upstream name (as the
+    `label` label).  Collecting returns metrics from the last successful
+    scrape of each upstream, so slow upstreams don't delay collection.
+    Metrics from an upstream are dropped if it's not scraped successfully for
+    `max_age` seconds (by default, three intervals).
+
+    Metrics with the same name from different upstreams are merged in a
+    single family, and `exporter_federation_upstream_up` and
+    `exporter_federation_upstream_scrape_duration_seconds` metrics are
+    included for each upstream.  Metrics that can't be merged, because their
+    type conflicts with the one from another upstream or their name is used
+    by a metric in the local `registry`, are skipped, and the conflict is
+    logged.
+
+    """
+
+    def __init__(
+        self,
+        upstreams: Mapping[str, str],
+        label: str = "upstream",
+        interval: float = 15.0,
+        timeout: float = 10.0,
+        max_age: float | None = None,
+        registry: CollectorRegistry | None = None,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.upstreams = dict(upstreams)
+        self.label = label
+        self.interval = interval
+        self.timeout = timeout
+        self.max_age = 3 * interval if max_age is None else max_age
+        self.registry = registry
+        self.logger = logger or structlog.get_logger()
+        self._states = {name: _UpstreamState() for name in self.upstreams}
+        self._session: ClientSession | None = None
+        self._task: asyncio.Task[None] | None = None
+        # conflicts already logged, as (upstream, metric) pairs
+        self._conflicts: set[tuple[str, str]] = set()
+
+    async def start(self, app: Application) -> None:
+        """Start scraping upstreams periodically."""
+        self._session = ClientSession(
+            connector=TCPConnector(limit=len(self.upstreams)),
+            timeout=ClientTimeout(total=self.timeout),
+        )
+        self._task = asyncio.create_task(self._refresh_periodically())
+
+    async def stop(self, app: Application) -> None:
+        """Stop scraping upstreams."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def refresh(self) -> None:
+        """Scrape all upstreams concurrently."""
+        await asyncio.gather(
+            *(
+                self._refresh_upstream(name, url)
+                for name, url in self.upstreams.items()
+            )
+        )
+
+    def collect(self) -> Iterator[Metric]:
+        now = time.monotonic()
+        families: dict[str, Metric] = {}
+        up = GaugeMetricFamily(
+            "exporter_federation_upstream_up",
+            "Whether the last scrape of the upstream succeeded",
+            labels=[self.label],
+        )
+        duration = GaugeMetricFamily(
+            "exporter_federation_upstream_scrape_duration_seconds",
+            "Duration of the last scrape of the upstream",
+            labels=[self.label],
+        )
+        for name, state in self._states.items():
+            up.add_metric([name], int(state.up))
+            duration.add_metric([name], state.duration)
+            if state.updated is None or now - state.updated > self.max_age:
+                continue
+            for family in state.families:
+                if self._is_local(family.name):
+                    self._log_conflict(name, family.name, "local metric")
+                    continue
+                merged = families.get(family.name)
+                if merged is None:
+                    merged = families[family.name] = Metric(
+                        family.name,
+                        family.documentation,
+                        family.type,
+                        unit=family.unit,
+                    )
+                elif merged.type != family.type:
+                    self._log_conflict(name, family.name, "type conflict")
+                    continue
+                merged.samples.extend(family.samples)
+        yield from families.values()
+        yield up
+        yield duration
+
+    def _is_local(self, name: str) -> bool:
+        if self.registry is None:
+            return False
+        collector = self.registry._names_to_collectors.get(name)
+        return collector is not None and collector is not self
+
+    def _log_conflict(self, upstream: str, metric: str, reason: str) -> None:
+        if (upstream, metric) in self._conflicts:
+            return
+        self._conflicts.add((upstream, metric))
+        self.logger.warning(
+            "federated metric skipped",
+            upstream=upstream,
+            metric=metric,
+            reason=reason,
+        )
+
+    async def _refresh_periodically(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def _refresh_upstream(self, name: str, url: str) -> None:
+        assert self._session is not None, "collector not started"
+        state = self._states[name]
+        start = time.perf_counter()
+        try:
+            async with self._session.get(
+                url, headers={"Accept": "text/plain; version=0.0.4"}
+            ) as response:
+                response.raise_for_status()
+                # the body is buffered, and decoded and parsed in a thread so
+                # that large responses don't block the loop
+                body = await response.read()
+            state.families = await asyncio.to_thread(self._parse, name, body)
+        except Exception as e:
+            state.up = False
+            self.logger.warning(
+                "upstream scrape failed",
+                upstream=name,
+                url=url,
+                error=str(e) or type(e).__name__,
+            )
+        else:
+            state.up = True
+            state.updated = time.monotonic()
+        state.duration = time.perf_counter() - start
+
+    def _parse(self, name: str, body: bytes) -> list[Metric]:
+        families = list(text_fd_to_metric_families(io.StringIO(body.decode())))
+        for family in families:
+            family.samples = [
+                sample._replace(labels={**sample.labels, self.label: name})
+                for sample in family.samples
+            ]
+        return families
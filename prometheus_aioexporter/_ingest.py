@@ -0,0 +1,48 @@
+"""Apply metric updates queued by multiple producers."""
+
+import asyncio
+
+from aiohttp.web import Application
+import structlog
+
+from ._metric import MetricsRegistry
+
+
+class UpdateWriter:
+    """Periodically apply updates queued in a registry.
+
+    Producers in any task or thread queue updates via
+    `MetricsRegistry.queue_updates()`, and the writer applies them in
+    batches every `interval` seconds from a single task, so that producers
+    don't contend on metric locks.  Pending updates are applied one last
+    time when the writer is stopped.
+
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        interval: float = 0.1,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.registry = registry
+        self.interval = interval
+        self.logger = logger or structlog.get_logger()
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self, app: Application) -> None:
+        """Start applying updates periodically."""
+        self._task = asyncio.create_task(self._write_periodically())
+
+    async def stop(self, app: Application) -> None:
+        """Stop applying updates periodically, and apply pending ones."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.registry.apply_queued_updates(logger=self.logger)
+
+    async def _write_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.registry.apply_queued_updates(logger=self.logger)
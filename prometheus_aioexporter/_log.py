@@ -1,11 +1,31 @@
+import atexit
+from collections.abc import Callable, Iterable
 from enum import IntEnum, StrEnum
 from functools import cached_property
 import logging
+import queue
+import random
+import sys
+import threading
 import typing as t
 
 from aiohttp.abc import AbstractAccessLogger
-from aiohttp.web import BaseRequest, StreamResponse
+from aiohttp.web import BaseRequest, RequestKey, StreamResponse
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.registry import Collector
 import structlog
+from structlog.typing import EventDict, WrappedLogger
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Signature for the final processor rendering log entries
+LogRenderer = Callable[[WrappedLogger, str, EventDict], str | bytes]
+
+# The request key for durations of request handling phases, in seconds
+REQUEST_PHASES_KEY: RequestKey[dict[str, float]] = RequestKey("request_phases")
 
 
 class LogFormat(StrEnum):
@@ -29,15 +49,37 @@ class LogLevel(IntEnum):
 
 
 class AccessLogger(AbstractAccessLogger):
-    """Access logger for aiohttp."""
+    """Access logger for aiohttp.
+
+    Only a `sample_rate` fraction of successful requests is logged, while
+    failed ones are always logged.  If the handler recorded durations of
+    phases in the request (under `REQUEST_PHASES_KEY`), they're included in
+    the `phases` field.
+
+    """
+
+    sample_rate: float = 1.0
 
     @cached_property
     def _logger(self) -> structlog.stdlib.BoundLogger:
         return t.cast(structlog.stdlib.BoundLogger, structlog.get_logger())
 
+    @property
+    def enabled(self) -> bool:
+        return self._logger.is_enabled_for(logging.DEBUG)
+
     def log(
         self, request: BaseRequest, response: StreamResponse, time: float
     ) -> None:
+        if (
+            response.status < 400
+            and self.sample_rate < 1.0
+            and random.random() >= self.sample_rate
+        ):
+            return
+        fields: dict[str, t.Any] = {}
+        if phases := request.get(REQUEST_PHASES_KEY):
+            fields["phases"] = phases
         self._logger.debug(
             "request",
             method=request.method,
@@ -46,18 +88,133 @@ class AccessLogger(AbstractAccessLogger):
             status=response.status,
             size=response.body_length,
             duration=time,
+            **fields,
+        )
+
+
+class QueueLogWriter(Collector):
+    """Render and write log entries from a background thread.
+
+    Entries are passed to the thread via a bounded queue. If the queue is
+    full, entries are dropped and counted.
+
+    The writer is also a Collector, exposing the number of dropped entries.
+
+    """
+
+    def __init__(
+        self,
+        renderer: LogRenderer,
+        file: t.TextIO | None = None,
+        maxsize: int = 10000,
+    ) -> None:
+        self._renderer = renderer
+        self._file = file or sys.stdout
+        self._queue: queue.Queue[EventDict | None] = queue.Queue(maxsize)
+        self._thread = threading.Thread(
+            target=self._run, name="log-writer", daemon=True
+        )
+        self._lock = threading.Lock()
+        self._dropped = 0
+
+    @property
+    def dropped(self) -> int:
+        """Number of dropped entries."""
+        return self._dropped
+
+    def start(self) -> None:
+        """Start the writer thread."""
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Write pending entries and stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._thread.join()
+
+    def write(self, event_dict: EventDict) -> None:
+        """Queue an entry for writing, dropping it if the queue is full."""
+        try:
+            self._queue.put_nowait(event_dict)
+        except queue.Full:
+            with self._lock:
+                self._dropped += 1
+
+    def logger_factory(self, *args: t.Any) -> "QueueLogger":
+        """Logger factory for structlog."""
+        return QueueLogger(self)
+
+    def collect(self) -> Iterable[CounterMetricFamily]:
+        yield CounterMetricFamily(
+            "exporter_log_entries_dropped",
+            "Log entries dropped because the log queue was full",
+            value=self._dropped,
         )
 
+    def _run(self) -> None:
+        while True:
+            event_dict = self._queue.get()
+            # write all available entries before flushing
+            while event_dict is not None:
+                self._write_entry(event_dict)
+                try:
+                    event_dict = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._file.flush()
+            if event_dict is None:
+                return
+
+    def _write_entry(self, event_dict: EventDict) -> None:
+        try:
+            line = self._renderer(None, "msg", event_dict)
+        except Exception as e:
+            line = f"failed rendering log entry: {e!r}"
+        if isinstance(line, bytes):
+            line = line.decode()
+        self._file.write(line + "\n")
+
+
+class QueueLogger:
+    """A structlog logger passing entries to a QueueLogWriter."""
+
+    def __init__(self, writer: QueueLogWriter) -> None:
+        self._writer = writer
+
+    def msg(self, **event_dict: t.Any) -> None:
+        self._writer.write(event_dict)
+
+    log = debug = info = warn = warning = msg
+    fatal = failure = err = error = critical = exception = msg
+
 
 def setup_logging(
     log_format: LogFormat = LogFormat.PLAIN,
     log_level: LogLevel = LogLevel.WARNING,
-) -> None:
-    """Setup logging for the application."""
+    queue_size: int = 0,
+    access_log_sample_rate: float = 1.0,
+) -> QueueLogWriter | None:
+    """Setup logging for the application.
+
+    If `queue_size` is not zero, log entries are rendered and written by a
+    background thread, and the QueueLogWriter is returned.
+
+    If orjson is installed, it's used for JSON rendering.
+
+    """
 
     config = structlog.get_config()
     processors = config["processors"]
+    logger_factory = config["logger_factory"]
     if log_format == LogFormat.JSON:
+        if orjson is None:
+            renderer = structlog.processors.JSONRenderer()
+        else:
+            renderer = structlog.processors.JSONRenderer(
+                serializer=orjson.dumps
+            )
+            logger_factory = structlog.BytesLoggerFactory()
         processors = [
             structlog.processors.TimeStamper(fmt="iso"),
             structlog.processors.add_log_level,
@@ -66,10 +223,24 @@ def setup_logging(
                     show_locals=False
                 )
             ),
-            structlog.processors.JSONRenderer(),
+            renderer,
         ]
 
+    writer = None
+    if queue_size:
+        # rendering is performed by the writer, with the last processor
+        *processors, renderer = processors
+        writer = QueueLogWriter(
+            t.cast(LogRenderer, renderer), maxsize=queue_size
+        )
+        writer.start()
+        atexit.register(writer.stop)
+        logger_factory = writer.logger_factory
+
+    AccessLogger.sample_rate = access_log_sample_rate
     structlog.configure(
         processors=processors,
         wrapper_class=structlog.make_filtering_bound_logger(log_level),
+        logger_factory=logger_factory,
     )
+    return writer
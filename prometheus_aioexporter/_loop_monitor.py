@@ -0,0 +1,135 @@
+"""Monitor event loop responsiveness."""
+
+import asyncio
+from collections.abc import Iterator
+import sys
+import threading
+import time
+import traceback
+
+from aiohttp.web import Application
+from prometheus_client import Histogram
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.metrics_core import Metric
+from prometheus_client.registry import Collector
+import structlog
+
+# Buckets for loop lag, in seconds
+LAG_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class LoopMonitor(Collector):
+    """Measure event loop lag and detect blocking callbacks.
+
+    A background task sleeps for `interval` seconds at a time, recording how
+    late it's woken up in a histogram.  A watchdog thread checks the task
+    progress, and if it's late by more than `slow_callback_duration`
+    seconds, the loop is blocked by a callback: the stack of the loop thread
+    is sampled and logged.
+
+    The object is a collector exposing loop lag and the number of detected
+    slow callbacks.  The `slow_callback_duration` is also applied to the
+    loop, for asyncio debug mode.
+
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.5,
+        slow_callback_duration: float = 0.1,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.interval = interval
+        self.slow_callback_duration = slow_callback_duration
+        self.logger = logger or structlog.get_logger()
+        self._lag = Histogram(
+            "exporter_event_loop_lag_seconds",
+            "Delay of event loop wake ups",
+            buckets=LAG_BUCKETS,
+            registry=None,
+        )
+        self._slow_callbacks = 0
+        self._task: asyncio.Task[None] | None = None
+        self._watchdog: threading.Thread | None = None
+        self._stopped = threading.Event()
+        # Monotonic time at which the task is expected to wake up, or None
+        # while it's running
+        self._expected_wakeup: float | None = None
+        self._loop_thread_id = 0
+
+    async def start(self, app: Application) -> None:
+        """Start monitoring the running loop."""
+        loop = asyncio.get_running_loop()
+        loop.slow_callback_duration = self.slow_callback_duration
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure_lag())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-monitor", daemon=True
+        )
+        self._watchdog.start()
+
+    async def stop(self, app: Application) -> None:
+        """Stop monitoring."""
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._watchdog:
+            await asyncio.to_thread(self._watchdog.join)
+            self._watchdog = None
+
+    def collect(self) -> Iterator[Metric]:
+        yield from self._lag.collect()
+        yield CounterMetricFamily(
+            "exporter_event_loop_slow_callbacks",
+            "Callbacks detected blocking the event loop",
+            value=self._slow_callbacks,
+        )
+
+    async def _measure_lag(self) -> None:
+        while True:
+            expected = time.monotonic() + self.interval
+            self._expected_wakeup = expected
+            await asyncio.sleep(self.interval)
+            self._expected_wakeup = None
+            self._lag.observe(max(time.monotonic() - expected, 0.0))
+
+    def _watch(self) -> None:
+        reported = None
+        while not self._stopped.wait(self.slow_callback_duration / 2):
+            expected = self._expected_wakeup
+            if expected is None or expected == reported:
+                continue
+            blocked = time.monotonic() - expected
+            if blocked < self.slow_callback_duration:
+                continue
+            # report each blocking callback once
+            reported = expected
+            self._slow_callbacks += 1
+            self.logger.warning(
+                "slow callback",
+                blocked=round(blocked, 3),
+                stack=self._loop_stack(),
+            )
+
+    def _loop_stack(self) -> str:
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return ""
+        return "".join(traceback.format_stack(frame))
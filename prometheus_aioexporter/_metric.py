@@ -1,10 +1,19 @@
 """Helpers around prometheus_client to create and register metrics."""
 
-from collections.abc import Iterable
+from abc import ABC, abstractmethod
+import asyncio
+import collections
+from collections.abc import (
+    AsyncIterator,
+    Iterable,
+    Iterator,
+    Mapping,
+)
 from dataclasses import (
     dataclass,
     field,
 )
+import threading
 import typing as t
 
 from prometheus_client import (
@@ -16,8 +25,23 @@ from prometheus_client import (
     Info,
     Summary,
 )
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.metrics_core import Metric
 from prometheus_client.registry import Collector
+import structlog
+
+from ._cardinality import (
+    FamilyCardinality,
+    SeriesBudget,
+    SeriesStats,
+    SeriesTotal,
+    TrackedMetric,
+    interned_metric_class,
+    resident_memory,
+    tracked_metric_class,
+)
+from ._shared_values import SharedValueStore
 
 
 @dataclass(frozen=True)
@@ -32,7 +56,7 @@ class MetricType:
 METRIC_TYPES: dict[str, MetricType] = {
     "counter": MetricType(cls=Counter),
     "enum": MetricType(cls=Enum, options=["states"]),
-    "gauge": MetricType(cls=Gauge),
+    "gauge": MetricType(cls=Gauge, options=["multiprocess_mode"]),
     "histogram": MetricType(cls=Histogram, options=["buckets"]),
     "info": MetricType(cls=Info),
     "summary": MetricType(cls=Summary),
@@ -48,6 +72,9 @@ class MetricConfig:
     type: str
     labels: Iterable[str] = field(default_factory=tuple)
     config: dict[str, t.Any] = field(default_factory=dict)
+    # Metrics with lower priority are shed first when over budget.  This
+    # doesn't affect the metric itself, so it's not compared.
+    priority: int = field(default=0, compare=False)
 
     def __post_init__(self) -> None:
         self.labels = tuple(sorted(self.labels))
@@ -67,47 +94,762 @@ class InvalidMetricType(Exception):
         )
 
 
+@dataclass(frozen=True)
+class MetricChanges:
+    """Changes to metrics applied when reconciling configurations."""
+
+    added: tuple[str, ...] = ()
+    updated: tuple[str, ...] = ()
+    removed: tuple[str, ...] = ()
+
+
+@dataclass(frozen=True)
+class MetricUpdate:
+    """An update to the value of a metric series.
+
+    The value is applied based on the metric type: gauges are set to it,
+    counters are incremented by it, histograms and summaries observe it,
+    enums are set to it as state, and infos are set to it as a mapping.
+
+    """
+
+    name: str
+    value: t.Any
+    labels: Mapping[str, str] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class MetricRemoval:
+    """Removal of a metric series.
+
+    If `labels` is None, all series for the metric are removed.
+
+    """
+
+    name: str
+    labels: Mapping[str, str] | None = None
+
+
+# Changes for metrics series
+MetricDelta = MetricUpdate | MetricRemoval
+
+# Metric types for which only the last update to a series is applied
+_LAST_VALUE_TYPES = frozenset(("enum", "gauge", "info"))
+
+# Map metric types to the method applying a value
+_UPDATE_METHODS = {
+    "counter": "inc",
+    "gauge": "set",
+    "histogram": "observe",
+    "info": "info",
+    "stateset": "state",
+    "summary": "observe",
+}
+
+
+class AsyncCollector(ABC):
+    """A collector for metrics that require asynchronous operations.
+
+    Subclasses implement `collect()` as an async generator of metric
+    families, which must complete within `timeout` seconds.
+
+    """
+
+    timeout: float = 10.0
+
+    @abstractmethod
+    def collect(self) -> AsyncIterator[Metric]:
+        """Yield metric families."""
+
+
+class _AsyncCollectorsResults(Collector):
+    """Collector for metrics last collected from async collectors."""
+
+    def __init__(self) -> None:
+        self.families: list[Metric] = []
+
+    def collect(self) -> Iterable[Metric]:
+        return self.families
+
+
+async def _collect_families(collector: AsyncCollector) -> list[Metric]:
+    async with asyncio.timeout(collector.timeout):
+        return [family async for family in collector.collect()]
+
+
+# Metric types whose values can be stored in a SharedValueStore
+_SHARED_VALUE_TYPES = frozenset(("counter", "gauge", "histogram", "summary"))
+
+
+class _SharedValuesCollector(Collector):
+    """Collector for metrics with values from a shared store."""
+
+    def __init__(self, registry: "MetricsRegistry") -> None:
+        self.registry = registry
+
+    def collect(self) -> Iterable[Metric]:
+        assert self.registry.value_store is not None
+        configs = self.registry._configs
+        return [
+            metric
+            for metric in self.registry.value_store.read_metrics(configs)
+            # skip values from metrics with a different type
+            if configs[metric.name].type == metric.type
+        ]
+
+
+class _SeriesBudgetCollector(Collector):
+    """Collector for usage of the series budget."""
+
+    def __init__(self, registry: "MetricsRegistry") -> None:
+        self.registry = registry
+
+    def collect(self) -> Iterable[Metric]:
+        registry = self.registry
+        budget = registry.series_budget
+        assert budget is not None
+        series = GaugeMetricFamily(
+            "exporter_budget_series",
+            "Number of series in metrics",
+            value=registry._series_total.series,
+        )
+        series_limit = GaugeMetricFamily(
+            "exporter_budget_series_limit",
+            "Limits for the number of series in metrics",
+            labels=["limit"],
+        )
+        memory = GaugeMetricFamily(
+            "exporter_budget_memory_bytes",
+            "Resident memory size at the last budget check",
+            value=registry._memory,
+        )
+        memory_limit = GaugeMetricFamily(
+            "exporter_budget_memory_limit_bytes",
+            "Limits for resident memory size",
+            labels=["limit"],
+        )
+        for family, limit, value in (
+            (series_limit, "soft", budget.soft_max_series),
+            (series_limit, "hard", budget.max_series),
+            (memory_limit, "soft", budget.soft_max_memory),
+            (memory_limit, "hard", budget.max_memory),
+        ):
+            if value:
+                family.add_metric([limit], value)
+        shed = GaugeMetricFamily(
+            "exporter_budget_shed_metrics",
+            "Number of metrics currently shed",
+            value=len(registry._shed),
+        )
+        refused = CounterMetricFamily(
+            "exporter_budget_refused_series",
+            "Number of new series refused",
+            value=registry._refused_series,
+        )
+        return [series, series_limit, memory, memory_limit, shed, refused]
+
+
+class _UpdateQueueCollector(Collector):
+    """Collector for usage of the updates queue."""
+
+    def __init__(self, registry: "MetricsRegistry") -> None:
+        self.registry = registry
+
+    def collect(self) -> Iterable[Metric]:
+        pending = GaugeMetricFamily(
+            "exporter_update_queue_pending",
+            "Number of queued metric updates not yet applied",
+            value=len(self.registry._queue),
+        )
+        dropped = CounterMetricFamily(
+            "exporter_update_queue_dropped",
+            "Number of metric updates dropped because the queue was full",
+            value=self.registry._dropped_updates,
+        )
+        return [pending, dropped]
+
+
+class _GenerationCollector(Collector):
+    """Collector for the published generation of metrics."""
+
+    def __init__(self, registry: "MetricsRegistry") -> None:
+        self.registry = registry
+
+    def collect(self) -> Iterable[Metric]:
+        # the generation is replaced, not modified, when a new one is
+        # published
+        metrics = list(self.registry._metrics.values())
+        for metric in metrics:
+            yield from metric.collect()
+
+
+class _Generation(dict[str, MetricWrapperBase]):
+    """A generation of metrics for a double-buffered registry."""
+
+    def __init__(self, serial: int) -> None:
+        super().__init__()
+        self.serial = serial
+        self.series_total = SeriesTotal()
+
+
 class MetricsRegistry:
-    """A registry for metrics."""
+    """A registry for metrics.
+
+    If `lazy` is True, metrics are only instantiated and registered when
+    they're first accessed, so unused metrics are not included in the output.
+
+    If a `value_store` is passed, it's used for values of
+    counters, gauges, histograms and summaries, so that metrics include
+    values from all processes using the same store.
+
+    If `double_buffered` is True, metrics are filled in a new generation
+    (see `start_generation()`) while the previous one is exported, and
+    published at once (see `publish_generation()`).  This can't be combined
+    with `lazy` or `value_store`.
+
+    If `track_series` is True, the number of series for each metric, and
+    for each label value, is tracked as series are added and removed (see
+    `cardinality()`), and can be limited with a `SeriesBudget` (see
+    `set_series_budget()`).  It must be set before metrics are created.
+
+    At most `update_queue_size` deltas (0 for no limit) can be queued with
+    `queue_updates()`.
+
+    """
 
     registry: CollectorRegistry
+    lazy: bool
+    value_store: SharedValueStore | None
+    double_buffered: bool
+    update_queue_size: int
+    track_series: bool
+    series_budget: SeriesBudget | None = None
 
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        lazy: bool = False,
+        value_store: SharedValueStore | None = None,
+        double_buffered: bool = False,
+        update_queue_size: int = 100000,
+        track_series: bool = False,
+    ) -> None:
+        if double_buffered and (lazy or value_store):
+            raise ValueError(
+                "Double buffering is not supported for lazy metrics or "
+                "shared values"
+            )
         self.registry = CollectorRegistry(auto_describe=True)
+        self.lazy = lazy
+        self.value_store = value_store
+        self.double_buffered = double_buffered
+        self.update_queue_size = update_queue_size
+        self.track_series = track_series
+        self._configs: dict[str, MetricConfig] = {}
+        # the published generation of metrics, if double-buffered
         self._metrics: dict[str, MetricWrapperBase] = {}
+        # serials of the last started and published generations, and the
+        # previously published one, which is recycled for the next one
+        self._generations = 0
+        self._published_generation = 0
+        self._spare: dict[str, MetricWrapperBase] = {}
+        self._queue: collections.deque[MetricDelta] = collections.deque()
+        self._queue_lock = threading.Lock()
+        self._queue_collector: _UpdateQueueCollector | None = None
+        self._dropped_updates = 0
+        self._async_collectors: list[AsyncCollector] = []
+        self._async_results = _AsyncCollectorsResults()
+        self.registry.register(self._async_results)
+        # metrics shed to fit the series budget, with their stats, and the
+        # number of series and estimated size at the time they were shed
+        self._shed: dict[str, tuple[SeriesStats, int, int]] = {}
+        self._refused_series = 0
+        # total series for published metrics
+        self._series_total = SeriesTotal()
+        self._memory = 0
+        self._memory_exceeded = False
+        if value_store:
+            self.registry.register(_SharedValuesCollector(self))
+        if double_buffered:
+            self.registry.register(_GenerationCollector(self))
 
     def create_metrics(
         self, configs: Iterable[MetricConfig]
-    ) -> dict[str, MetricWrapperBase]:
+    ) -> Mapping[str, MetricWrapperBase]:
         """Create Prometheus metrics from a list of MetricConfigs."""
-        metrics: dict[str, MetricWrapperBase] = {
-            config.name: self._register_metric(config) for config in configs
-        }
-        self._metrics.update(metrics)
-        return metrics
+        names = []
+        for config in configs:
+            if not self.lazy:
+                self._metrics[config.name] = self._register_metric(config)
+            self._configs[config.name] = config
+            names.append(config.name)
+        if self.lazy:
+            return LazyMetrics(self, names)
+        return {name: self._metrics[name] for name in names}
+
+    def reconcile_metrics(
+        self,
+        configs: Iterable[MetricConfig],
+        managed: Iterable[str] | None = None,
+    ) -> MetricChanges:
+        """Reconcile metrics with a new list of MetricConfigs.
+
+        Metrics whose configuration hasn't changed are kept along with their
+        values, new metrics are created and ones with a different
+        configuration are replaced.  Existing metrics that are not in
+        `configs` are removed; if `managed` is specified, only metrics with
+        those names are considered for removal.
+
+        Changes are applied synchronously, so scrapes see either the old or
+        the new set of metrics.  If registering a metric fails, previous
+        metrics are restored.
+
+        """
+        new_configs = {config.name: config for config in configs}
+        candidates = self._configs.keys()
+        if managed is not None:
+            candidates = candidates & set(managed)
+        removed = sorted(
+            name for name in candidates if name not in new_configs
+        )
+        added = []
+        updated = []
+        for name, config in new_configs.items():
+            if name not in self._configs:
+                added.append(name)
+            elif self._configs[name] != config:
+                updated.append(name)
+
+        old_metrics: dict[str, MetricWrapperBase] = {}
+        for name in removed + updated:
+            if (metric := self._metrics.pop(name, None)) is not None:
+                self._unregister_metric(metric)
+                if self.track_series:
+                    _series_stats(metric).set_total(None)
+                old_metrics[name] = metric
+        new_metrics: dict[str, MetricWrapperBase] = {}
+        try:
+            if not self.lazy:
+                for name in updated + added:
+                    new_metrics[name] = self._register_metric(
+                        new_configs[name]
+                    )
+        except Exception:
+            for metric in new_metrics.values():
+                self._unregister_metric(metric)
+            for metric in old_metrics.values():
+                if self._is_registered(_metric_type(metric)):
+                    self.registry.register(metric)
+                if self.track_series:
+                    _series_stats(metric).set_total(self._series_total)
+            self._metrics.update(old_metrics)
+            raise
+
+        for name in removed:
+            del self._configs[name]
+        for name in removed + updated:
+            self._spare.pop(name, None)
+        # unchanged metrics might still have a different priority
+        self._configs.update(new_configs)
+        self._metrics.update(new_metrics)
+        return MetricChanges(
+            added=tuple(added), updated=tuple(updated), removed=tuple(removed)
+        )
 
     def get_metric(
         self, name: str, labels: dict[str, str] | None = None
     ) -> MetricWrapperBase:
         """Return a metric, optionally configured with labels."""
-        metric = self._metrics[name]
+        metric = self._get_or_register_metric(name)
         if labels:
             return metric.labels(**labels)
 
         return metric
 
-    def get_metrics(self) -> dict[str, MetricWrapperBase]:
-        """Return a dict mapping names to metrics."""
+    def get_metrics(self) -> Mapping[str, MetricWrapperBase]:
+        """Return a mapping of names to metrics.
+
+        For lazy registries, metrics are instantiated when accessed through
+        the mapping.
+
+        """
+        if self.lazy:
+            return LazyMetrics(self, self._configs)
         return self._metrics.copy()
 
-    def register_additional_collector(self, collector: Collector) -> None:
+    def start_generation(self) -> Mapping[str, MetricWrapperBase]:
+        """Return a new generation of metrics to fill, for double buffering.
+
+        Metrics in the generation have no series, and are not exported until
+        the generation is passed to `publish_generation()`.  Metric objects
+        from the generation published before the current one are reused.
+        Multiple generations can be filled at the same time.
+
+        """
+        if not self.double_buffered:
+            raise ValueError("Registry is not double-buffered")
+        spare, self._spare = self._spare, {}
+        self._generations += 1
+        generation = _Generation(self._generations)
+        for name, config in self._configs.items():
+            metric = spare.get(name)
+            if metric is not None and metric._labelnames:
+                metric.clear()
+            else:
+                metric = self._register_metric(config)
+            generation[name] = metric
+            if self.track_series:
+                self._track_generation_series(
+                    name, _series_stats(metric), generation
+                )
+        return generation
+
+    def publish_generation(
+        self, generation: Mapping[str, MetricWrapperBase]
+    ) -> bool:
+        """Publish a generation returned by `start_generation()`.
+
+        Metrics from the new generation replace all current ones at once,
+        so scrapes see either generation fully.  If a generation started
+        later has already been published, the generation is discarded and
+        False is returned.
+
+        """
+        if not isinstance(generation, _Generation):
+            raise ValueError("Not a generation of metrics")
+        if generation.serial <= self._published_generation:
+            return False
+        self._published_generation = generation.serial
+        self._spare, self._metrics = self._metrics, generation
+        self._series_total = generation.series_total
+        return True
+
+    def apply_updates(
+        self,
+        deltas: Iterable[MetricDelta],
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> set[str]:
+        """Apply updates and removals to metric series.
+
+        Names of metrics changed by these deltas are returned.  Deltas that
+        fail (e.g. for unknown metrics, or with labels not matching the
+        metric ones) are logged and skipped.  Updates are not supported for
+        double-buffered registries, since the next generation would discard
+        them.
+
+        """
+        self._check_not_double_buffered()
+        return self._apply_deltas(deltas, logger)
+
+    def queue_updates(self, deltas: Iterable[MetricDelta]) -> None:
+        """Queue updates and removals to be applied later.
+
+        This can be called from any thread or task.  Queued deltas are
+        applied in order by `apply_queued_updates()`.  If the queue already
+        contains `update_queue_size` deltas, new ones are dropped.  As with
+        `apply_updates()`, this is not supported for double-buffered
+        registries.
+
+        Queue usage is included in metrics once updates are queued.
+
+        """
+        self._check_not_double_buffered()
+        deltas = list(deltas)
+        with self._queue_lock:
+            if not self._queue_collector:
+                self._queue_collector = _UpdateQueueCollector(self)
+                self.registry.register(self._queue_collector)
+            if self.update_queue_size:
+                room = max(self.update_queue_size - len(self._queue), 0)
+                self._dropped_updates += max(len(deltas) - room, 0)
+                deltas = deltas[:room]
+            self._queue.extend(deltas)
+
+    def apply_queued_updates(
+        self, logger: structlog.stdlib.BoundLogger | None = None
+    ) -> int:
+        """Apply queued updates and removals, returning their number.
+
+        Updates to the same series are coalesced before being applied:
+        increments to counters are summed, and only the last value is set
+        for gauges, enums and infos.  Deltas that fail are logged and
+        skipped.
+
+        """
+        queue = self._queue
+        deltas = [queue.popleft() for _ in range(len(queue))]
+        if not deltas:
+            return 0
+        self._apply_deltas(_coalesce_deltas(deltas, self._configs), logger)
+        return len(deltas)
+
+    def cardinality(self, top: int = 10) -> list[FamilyCardinality]:
+        """Return cardinality of instantiated metrics, largest first.
+
+        For each label, the `top` values with most series are included.
+        Growth is relative to the previous call.
+
+        """
+        self._check_series_tracked()
+        families = [
+            _series_stats(metric).report(name, _metric_type(metric), top)
+            for name, metric in self._metrics.items()
+        ]
+        return sorted(
+            families, key=lambda family: (-family.series, family.name)
+        )
+
+    def set_series_budget(self, budget: SeriesBudget) -> None:
+        """Limit the number of series and memory used by metrics.
+
+        Hard limits are enforced when new series are created, by refusing
+        them.  Values for refused series are discarded.  Soft limits, and
+        memory usage, are checked by `enforce_series_budget()`.
+
+        Budget usage is included in metrics.
+
+        """
+        self._check_series_tracked()
+        self.series_budget = budget
+        for metric in self._metrics.values():
+            _series_stats(metric).guard = self._admit_series
+        self.registry.register(_SeriesBudgetCollector(self))
+
+    def enforce_series_budget(
+        self, logger: structlog.stdlib.BoundLogger | None = None
+    ) -> None:
+        """Shed or restore metrics based on the series budget soft limits.
+
+        If soft limits are exceeded, series for metrics with lowest
+        priority, and most series, are removed until usage is expected to
+        be within limits, and new series for those metrics are refused.
+        Shed metrics are restored once they're expected to fit within soft
+        limits again.
+
+        """
+        budget = self.series_budget
+        if budget is None:
+            return
+        logger = logger or structlog.get_logger()
+        if budget.memory_limited:
+            self._memory = resident_memory()
+        self._memory_exceeded = bool(
+            budget.max_memory and self._memory >= budget.max_memory
+        )
+        series = self._series_total.series
+        excess_series = (
+            series - budget.soft_max_series if budget.soft_max_series else 0
+        )
+        excess_memory = (
+            self._memory - budget.soft_max_memory
+            if budget.soft_max_memory
+            else 0
+        )
+        # forget metrics that have been replaced or removed
+        for name, (stats, _, _) in list(self._shed.items()):
+            metric = self._metrics.get(name)
+            if metric is None or _series_stats(metric) is not stats:
+                del self._shed[name]
+        if excess_series > 0 or excess_memory > 0:
+            self._shed_metrics(excess_series, excess_memory, logger)
+        else:
+            self._restore_metrics(-excess_series, -excess_memory, logger)
+
+    def register_additional_collector(
+        self, collector: Collector | AsyncCollector
+    ) -> None:
         """Register an additional collector or metric.
 
         Metric(s) for the collector will not be included in the result of
         get_metrics.
 
+        Metrics from `AsyncCollector`s are only included after
+        `collect_async()` is called.
+
+        """
+        if isinstance(collector, AsyncCollector):
+            self._async_collectors.append(collector)
+        else:
+            self.registry.register(collector)
+
+    async def collect_async(
+        self, logger: structlog.stdlib.BoundLogger | None = None
+    ) -> None:
+        """Collect metrics from async collectors, concurrently.
+
+        Collected metrics are included in the registry output until the next
+        call.  Metrics for collectors that fail or time out are omitted.
+
+        """
+        results = await asyncio.gather(
+            *(
+                _collect_families(collector)
+                for collector in self._async_collectors
+            ),
+            return_exceptions=True,
+        )
+        families = []
+        for collector, result in zip(
+            self._async_collectors, results, strict=True
+        ):
+            if isinstance(result, BaseException):
+                (logger or structlog.get_logger()).warning(
+                    "async collector failed",
+                    collector=type(collector).__name__,
+                    error=str(result) or type(result).__name__,
+                )
+            else:
+                families.extend(result)
+        self._async_results.families = families
+
+    def _check_not_double_buffered(self) -> None:
+        if self.double_buffered:
+            raise ValueError(
+                "Updates are not supported for double-buffered registries"
+            )
+
+    def _check_series_tracked(self) -> None:
+        if not self.track_series:
+            raise ValueError("Series tracking is not enabled")
+
+    def _track_generation_series(
+        self, name: str, stats: SeriesStats, generation: _Generation
+    ) -> None:
+        # series in the generation are limited separately from the
+        # published ones
+        stats.set_total(generation.series_total)
+        # shed metrics stay blocked in the new generation
+        stats.blocked = name in self._shed
+        if stats.blocked:
+            _, series, size = self._shed[name]
+            self._shed[name] = (stats, series, size)
+
+    def _admit_series(self, stats: SeriesStats) -> bool:
+        budget = self.series_budget
+        assert budget is not None
+        if (
+            stats.blocked
+            or self._memory_exceeded
+            or (
+                budget.max_series
+                and stats.total is not None
+                and stats.total.series >= budget.max_series
+            )
+        ):
+            self._refused_series += 1
+            return False
+        return True
+
+    def _shed_metrics(
+        self,
+        excess_series: int,
+        excess_memory: int,
+        logger: structlog.stdlib.BoundLogger,
+    ) -> None:
+        candidates = sorted(
+            (
+                (name, metric)
+                for name, metric in self._metrics.items()
+                if metric._labelnames and not _series_stats(metric).blocked
+            ),
+            key=lambda item: (
+                self._configs[item[0]].priority,
+                -_series_stats(item[1]).series,
+            ),
+        )
+        shed = []
+        for name, metric in candidates:
+            if excess_series <= 0 and excess_memory <= 0:
+                break
+            stats = _series_stats(metric)
+            series, size = stats.series, stats.estimated_bytes
+            stats.blocked = True
+            metric.clear()
+            self._shed[name] = (stats, series, size)
+            excess_series -= series
+            excess_memory -= size
+            shed.append(name)
+        logger.warning(
+            "series budget exceeded",
+            series=self._series_total.series,
+            memory=self._memory,
+            shed=shed,
+        )
+
+    def _restore_metrics(
+        self,
+        series_room: int,
+        memory_room: int,
+        logger: structlog.stdlib.BoundLogger,
+    ) -> None:
+        budget = self.series_budget
+        assert budget is not None
+        restored = []
+        for name in sorted(
+            self._shed,
+            key=lambda name: -self._configs[name].priority,
+        ):
+            stats, series, size = self._shed[name]
+            if (budget.soft_max_series and series > series_room) or (
+                budget.soft_max_memory and size > memory_room
+            ):
+                continue
+            stats.blocked = False
+            del self._shed[name]
+            series_room -= series
+            memory_room -= size
+            restored.append(name)
+        if restored:
+            logger.info("shed metrics restored", restored=restored)
+
+    def _apply_deltas(
+        self,
+        deltas: Iterable[MetricDelta],
+        logger: structlog.stdlib.BoundLogger | None,
+    ) -> set[str]:
+        """Apply deltas, logging failed ones.
+
+        Return names of changed metrics.
+
         """
-        self.registry.register(collector)
+        changed = set()
+        for delta in deltas:
+            try:
+                if self._apply_delta(delta):
+                    changed.add(delta.name)
+            except Exception as e:
+                (logger or structlog.get_logger()).warning(
+                    "metric update failed",
+                    metric=delta.name,
+                    error=str(e) or type(e).__name__,
+                )
+        return changed
+
+    def _apply_delta(self, delta: MetricDelta) -> bool:
+        """Apply an update or removal, returning whether it changed series."""
+        metric = self._get_or_register_metric(delta.name)
+        if isinstance(delta, MetricRemoval) and delta.labels is None:
+            metric.clear()
+            return True
+        label_values = _label_values(metric, delta.labels or {})
+        if isinstance(delta, MetricRemoval):
+            if not label_values:
+                raise ValueError(
+                    "Metric has no labels, series can't be removed"
+                )
+            if label_values not in metric._metrics:
+                return False
+            metric.remove(*label_values)
+        else:
+            series = metric.labels(*label_values) if label_values else metric
+            getattr(series, _UPDATE_METHODS[_metric_type(metric)])(delta.value)
+        return True
+
+    def _get_or_register_metric(self, name: str) -> MetricWrapperBase:
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._register_metric(self._configs[name])
+            self._metrics[name] = metric
+        return metric
 
     def _register_metric(self, config: MetricConfig) -> MetricWrapperBase:
         metric_type = METRIC_TYPES[config.type]
@@ -116,10 +858,133 @@ class MetricsRegistry:
             for key, value in config.config.items()
             if key in metric_type.options
         }
-        return metric_type.cls(
+        # metrics with shared values are collected from the store, and
+        # double-buffered ones by generation
+        registry = self.registry if self._is_registered(config.type) else None
+        cls = metric_type.cls
+        if self.track_series:
+            cls = tracked_metric_class(cls)
+        else:
+            cls = interned_metric_class(cls)
+        if self._has_shared_values(config.type):
+            assert self.value_store is not None
+            cls = self.value_store.metric_class(cls)
+        metric = cls(
             config.name,
             config.description,
             labelnames=config.labels,
-            registry=self.registry,
+            registry=registry,
             **options,
         )
+        if self.track_series:
+            stats = _series_stats(metric)
+            stats.set_total(self._series_total)
+            if self.series_budget:
+                stats.guard = self._admit_series
+        return metric
+
+    def _unregister_metric(self, metric: MetricWrapperBase) -> None:
+        if self._is_registered(_metric_type(metric)):
+            self.registry.unregister(metric)
+
+    def _is_registered(self, metric_type: str) -> bool:
+        """Whether metrics of a type are registered individually."""
+        return not (
+            self.double_buffered or self._has_shared_values(metric_type)
+        )
+
+    def _has_shared_values(self, metric_type: str) -> bool:
+        return bool(self.value_store) and metric_type in _SHARED_VALUE_TYPES
+
+
+def _label_values(
+    metric: MetricWrapperBase, labels: Mapping[str, str]
+) -> tuple[str, ...]:
+    """Return values for metric labels, checking that names match."""
+    if set(labels) != set(metric._labelnames):
+        names = ", ".join(sorted(labels)) or "none"
+        expected = ", ".join(metric._labelnames) or "none"
+        raise ValueError(
+            f"Incorrect label names: {names} (expected {expected})"
+        )
+    return tuple(str(labels[name]) for name in metric._labelnames)
+
+
+def _coalesce_deltas(
+    deltas: Iterable[MetricDelta], configs: Mapping[str, MetricConfig]
+) -> list[MetricDelta]:
+    """Merge updates to the same series, preserving order with removals."""
+    result: list[MetricDelta] = []
+    # index in the result of the last update for each series, reset when
+    # series are removed
+    last_updates: dict[tuple[t.Any, ...], int] = {}
+    for delta in deltas:
+        config = configs.get(delta.name)
+        if isinstance(delta, MetricRemoval):
+            if delta.labels is None:
+                last_updates = {
+                    key: index
+                    for key, index in last_updates.items()
+                    if key[0] != delta.name
+                }
+            else:
+                last_updates.pop(_series_key(delta.name, delta.labels), None)
+        elif config is not None and (
+            config.type == "counter" or config.type in _LAST_VALUE_TYPES
+        ):
+            key = _series_key(delta.name, delta.labels)
+            index = last_updates.get(key)
+            if index is not None:
+                if config.type == "counter":
+                    previous = result[index]
+                    assert isinstance(previous, MetricUpdate)
+                    delta = MetricUpdate(
+                        delta.name, previous.value + delta.value, delta.labels
+                    )
+                result[index] = delta
+                continue
+            last_updates[key] = len(result)
+        result.append(delta)
+    return result
+
+
+def _series_key(name: str, labels: Mapping[str, t.Any]) -> tuple[t.Any, ...]:
+    return (
+        name,
+        *sorted((label, str(value)) for label, value in labels.items()),
+    )
+
+
+def _metric_type(metric: MetricWrapperBase) -> str:
+    """Return the type of a metric, which is always set for its class."""
+    return t.cast(str, metric._type)
+
+
+def _series_stats(metric: MetricWrapperBase) -> SeriesStats:
+    return t.cast(TrackedMetric, metric).series_stats
+
+
+class LazyMetrics(Mapping[str, MetricWrapperBase]):
+    """Mapping of metrics from a lazy registry.
+
+    Metrics are instantiated and registered on first access.
+
+    """
+
+    def __init__(self, registry: MetricsRegistry, names: Iterable[str]):
+        self._registry = registry
+        self._names = dict.fromkeys(names)
+
+    def __getitem__(self, name: str) -> MetricWrapperBase:
+        if name not in self._names:
+            raise KeyError(name)
+        return self._registry._get_or_register_metric(name)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._names
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
@@ -0,0 +1,331 @@
+"""Probe multiple targets, with metrics in per-target registries."""
+
+import asyncio
+from collections import Counter, OrderedDict
+from collections.abc import (
+    AsyncGenerator,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    Iterator,
+    Mapping,
+)
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+import time
+import typing as t
+
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.web import (
+    AppKey,
+    Application,
+    HTTPBadRequest,
+    Request,
+    StreamResponse,
+)
+from prometheus_client import Gauge
+from prometheus_client.aiohttp import make_aiohttp_handler
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    Metric,
+)
+from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.registry import Collector
+import structlog
+
+from ._metric import MetricConfig, MetricsRegistry
+
+# Signature for probe handlers
+ProbeHandler = Callable[
+    [str, Mapping[str, MetricWrapperBase], ClientSession], Awaitable[None]
+]
+
+# The application key to get the shared client session.
+CLIENT_SESSION_APP_KEY: AppKey[ClientSession] = AppKey("client_session")
+
+# Metrics included in every probe result
+PROBE_METRIC_CONFIGS = (
+    MetricConfig("probe_success", "Whether the probe succeeded", "gauge"),
+    MetricConfig(
+        "probe_duration_seconds", "Duration of the probe in seconds", "gauge"
+    ),
+)
+
+
+@dataclass
+class _TargetSlot:
+    """Concurrency limit for a target, with the number of its users.
+
+    Users include probes waiting for the semaphore, while `running` only
+    counts the ones holding it.
+
+    """
+
+    semaphore: asyncio.Semaphore
+    users: int = 0
+    running: int = 0
+
+
+@dataclass
+class _CacheEntry:
+    """A cached registry, with its number of series and expiry time."""
+
+    registry: MetricsRegistry
+    series: int
+    expiry: float
+
+
+class RegistryCache(Collector):
+    """LRU cache of per-target registries.
+
+    Registries are evicted when unused for `ttl` seconds, when more than
+    `max_size` are cached, or when the total number of series in cached
+    registries exceeds `max_series` (if set).
+
+    The cache is a collector exposing its size, hits and evictions.
+
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 300.0,
+        max_series: int | None = None,
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_series = max_series
+        self._entries: OrderedDict[str, _CacheEntry] = OrderedDict()
+        self._series = 0
+        self._requests: Counter[str] = Counter(hit=0, miss=0)
+        self._evictions: Counter[str] = Counter(expired=0, size=0, series=0)
+
+    @property
+    def size(self) -> int:
+        """Number of cached registries."""
+        return len(self._entries)
+
+    @property
+    def series(self) -> int:
+        """Total number of series in cached registries."""
+        return self._series
+
+    def get(self, target: str) -> MetricsRegistry | None:
+        """Return the cached registry for a target, if any."""
+        self._expire()
+        entry = self._entries.get(target)
+        if entry is None:
+            self._requests["miss"] += 1
+            return None
+        self._requests["hit"] += 1
+        self._entries.move_to_end(target)
+        entry.expiry = time.monotonic() + self.ttl
+        return entry.registry
+
+    def put(self, target: str, registry: MetricsRegistry) -> None:
+        """Cache the registry for a target, evicting others if needed."""
+        if entry := self._entries.pop(target, None):
+            self._series -= entry.series
+        series = _series_count(registry)
+        self._entries[target] = _CacheEntry(
+            registry, series, time.monotonic() + self.ttl
+        )
+        self._series += series
+        self._expire()
+        while len(self._entries) > self.max_size:
+            self._evict_oldest("size")
+        while self.max_series is not None and self._series > self.max_series:
+            self._evict_oldest("series")
+
+    def collect(self) -> Iterator[Metric]:
+        yield GaugeMetricFamily(
+            "exporter_probe_cache_registries",
+            "Number of cached probe registries",
+            value=len(self._entries),
+        )
+        yield GaugeMetricFamily(
+            "exporter_probe_cache_series",
+            "Number of series in cached probe registries",
+            value=self._series,
+        )
+        requests = CounterMetricFamily(
+            "exporter_probe_cache_requests",
+            "Lookups in the probe registries cache",
+            labels=["result"],
+        )
+        for result, count in self._requests.items():
+            requests.add_metric([result], count)
+        yield requests
+        evictions = CounterMetricFamily(
+            "exporter_probe_cache_evictions",
+            "Registries evicted from the probe registries cache",
+            labels=["reason"],
+        )
+        for reason, count in self._evictions.items():
+            evictions.add_metric([reason], count)
+        yield evictions
+
+    def _expire(self) -> None:
+        # entries are in order of use, hence of expiry
+        now = time.monotonic()
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expiry > now:
+                break
+            self._evict_oldest("expired")
+
+    def _evict_oldest(self, reason: str) -> None:
+        _, entry = self._entries.popitem(last=False)
+        self._series -= entry.series
+        self._evictions[reason] += 1
+
+
+class Prober:
+    """Probe targets, collecting metrics in a registry for each target.
+
+    The probe handler is called for each request with the target, a mapping
+    of metric names to metrics (built from `metric_configs`), and a client
+    session shared across probes.  The signature is the following:
+
+      async def probe_handler(
+          target: str,
+          metrics: Mapping[str, MetricWrapperBase],
+          session: ClientSession,
+      ) -> None:
+
+    Probes are limited to `max_concurrency` overall and
+    `max_target_concurrency` for each target, and time out after `timeout`
+    seconds.  Metrics for a probe include `probe_success` and
+    `probe_duration_seconds`.
+
+    If a `cache` is provided, registries are reused across probes for the
+    same target, so metric objects are only created once and only values are
+    updated by the probe handler.  Series of labelled metrics are removed
+    before each probe, so only the ones set by the last probe are exported.
+    Since that would affect other probes of the target, the cache is
+    bypassed while another probe of the same target is running.
+
+    """
+
+    def __init__(
+        self,
+        metric_configs: Iterable[MetricConfig],
+        handler: ProbeHandler,
+        max_concurrency: int = 100,
+        max_target_concurrency: int = 1,
+        timeout: float = 10.0,
+        cache: RegistryCache | None = None,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.metric_configs = [*PROBE_METRIC_CONFIGS, *metric_configs]
+        self.handler = handler
+        self.max_concurrency = max_concurrency
+        self.max_target_concurrency = max_target_concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self.logger = logger or structlog.get_logger()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._target_slots: dict[str, _TargetSlot] = {}
+
+    def setup(self, app: Application, path: str) -> None:
+        """Setup probes in the application, exposed at the specified path."""
+        app.router.add_get(path, self.handle_probe)
+        app.cleanup_ctx.append(self._client_session)
+
+    async def handle_probe(self, request: Request) -> StreamResponse:
+        """Request handler for probes."""
+        target = request.query.get("target")
+        if not target:
+            raise HTTPBadRequest(text="Missing 'target' parameter")
+        registry = await self.probe(
+            target, request.app[CLIENT_SESSION_APP_KEY]
+        )
+        handler = make_aiohttp_handler(registry.registry)
+        return await handler(request)
+
+    async def probe(
+        self, target: str, session: ClientSession
+    ) -> MetricsRegistry:
+        """Probe a target, returning the registry with its metrics."""
+        async with self._target_slot(target) as slot, self._semaphore:
+            # a cached registry is cleared below, so it can't be shared with
+            # other running probes
+            registry = self.target_registry(target, cached=slot.running == 1)
+            metrics = registry.get_metrics()
+            # drop series from the previous probe of a cached registry
+            for metric in metrics.values():
+                if metric._labelnames:
+                    metric.clear()
+            start = time.perf_counter()
+            success = False
+            try:
+                async with asyncio.timeout(self.timeout):
+                    await self.handler(target, metrics, session)
+                success = True
+            except Exception as e:
+                self.logger.warning(
+                    "probe failed",
+                    target=target,
+                    error=str(e) or type(e).__name__,
+                )
+            duration = time.perf_counter() - start
+        t.cast(Gauge, metrics["probe_success"]).set(int(success))
+        t.cast(Gauge, metrics["probe_duration_seconds"]).set(duration)
+        if self.cache is not None:
+            self.cache.put(target, registry)
+        return registry
+
+    def target_registry(
+        self, target: str, cached: bool = True
+    ) -> MetricsRegistry:
+        """Return a registry for probing a target.
+
+        If `cached` is false, a new registry is returned even if one is
+        cached for the target.
+
+        """
+        if (
+            cached
+            and self.cache is not None
+            and (registry := self.cache.get(target))
+        ):
+            return registry
+        registry = MetricsRegistry()
+        registry.create_metrics(self.metric_configs)
+        return registry
+
+    async def _client_session(self, app: Application) -> AsyncIterator[None]:
+        connector = TCPConnector(limit=self.max_concurrency)
+        async with ClientSession(connector=connector) as session:
+            app[CLIENT_SESSION_APP_KEY] = session
+            yield
+
+    @asynccontextmanager
+    async def _target_slot(self, target: str) -> AsyncGenerator[_TargetSlot]:
+        slot = self._target_slots.get(target)
+        if slot is None:
+            slot = self._target_slots[target] = _TargetSlot(
+                asyncio.Semaphore(self.max_target_concurrency)
+            )
+        slot.users += 1
+        try:
+            async with slot.semaphore:
+                slot.running += 1
+                try:
+                    yield slot
+                finally:
+                    slot.running -= 1
+        finally:
+            slot.users -= 1
+            if not slot.users:
+                del self._target_slots[target]
+
+
+def _series_count(registry: MetricsRegistry) -> int:
+    """Return the number of series for metrics in a registry."""
+    return sum(
+        len(metric._metrics) if metric._labelnames else 1
+        for metric in registry.get_metrics().values()
+    )
@@ -0,0 +1,162 @@
+"""Push metrics to a Pushgateway."""
+
+import asyncio
+import base64
+from collections.abc import Mapping
+import gzip
+import random
+import typing as t
+from urllib.parse import quote
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from aiohttp.web import Application
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+import structlog
+
+from ._web import PrometheusExporter
+
+
+class PushError(Exception):
+    """Raised when pushing metrics fails."""
+
+    def __init__(self, url: str, details: str):
+        self.url = url
+        self.details = details
+        super().__init__(f"Push to {url} failed: {details}")
+
+
+async def retry_with_backoff(
+    call: t.Callable[[], t.Awaitable[None]],
+    retries: int,
+    backoff: float,
+    max_backoff: float = 30.0,
+    retry_on: tuple[type[Exception], ...] = (Exception,),
+) -> None:
+    """Call a coroutine function, retrying with exponential backoff.
+
+    Delays between attempts double at each retry, up to `max_backoff`, with
+    random jitter.
+
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await call()
+        except retry_on:
+            if attempt == retries:
+                raise
+        delay = min(backoff * 2**attempt, max_backoff)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def pushgateway_url(
+    url: str, job: str, grouping: Mapping[str, str] | None = None
+) -> str:
+    """Return the Pushgateway URL for a job and grouping key."""
+    parts = [url.rstrip("/"), "metrics"]
+    for label, value in {"job": job, **(grouping or {})}.items():
+        if not value or "/" in value:
+            # base64 encoding is required for these values
+            encoded = base64.urlsafe_b64encode(value.encode()).decode()
+            parts.extend((f"{label}@base64", encoded or "="))
+        else:
+            parts.extend((label, quote(value, safe="")))
+    return "/".join(parts)
+
+
+class MetricsPusher:
+    """Periodically push metrics from an exporter to a Pushgateway.
+
+    Metrics are updated by calling the exporter update handler before each
+    push, and pushed one last time at application shutdown.
+
+    """
+
+    def __init__(
+        self,
+        exporter: PrometheusExporter,
+        url: str,
+        job: str,
+        grouping: Mapping[str, str] | None = None,
+        interval: float = 15.0,
+        timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.exporter = exporter
+        self.url = pushgateway_url(url, job, grouping)
+        self.interval = interval
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.logger = logger or structlog.get_logger()
+        self._session: ClientSession | None = None
+        self._task: asyncio.Task[None] | None = None
+
+    async def start(self, app: Application) -> None:
+        """Start pushing metrics periodically."""
+        self._session = ClientSession(
+            connector=TCPConnector(limit=1),
+            timeout=ClientTimeout(total=self.timeout),
+        )
+        self._task = asyncio.create_task(self._push_periodically())
+
+    async def stop(self, app: Application) -> None:
+        """Stop periodic pushes, and push metrics a final time."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        try:
+            await self.push()
+        except Exception as e:
+            self.logger.error("final push failed", url=self.url, error=str(e))
+        finally:
+            if self._session:
+                await self._session.close()
+                self._session = None
+
+    async def push(self) -> None:
+        """Update metrics and push them, retrying on failures."""
+        await self.exporter.update_metrics()
+        payload = await asyncio.to_thread(self._serialize)
+        await retry_with_backoff(
+            lambda: self._put(payload),
+            self.retries,
+            self.backoff,
+            retry_on=(ClientError, TimeoutError, _RetryablePushError),
+        )
+        self.logger.debug("metrics pushed", url=self.url, size=len(payload))
+
+    def _serialize(self) -> bytes:
+        return gzip.compress(generate_latest(self.exporter.registry.registry))
+
+    async def _put(self, payload: bytes) -> None:
+        assert self._session is not None, "pusher not started"
+        async with self._session.put(
+            self.url,
+            data=payload,
+            headers={
+                "Content-Type": CONTENT_TYPE_LATEST,
+                "Content-Encoding": "gzip",
+            },
+        ) as response:
+            if response.status < 300:
+                return
+            text = await response.text()
+            details = f"status {response.status}: {text.strip()}"
+            if response.status == 429 or response.status >= 500:
+                raise _RetryablePushError(self.url, details)
+            raise PushError(self.url, details)
+
+    async def _push_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.push()
+            except Exception as e:
+                self.logger.error("push failed", url=self.url, error=str(e))
+
+
+class _RetryablePushError(PushError):
+    """A push failure that can be retried."""
@@ -0,0 +1,359 @@
+"""Send metrics via the Prometheus remote-write protocol."""
+
+import asyncio
+from collections.abc import Iterable, Mapping
+from functools import lru_cache
+import struct
+import time
+import typing as t
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, TCPConnector
+from aiohttp.web import Application
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.registry import Collector
+import structlog
+
+from ._push import retry_with_backoff
+from ._web import PrometheusExporter
+
+try:
+    import cramjam
+except ImportError:  # pragma: no cover
+    cramjam = None
+
+# Series labels, as (name, value) pairs sorted by name
+Labels = tuple[tuple[str, str], ...]
+
+
+class TimeSeries(t.NamedTuple):
+    """A sample for a series."""
+
+    labels: Labels
+    value: float
+    # Timestamp in milliseconds
+    timestamp: int
+
+
+class RemoteWriteError(Exception):
+    """Raised when sending samples fails."""
+
+    def __init__(self, url: str, details: str):
+        self.url = url
+        self.details = details
+        super().__init__(f"Remote write to {url} failed: {details}")
+
+
+class _RetryableRemoteWriteError(RemoteWriteError):
+    """A remote-write failure that can be retried."""
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(tag: int, data: bytes) -> bytes:
+    """Encode a length-delimited protobuf field."""
+    return bytes((tag,)) + _varint(len(data)) + data
+
+
+@lru_cache(maxsize=65536)
+def _encode_labels(labels: Labels) -> bytes:
+    # Label messages (name = 1, value = 2) as TimeSeries.labels (1)
+    return b"".join(
+        _field(
+            0x0A, _field(0x0A, name.encode()) + _field(0x12, value.encode())
+        )
+        for name, value in labels
+    )
+
+
+def encode_write_request(series: Iterable[TimeSeries]) -> bytes:
+    """Encode a remote-write WriteRequest protobuf message."""
+    out = bytearray()
+    for labels, value, timestamp in series:
+        # Sample message: value = 1 (double), timestamp = 2 (int64)
+        sample = b"\x09" + struct.pack("<d", value) + b"\x10"
+        sample += _varint(timestamp & 0xFFFFFFFFFFFFFFFF)
+        timeseries = _encode_labels(labels) + _field(0x12, sample)
+        out += _field(0x0A, timeseries)
+    return bytes(out)
+
+
+def _snappy_compress_literal(data: bytes) -> bytes:
+    """Encode data in the snappy block format, without compression."""
+    out = bytearray(_varint(len(data)))
+    for offset in range(0, len(data), 65536):
+        chunk = data[offset : offset + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            out.append(length << 2)
+        elif length < 0x100:
+            out += bytes((60 << 2, length))
+        else:
+            out += bytes((61 << 2,)) + length.to_bytes(2, "little")
+        out += chunk
+    return bytes(out)
+
+
+def snappy_compress(data: bytes) -> bytes:
+    """Compress data in the snappy block format.
+
+    Data is only framed as snappy literals if cramjam is not installed.
+
+    """
+    if cramjam is None:  # pragma: no cover
+        return _snappy_compress_literal(data)
+    return bytes(cramjam.snappy.compress_raw(data))
+
+
+def registry_series(
+    registry: Collector,
+    timestamp: int,
+    external_labels: Mapping[str, str] | None = None,
+) -> Iterable[TimeSeries]:
+    """Return series for samples collected from a registry."""
+    for metric in registry.collect():
+        created_name = metric.name + "_created"
+        for sample in metric.samples:
+            if sample.name == created_name:
+                continue
+            labels = {
+                **(external_labels or {}),
+                **sample.labels,
+                "__name__": sample.name,
+            }
+            yield TimeSeries(
+                tuple(sorted(labels.items())),
+                sample.value,
+                (
+                    timestamp
+                    if sample.timestamp is None
+                    else int(float(sample.timestamp) * 1000)
+                ),
+            )
+
+
+class RemoteWriter:
+    """Periodically send metrics from an exporter via remote-write.
+
+    Samples are distributed to `shards` bounded queues (keeping samples for
+    the same series in the same shard), and each shard sends batches of up to
+    `max_samples_per_send` samples, or whatever is queued after
+    `batch_deadline` seconds.  Samples are dropped when a shard queue is
+    full.
+
+    Metrics about queues and sends are registered in the exporter registry.
+
+    """
+
+    def __init__(
+        self,
+        exporter: PrometheusExporter,
+        url: str,
+        interval: float = 15.0,
+        shards: int = 4,
+        capacity: int = 10000,
+        max_samples_per_send: int = 2000,
+        batch_deadline: float = 5.0,
+        timeout: float = 10.0,
+        retries: int = 3,
+        backoff: float = 1.0,
+        external_labels: Mapping[str, str] | None = None,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.exporter = exporter
+        self.url = url
+        self.interval = interval
+        self.max_samples_per_send = max_samples_per_send
+        self.batch_deadline = batch_deadline
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.external_labels = dict(external_labels or {})
+        self.logger = logger or structlog.get_logger()
+        self._queues: list[asyncio.Queue[TimeSeries]] = [
+            asyncio.Queue(capacity) for _ in range(shards)
+        ]
+        self._session: ClientSession | None = None
+        self._tasks: list[asyncio.Task[None]] = []
+        self._collect_task: asyncio.Task[None] | None = None
+        self._setup_metrics()
+
+    async def start(self, app: Application) -> None:
+        """Start collecting and sending samples."""
+        self._session = ClientSession(
+            connector=TCPConnector(limit=len(self._queues)),
+            timeout=ClientTimeout(total=self.timeout),
+        )
+        self._tasks = [
+            asyncio.create_task(self._run_shard(queue))
+            for queue in self._queues
+        ]
+        self._collect_task = asyncio.create_task(self._collect_periodically())
+
+    async def stop(self, app: Application) -> None:
+        """Stop collecting samples, and send pending ones."""
+        if self._collect_task:
+            self._collect_task.cancel()
+            await asyncio.gather(self._collect_task, return_exceptions=True)
+            self._collect_task = None
+        if not self._tasks:
+            # not started, samples can't be sent
+            return
+        try:
+            await self.collect()
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self._queues)),
+                self.timeout,
+            )
+        except Exception as e:
+            self.logger.error(
+                "remote write flush failed", url=self.url, error=str(e)
+            )
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    async def collect(self) -> None:
+        """Update metrics and queue samples for sending."""
+        await self.exporter.update_metrics()
+        timestamp = int(time.time() * 1000)
+        shards = len(self._queues)
+        dropped = 0
+        for series in registry_series(
+            self.exporter.registry.registry, timestamp, self.external_labels
+        ):
+            queue = self._queues[hash(series.labels) % shards]
+            try:
+                queue.put_nowait(series)
+            except asyncio.QueueFull:
+                dropped += 1
+        if dropped:
+            self._samples_dropped.labels(reason="queue_full").inc(dropped)
+
+    def _setup_metrics(self) -> None:
+        self._pending_samples = Gauge(
+            "exporter_remote_write_pending_samples",
+            "Samples queued for sending via remote-write",
+            labelnames=["shard"],
+            registry=None,
+        )
+        for index, queue in enumerate(self._queues):
+            self._pending_samples.labels(shard=str(index)).set_function(
+                queue.qsize
+            )
+        self._samples_sent = Counter(
+            "exporter_remote_write_samples_sent",
+            "Samples sent via remote-write",
+            registry=None,
+        )
+        self._samples_dropped = Counter(
+            "exporter_remote_write_samples_dropped",
+            "Samples dropped without being sent via remote-write",
+            labelnames=["reason"],
+            registry=None,
+        )
+        self._send_duration = Histogram(
+            "exporter_remote_write_send_duration_seconds",
+            "Duration of remote-write requests",
+            registry=None,
+        )
+        for metric in (
+            self._pending_samples,
+            self._samples_sent,
+            self._samples_dropped,
+            self._send_duration,
+        ):
+            self.exporter.registry.register_additional_collector(metric)
+
+    async def _collect_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.collect()
+            except Exception as e:
+                self.logger.error(
+                    "remote write collection failed", error=str(e)
+                )
+
+    async def _run_shard(self, queue: asyncio.Queue[TimeSeries]) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.batch_deadline
+            while len(batch) < self.max_samples_per_send:
+                try:
+                    batch.append(queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(
+                        await asyncio.wait_for(queue.get(), remaining)
+                    )
+                except TimeoutError:
+                    break
+            try:
+                await self._send(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _send(self, batch: list[TimeSeries]) -> None:
+        payload = await asyncio.to_thread(
+            lambda: snappy_compress(encode_write_request(batch))
+        )
+        try:
+            await retry_with_backoff(
+                lambda: self._post(payload),
+                self.retries,
+                self.backoff,
+                retry_on=(
+                    ClientError,
+                    TimeoutError,
+                    _RetryableRemoteWriteError,
+                ),
+            )
+        except Exception as e:
+            reason = "rejected" if type(e) is RemoteWriteError else "failed"
+            self._samples_dropped.labels(reason=reason).inc(len(batch))
+            self.logger.error(
+                "remote write failed",
+                url=self.url,
+                samples=len(batch),
+                error=str(e),
+            )
+        else:
+            self._samples_sent.inc(len(batch))
+
+    async def _post(self, payload: bytes) -> None:
+        assert self._session is not None, "remote writer not started"
+        with self._send_duration.time():
+            async with self._session.post(
+                self.url,
+                data=payload,
+                headers={
+                    "Content-Encoding": "snappy",
+                    "Content-Type": "application/x-protobuf",
+                    "X-Prometheus-Remote-Write-Version": "0.1.0",
+                },
+            ) as response:
+                if response.status < 300:
+                    return
+                text = await response.text()
+        details = f"status {response.status}: {text.strip()}"
+        if response.status == 429 or response.status >= 500:
+            raise _RetryableRemoteWriteError(self.url, details)
+        raise RemoteWriteError(self.url, details)
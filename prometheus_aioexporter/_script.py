@@ -1,6 +1,6 @@
 """Run a web server providing a Prometheus metrics endpoint."""
 
-from collections.abc import Iterable
+from collections.abc import Iterable, Mapping
 from copy import deepcopy
 from importlib import metadata
 import os
@@ -16,12 +16,18 @@ from prometheus_client import ProcessCollector
 from prometheus_client.metrics import MetricWrapperBase
 import structlog
 
-from ._log import LogFormat, LogLevel, setup_logging
+from ._cardinality import SeriesBudget
+from ._catalog import MetricsConfigReloader
+from ._log import LogFormat, LogLevel, QueueLogWriter, setup_logging
 from ._metric import (
     MetricConfig,
     MetricsRegistry,
 )
-from ._web import PrometheusExporter, PrometheusExporterConfig
+from ._probe import Prober
+from ._push import MetricsPusher
+from ._remote_write import RemoteWriter
+from ._snapshot import MetricsSnapshotter
+from ._web import EventLoop, PrometheusExporter, PrometheusExporterConfig
 
 
 class Arguments:
@@ -76,14 +82,30 @@ class PrometheusExporterScript:
     # option name as "<PREFIX>_<UPPERCASE_NAME>".
     envvar_prefix: str = "EXP"
 
+    # Whether metrics are only instantiated when first accessed, can be
+    # changed by subclasses.
+    lazy_metrics: bool = False
+
+    # Whether metrics are filled by the update handler in a new generation,
+    # published when the handler completes, can be changed by subclasses.
+    double_buffered_metrics: bool = False
+
+    # Prober for multi-target probes, can be set by subclasses in configure().
+    prober: Prober | None = None
+
     # Registry for handling metrics.
     registry: MetricsRegistry
     # Structured logger for the exporter.
     logger: structlog.stdlib.BoundLogger
 
+    _metrics_config_reloader: MetricsConfigReloader | None = None
+
     def __init__(self) -> None:
         self._ensure_version()
-        self.registry = MetricsRegistry()
+        self.registry = MetricsRegistry(
+            lazy=self.lazy_metrics,
+            double_buffered=self.double_buffered_metrics,
+        )
         self.logger = structlog.get_logger()
         self.command = self._setup_command()
 
@@ -138,7 +160,7 @@ class PrometheusExporterScript:
 
     def create_metrics(
         self, metric_configs: Iterable[MetricConfig]
-    ) -> dict[str, MetricWrapperBase]:
+    ) -> Mapping[str, MetricWrapperBase]:
         """Create and register metrics from a list of MetricConfigs."""
         return self.registry.create_metrics(metric_configs)
 
@@ -191,6 +213,47 @@ class PrometheusExporterScript:
                 show_default=True,
                 show_envvar=True,
             ),
+            click.Option(
+                ["--unix-socket"],
+                help="path of a Unix socket to listen on, instead of TCP",
+                type=click.Path(dir_okay=False, path_type=Path),
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--socket-activation"],
+                help=(
+                    "listen on sockets passed by systemd socket activation, "
+                    "if any, instead of TCP"
+                ),
+                type=bool,
+                is_flag=True,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--listen-backlog"],
+                help="maximum number of pending connections",
+                type=click.IntRange(min=1),
+                default=128,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--keepalive-timeout"],
+                help="timeout (in seconds) for idle keep-alive connections",
+                type=click.FloatRange(min=0),
+                default=75.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--event-loop"],
+                help="event loop implementation",
+                type=click.Choice(EventLoop, case_sensitive=False),
+                default=EventLoop.ASYNCIO,
+                show_default=True,
+                show_envvar=True,
+            ),
             click.Option(
                 ["--metrics-path"],
                 help="path under which metrics are exposed",
@@ -199,6 +262,177 @@ class PrometheusExporterScript:
                 show_default=True,
                 show_envvar=True,
             ),
+            click.Option(
+                ["--scrape-concurrency"],
+                help=(
+                    "maximum number of concurrent scrape requests, 0 for "
+                    "unlimited"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--scrape-queue-size"],
+                help=(
+                    "maximum number of scrape requests waiting when "
+                    "concurrency is limited"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--scrape-queue-timeout"],
+                help="maximum time (in seconds) scrape requests can wait",
+                type=click.FloatRange(min=0),
+                default=10.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--scrape-min-interval"],
+                help=(
+                    "minimum interval (in seconds) between scrape requests "
+                    "from the same client, 0 to disable"
+                ),
+                type=click.FloatRange(min=0),
+                default=0.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--scrape-client-header"],
+                help=(
+                    "request header identifying clients for the scrape "
+                    "interval (e.g. X-Forwarded-For), instead of the peer "
+                    "address"
+                ),
+                type=str,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--ready-max-age"],
+                help=(
+                    "maximum age (in seconds) of the last metrics update for "
+                    "the exporter to be reported as ready, 0 to disable"
+                ),
+                type=click.FloatRange(min=0),
+                default=0.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--loop-monitor-interval"],
+                help=(
+                    "interval (in seconds) for measuring event loop lag, 0 "
+                    "to disable"
+                ),
+                type=click.FloatRange(min=0),
+                default=0.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--slow-callback-duration"],
+                help=(
+                    "minimum duration (in seconds) of callbacks blocking the "
+                    "event loop to be logged, if loop is monitored"
+                ),
+                type=click.FloatRange(min=0, min_open=True),
+                default=0.1,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--debug-cardinality"],
+                help=(
+                    "expose series cardinality of metrics at "
+                    "/debug/cardinality"
+                ),
+                type=bool,
+                is_flag=True,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--series-soft-limit"],
+                help=(
+                    "number of series above which metrics with lowest "
+                    "priority are shed, 0 to disable"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--series-hard-limit"],
+                help=(
+                    "number of series above which new series are refused, 0 "
+                    "to disable"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--memory-soft-limit"],
+                help=(
+                    "resident memory size (in bytes) above which metrics "
+                    "with lowest priority are shed, 0 to disable"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--memory-hard-limit"],
+                help=(
+                    "resident memory size (in bytes) above which new series "
+                    "are refused, 0 to disable"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--update-queue-interval"],
+                help=(
+                    "interval (in seconds) for applying queued metric "
+                    "updates, 0 to only apply them when metrics are updated"
+                ),
+                type=click.FloatRange(min=0),
+                default=0.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--update-queue-size"],
+                help=(
+                    "maximum number of queued metric updates, 0 for unlimited"
+                ),
+                type=click.IntRange(min=0),
+                default=100000,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--server-timing"],
+                help=(
+                    "include durations of metrics request phases in the "
+                    "Server-Timing header"
+                ),
+                type=bool,
+                is_flag=True,
+                show_default=True,
+                show_envvar=True,
+            ),
             click.Option(
                 ["-L", "--log-level"],
                 help="minimum level for log messages",
@@ -215,6 +449,25 @@ class PrometheusExporterScript:
                 show_default=True,
                 show_envvar=True,
             ),
+            click.Option(
+                ["--log-queue-size"],
+                help=(
+                    "if not zero, write logs from a background thread, "
+                    "queuing up to the specified number of entries"
+                ),
+                type=click.IntRange(min=0),
+                default=0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--access-log-sample-rate"],
+                help="fraction of successful requests to log",
+                type=click.FloatRange(min=0, max=1),
+                default=1.0,
+                show_default=True,
+                show_envvar=True,
+            ),
             click.Option(
                 ["--process-stats"],
                 help="include process stats in metrics",
@@ -223,6 +476,95 @@ class PrometheusExporterScript:
                 show_default=True,
                 show_envvar=True,
             ),
+            click.Option(
+                ["--metrics-config"],
+                help="file with metrics definitions (JSON, YAML or TOML)",
+                type=click.Path(exists=True, dir_okay=False, path_type=Path),
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--metrics-config-cache"],
+                help="directory for caching parsed metrics definitions",
+                type=click.Path(file_okay=False, path_type=Path),
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--metrics-config-watch-interval"],
+                help=(
+                    "interval (in seconds) for checking changes to the "
+                    "metrics definitions file, 0 to disable"
+                ),
+                type=click.FloatRange(min=0),
+                default=0.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--push-gateway"],
+                help="URL of a Pushgateway to periodically push metrics to",
+                type=str,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--push-interval"],
+                help="interval (in seconds) between pushes",
+                type=click.FloatRange(min=0, min_open=True),
+                default=15.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--push-job"],
+                help="job name for pushed metrics",
+                type=str,
+                default=self.name,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--push-grouping"],
+                help="grouping label for pushed metrics, as LABEL=VALUE",
+                type=str,
+                multiple=True,
+                callback=_parse_grouping,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--remote-write-url"],
+                help="URL of a remote-write receiver to send metrics to",
+                type=str,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--remote-write-interval"],
+                help="interval (in seconds) between remote-write collections",
+                type=click.FloatRange(min=0, min_open=True),
+                default=15.0,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--remote-write-shards"],
+                help="number of concurrent remote-write senders",
+                type=click.IntRange(min=1),
+                default=4,
+                show_default=True,
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--snapshot-file"],
+                help=("file to persist metric values to, restored at startup"),
+                type=click.Path(dir_okay=False, path_type=Path),
+                show_envvar=True,
+            ),
+            click.Option(
+                ["--snapshot-interval"],
+                help="interval (in seconds) between metric values snapshots",
+                type=click.FloatRange(min=0, min_open=True),
+                default=60.0,
+                show_default=True,
+                show_envvar=True,
+            ),
             click.Option(
                 ["--ssl-private-key"],
                 help="full path to the ssl private key",
@@ -266,21 +608,53 @@ class PrometheusExporterScript:
             sys.exit(1)
 
     def _execute(self, args: Arguments) -> None:
-        setup_logging(args.log_format, args.log_level)
+        log_writer = setup_logging(
+            args.log_format,
+            args.log_level,
+            queue_size=args.log_queue_size,
+            access_log_sample_rate=args.access_log_sample_rate,
+        )
         self.logger.info(
             "startup", version=self.version, python_version=sys.version
         )
         self.logger.debug("configuration", **args.dict())
-        self._configure_registry(include_process_stats=args.process_stats)
+        # series are only tracked when needed, before metrics are created
+        self.registry.track_series = (
+            args.debug_cardinality or self._get_series_budget(args).enabled
+        )
+        self._configure_registry(
+            include_process_stats=args.process_stats, log_writer=log_writer
+        )
+        if args.metrics_config:
+            self._load_metrics_config(args)
         self.configure(args)
         exporter = self._get_exporter(args)
         exporter.run()
 
-    def _configure_registry(self, include_process_stats: bool = False) -> None:
+    def _configure_registry(
+        self,
+        include_process_stats: bool = False,
+        log_writer: QueueLogWriter | None = None,
+    ) -> None:
         if include_process_stats:
             self.registry.register_additional_collector(
                 ProcessCollector(registry=None)
             )
+        if log_writer:
+            self.registry.register_additional_collector(log_writer)
+
+    def _load_metrics_config(self, args: Arguments) -> None:
+        self._metrics_config_reloader = MetricsConfigReloader(
+            self.registry,
+            args.metrics_config,
+            cache_dir=args.metrics_config_cache,
+            watch_interval=args.metrics_config_watch_interval,
+            logger=self.logger,
+        )
+        self._metrics_config_reloader.load()
+        self.logger.debug(
+            "metrics config loaded", path=str(args.metrics_config)
+        )
 
     def _get_ssl_context(self, args: Arguments) -> ssl.SSLContext | None:
         if not all((args.ssl_private_key, args.ssl_public_key)):
@@ -291,6 +665,14 @@ class PrometheusExporterScript:
         ssl_context.load_cert_chain(args.ssl_public_key, args.ssl_private_key)
         return ssl_context
 
+    def _get_series_budget(self, args: Arguments) -> SeriesBudget:
+        return SeriesBudget(
+            soft_max_series=args.series_soft_limit,
+            max_series=args.series_hard_limit,
+            soft_max_memory=args.memory_soft_limit,
+            max_memory=args.memory_hard_limit,
+        )
+
     def _get_exporter(self, args: Arguments) -> PrometheusExporter:
         config = PrometheusExporterConfig(
             self.name,
@@ -300,10 +682,84 @@ class PrometheusExporterScript:
             args.port,
             metrics_path=args.metrics_path,
             ssl_context=self._get_ssl_context(args),
+            unix_socket=args.unix_socket,
+            socket_activation=args.socket_activation,
+            backlog=args.listen_backlog,
+            keepalive_timeout=args.keepalive_timeout,
+            scrape_concurrency=args.scrape_concurrency,
+            scrape_queue_size=args.scrape_queue_size,
+            scrape_queue_timeout=args.scrape_queue_timeout,
+            scrape_min_interval=args.scrape_min_interval,
+            scrape_client_header=args.scrape_client_header,
+            ready_max_age=args.ready_max_age,
+            loop_monitor_interval=args.loop_monitor_interval,
+            slow_callback_duration=args.slow_callback_duration,
+            server_timing=args.server_timing,
+            debug_cardinality=args.debug_cardinality,
+            update_queue_interval=args.update_queue_interval,
+            update_queue_size=args.update_queue_size,
+            series_budget=self._get_series_budget(args),
+            event_loop=args.event_loop,
         )
         exporter = PrometheusExporter(
             config, self.registry, logger=self.logger
         )
+        if self.prober:
+            exporter.set_prober(self.prober)
+        snapshotter = None
+        if args.snapshot_file:
+            snapshotter = MetricsSnapshotter(
+                self.registry,
+                args.snapshot_file,
+                interval=args.snapshot_interval,
+                logger=self.logger,
+            )
+            # restore values before other startup handlers run
+            exporter.app.on_startup.append(snapshotter.start)
         exporter.app.on_startup.append(self.on_application_startup)
+        if args.push_gateway:
+            pusher = MetricsPusher(
+                exporter,
+                args.push_gateway,
+                args.push_job,
+                grouping=args.push_grouping,
+                interval=args.push_interval,
+                logger=self.logger,
+            )
+            exporter.app.on_startup.append(pusher.start)
+            # the final push updates metrics, so it must happen before the
+            # script shutdown handler releases resources
+            exporter.app.on_shutdown.append(pusher.stop)
+        if args.remote_write_url:
+            writer = RemoteWriter(
+                exporter,
+                args.remote_write_url,
+                interval=args.remote_write_interval,
+                shards=args.remote_write_shards,
+                logger=self.logger,
+            )
+            exporter.app.on_startup.append(writer.start)
+            # like the final push, the final send updates metrics
+            exporter.app.on_shutdown.append(writer.stop)
         exporter.app.on_shutdown.append(self.on_application_shutdown)
+        if snapshotter:
+            # save values after other shutdown handlers have run
+            exporter.app.on_shutdown.append(snapshotter.stop)
+        if reloader := self._metrics_config_reloader:
+            exporter.app.on_startup.append(reloader.start)
+            exporter.app.on_cleanup.append(reloader.stop)
         return exporter
+
+
+def _parse_grouping(
+    ctx: click.Context, param: click.Parameter, values: Iterable[str]
+) -> dict[str, str]:
+    grouping = {}
+    for value in values:
+        label, sep, label_value = value.partition("=")
+        if not sep or not label:
+            raise click.BadParameter(
+                f"invalid value {value!r}, must be LABEL=VALUE"
+            )
+        grouping[label] = label_value
+    return grouping
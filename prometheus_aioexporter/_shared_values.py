@@ -0,0 +1,414 @@
+"""Metric values shared across processes via a memory-mapped file."""
+
+from collections.abc import Container, Generator
+from contextlib import contextmanager
+import fcntl
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import threading
+import types
+import typing as t
+import weakref
+
+from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.metrics_core import Metric
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# File header: magic, format version, reserved, bytes used by records
+_FILE_HEADER = struct.Struct("<8sIIQ")
+_USED_OFFSET = 16
+_MAGIC = b"PAEXVALS"
+_VERSION = 1
+# Record header: key length, process ID, value, timestamp.  Records are
+# aligned to 8 bytes, so that values can be updated with a single write.
+_RECORD_HEADER = struct.Struct("<IIdd")
+_PID = struct.Struct("<I")
+_PID_OFFSET = 4
+_VALUE_OFFSET = 8
+_VALUE = struct.Struct("<dd")
+_ALIGNMENT = 8
+
+_Metric = t.TypeVar("_Metric", bound=MetricWrapperBase)
+
+
+class SharedValueStoreError(Exception):
+    """Raised when a shared values file is invalid."""
+
+    def __init__(self, path: Path, details: str):
+        self.path = path
+        self.details = details
+        super().__init__(f"Invalid shared values file {path}: {details}")
+
+
+class _SeriesKey(t.NamedTuple):
+    """Details for a series stored in a record."""
+
+    type: str
+    multiprocess_mode: str
+    metric_name: str
+    name: str
+    labels: tuple[tuple[str, str], ...]
+    documentation: str
+
+
+class SharedValue:
+    """Metric value stored in a `SharedValueStore`.
+
+    This is used in place of `prometheus_client.values.ValueClass` by
+    metrics created from `SharedValueStore.metric_class()`, via a subclass
+    bound to a store.
+
+    """
+
+    _multiprocess = True
+    _store: "SharedValueStore"
+
+    def __init__(
+        self,
+        typ: str,
+        metric_name: str,
+        name: str,
+        labelnames: t.Sequence[str],
+        labelvalues: t.Sequence[str],
+        help_text: str,
+        multiprocess_mode: str = "",
+        **kwargs: t.Any,
+    ) -> None:
+        self._key = json.dumps(
+            [
+                typ,
+                multiprocess_mode,
+                metric_name,
+                name,
+                list(zip(labelnames, labelvalues, strict=True)),
+                help_text,
+            ],
+            separators=(",", ":"),
+        )
+        self._type = typ
+        self._offset = 0
+        self._value = 0.0
+        self._store._add_value(self)
+
+    def inc(self, amount: float) -> None:
+        with self._store._lock:
+            self._store._check_pid()
+            self._value += amount
+            self._store._write(self._offset, self._value, 0.0)
+
+    def set(self, value: float, timestamp: float | None = None) -> None:
+        with self._store._lock:
+            self._store._check_pid()
+            self._value = value
+            self._store._write(self._offset, value, timestamp or 0.0)
+
+    def set_exemplar(self, exemplar: t.Any) -> None:
+        # exemplars are not supported
+        pass
+
+    def get(self) -> float:
+        with self._store._lock:
+            return self._value
+
+    def get_exemplar(self) -> None:
+        return None
+
+
+class SharedValueStore:
+    """Store metric values for multiple processes in a single file.
+
+    The file contains a fixed header followed by a sequence of records, each
+    holding a series key (metric name, labels, type and description), the
+    process ID, and the value.  Records are only appended, under an
+    exclusive file lock, and each process only updates values in its own
+    records, so updates don't need locking across processes.
+
+    Each process keeps an index from series keys to record offsets, and
+    values from all processes are read in a single pass over the mapped
+    file, parsing only records added since the previous read.
+
+    Only metrics created from classes returned by `metric_class()` store
+    values in the file.  File records are never removed, so series removed
+    from metrics are still reported.  Instead, records of processes which
+    are no longer running are taken over by new processes for the same
+    series, so the file doesn't grow as processes are replaced.  Counter,
+    histogram and summary values are kept when a record is taken over, so
+    totals don't decrease, while gauge values are reset.  Gauges with a
+    `live*` multiprocess mode only report values from running processes.
+
+    """
+
+    def __init__(self, path: Path, initial_size: int = 1 << 20) -> None:
+        self.path = path
+        self.initial_size = initial_size
+        self._lock = threading.RLock()
+        self._values: weakref.WeakSet[SharedValue] = weakref.WeakSet()
+        self._metric_classes: dict[type, type] = {}
+        self._open()
+
+    def close(self) -> None:
+        """Close the file."""
+        with self._lock:
+            self._mmap.close()
+            os.close(self._fd)
+
+    def value_class(self) -> type[SharedValue]:
+        """Return a value class bound to the store."""
+        return t.cast(
+            type[SharedValue],
+            type("SharedValue", (SharedValue,), {"_store": self}),
+        )
+
+    def metric_class(self, cls: type[_Metric]) -> type[_Metric]:
+        """Return a subclass of a metric class storing values in the store.
+
+        Other metrics are not affected, as the value class is only replaced
+        when values for the subclass are created.
+
+        """
+        with self._lock:
+            if (metric_class := self._metric_classes.get(cls)) is None:
+                metric_class = self._metric_classes[cls] = type(
+                    cls.__name__,
+                    (cls,),
+                    {"_metric_init": self._metric_init(cls)},
+                )
+            return t.cast(type[_Metric], metric_class)
+
+    def read_metrics(
+        self, names: Container[str] | None = None
+    ) -> list[Metric]:
+        """Return metrics with values aggregated across processes.
+
+        Values are aggregated as in prometheus_client multiprocess mode.  If
+        `names` is specified, only metrics with those names are returned.
+        Metrics redefined with a different type are returned once per type.
+
+        """
+        # records for metrics with the same name might have different
+        # types, if metrics are redefined
+        metrics: dict[tuple[str, str], Metric] = {}
+        alive: dict[int, bool] = {}
+        with self._lock:
+            self._check_pid()
+            self._sync()
+            for offset, key in self._records:
+                if names is not None and key.metric_name not in names:
+                    continue
+                pid = self._record_pid(offset)
+                if key.multiprocess_mode.startswith("live"):
+                    if pid not in alive:
+                        alive[pid] = _is_alive(pid)
+                    if not alive[pid]:
+                        continue
+                value, timestamp = _VALUE.unpack_from(self._mmap, offset)
+                metric = metrics.get((key.metric_name, key.type))
+                if metric is None:
+                    metric = metrics[key.metric_name, key.type] = Metric(
+                        key.metric_name, key.documentation, key.type
+                    )
+                # sample labels are passed as tuples, and gauges include the
+                # mode, as expected by accumulation
+                if key.type == "gauge":
+                    t.cast(
+                        t.Any, metric
+                    )._multiprocess_mode = key.multiprocess_mode
+                    labels = (*key.labels, ("pid", str(pid)))
+                    metric.add_sample(
+                        key.name, t.cast(dict, labels), value, timestamp
+                    )
+                else:
+                    metric.add_sample(
+                        key.name, t.cast(dict, key.labels), value
+                    )
+        return list(MultiProcessCollector._accumulate_metrics(metrics, True))
+
+    def _metric_init(self, cls: type[MetricWrapperBase]) -> types.FunctionType:
+        """Return the metric init function, using the store value class.
+
+        The client library creates values from the `ValueClass` global of
+        the `values` module, so the function is copied with globals pointing
+        to the store one instead.
+
+        """
+        metric_init = t.cast(types.FunctionType, cls._metric_init)
+        return types.FunctionType(
+            metric_init.__code__,
+            {
+                **metric_init.__globals__,
+                "values": types.SimpleNamespace(ValueClass=self.value_class()),
+            },
+            metric_init.__name__,
+            metric_init.__defaults__,
+            metric_init.__closure__,
+        )
+
+    def _open(self) -> None:
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._file_lock():
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(
+                    self._fd, max(self.initial_size, _FILE_HEADER.size)
+                )
+                header = _FILE_HEADER.pack(
+                    _MAGIC, _VERSION, 0, _FILE_HEADER.size
+                )
+                os.pwrite(self._fd, header, 0)
+            self._mmap = mmap.mmap(self._fd, 0)
+        if len(self._mmap) < _FILE_HEADER.size:
+            self.close()
+            raise SharedValueStoreError(self.path, "file too short")
+        magic, version, _, _ = _FILE_HEADER.unpack_from(self._mmap)
+        if magic != _MAGIC or version != _VERSION:
+            self.close()
+            raise SharedValueStoreError(self.path, "unknown file format")
+        # value offsets and keys for records, and value offsets by key
+        self._records: list[tuple[int, _SeriesKey]] = []
+        self._offsets: dict[str, list[int]] = {}
+        self._parsed = _FILE_HEADER.size
+
+    @contextmanager
+    def _file_lock(self) -> Generator[None]:
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _check_pid(self) -> None:
+        """Reopen the file and move values to new records after a fork."""
+        if os.getpid() == self._pid:
+            return
+        # the file lock is shared with the parent process, so the file needs
+        # to be opened again
+        self._mmap.close()
+        os.close(self._fd)
+        self._open()
+        for value in list(self._values):
+            self._allocate(value)
+
+    def _add_value(self, value: SharedValue) -> None:
+        with self._lock:
+            self._check_pid()
+            self._allocate(value)
+            self._values.add(value)
+
+    def _allocate(self, value: SharedValue) -> None:
+        # records owned by the process are only changed by it
+        offset = self._find(value._key)
+        if offset is None:
+            with self._file_lock():
+                self._sync()
+                offset = self._find(value._key)
+                if offset is None:
+                    offset = self._take_over(value)
+                if offset is None:
+                    offset = self._append(value._key)
+        value._offset = offset
+        value._value = _VALUE.unpack_from(self._mmap, offset)[0]
+
+    def _find(self, key: str) -> int | None:
+        """Return the value offset of the process record for a key."""
+        for offset in self._offsets.get(key, ()):
+            if self._record_pid(offset) == self._pid:
+                return offset
+        return None
+
+    def _take_over(self, value: SharedValue) -> int | None:
+        """Take over the record of a dead process for a value, if any.
+
+        This must be called with the file lock held.
+
+        """
+        for offset in self._offsets.get(value._key, ()):
+            if _is_alive(self._record_pid(offset)):
+                continue
+            if value._type == "gauge":
+                _VALUE.pack_into(self._mmap, offset, 0.0, 0.0)
+            _PID.pack_into(
+                self._mmap, offset - _VALUE_OFFSET + _PID_OFFSET, self._pid
+            )
+            return offset
+        return None
+
+    def _append(self, key: str) -> int:
+        """Append a record for a key, returning the offset of its value."""
+        data = key.encode()
+        size = _RECORD_HEADER.size + len(data)
+        size += -size % _ALIGNMENT
+        used = self._used()
+        if used + size > len(self._mmap):
+            os.ftruncate(self._fd, max(2 * len(self._mmap), used + size))
+            self._remap()
+        _RECORD_HEADER.pack_into(
+            self._mmap, used, len(data), self._pid, 0.0, 0.0
+        )
+        start = used + _RECORD_HEADER.size
+        self._mmap[start : start + len(data)] = data
+        # publish the record only once it's complete
+        struct.pack_into("<Q", self._mmap, _USED_OFFSET, used + size)
+        self._sync()
+        return used + _VALUE_OFFSET
+
+    def _sync(self) -> None:
+        """Parse records added since the last call."""
+        used = self._used()
+        if used > len(self._mmap):
+            self._remap()
+        offset = self._parsed
+        while offset < used:
+            key_size, _, _, _ = _RECORD_HEADER.unpack_from(self._mmap, offset)
+            start = offset + _RECORD_HEADER.size
+            key_data = self._mmap[start : start + key_size].decode()
+            typ, mode, metric_name, name, labels, documentation = json.loads(
+                key_data
+            )
+            series_key = _SeriesKey(
+                typ,
+                mode,
+                metric_name,
+                name,
+                tuple(sorted((label, value) for label, value in labels)),
+                documentation,
+            )
+            self._records.append((offset + _VALUE_OFFSET, series_key))
+            self._offsets.setdefault(key_data, []).append(
+                offset + _VALUE_OFFSET
+            )
+            size = _RECORD_HEADER.size + key_size
+            offset += size + (-size % _ALIGNMENT)
+        self._parsed = offset
+
+    def _remap(self) -> None:
+        self._mmap.close()
+        self._mmap = mmap.mmap(self._fd, 0)
+
+    def _record_pid(self, offset: int) -> int:
+        """Return the process ID for the record of a value offset."""
+        return int(
+            _PID.unpack_from(self._mmap, offset - _VALUE_OFFSET + _PID_OFFSET)[
+                0
+            ]
+        )
+
+    def _used(self) -> int:
+        return int(struct.unpack_from("<Q", self._mmap, _USED_OFFSET)[0])
+
+    def _write(self, offset: int, value: float, timestamp: float) -> None:
+        _VALUE.pack_into(self._mmap, offset, value, timestamp)
+
+
+def _is_alive(pid: int) -> bool:
+    """Return whether a process is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process belongs to another user
+        return True
+    return True
@@ -0,0 +1,328 @@
+"""Persist metric values across restarts."""
+
+from array import array
+import asyncio
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import sys
+import tempfile
+import typing as t
+
+from aiohttp.web import Application
+from prometheus_client.metrics import MetricWrapperBase
+import structlog
+
+from ._metric import MetricsRegistry
+
+# Snapshot header: magic, format version, size of the JSON index
+_HEADER = struct.Struct("<8sII")
+_MAGIC = b"PAEXSNAP"
+_VERSION = 1
+# Values are stored as native doubles, aligned to their size
+_VALUE_SIZE = array("d").itemsize
+# Minimum number of values for series of each metric type (histograms also
+# have one per bucket)
+_SERIES_VALUES = {"counter": 2, "gauge": 1, "histogram": 2, "summary": 3}
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot file is invalid."""
+
+    def __init__(self, path: Path, details: str):
+        self.path = path
+        self.details = details
+        super().__init__(f"Invalid snapshot {path}: {details}")
+
+
+def _series_values(metric_type: str, series: t.Any) -> list[float]:
+    """Return values to persist for a metric series."""
+    match metric_type:
+        case "counter":
+            return [series._value.get(), series._created]
+        case "gauge":
+            return [series._value.get()]
+        case "histogram":
+            return [
+                series._sum.get(),
+                series._created,
+                *(bucket.get() for bucket in series._buckets),
+            ]
+        case "summary":
+            return [series._count.get(), series._sum.get(), series._created]
+    return []
+
+
+def _restore_values(
+    metric_type: str, series: t.Any, values: t.Sequence[float]
+) -> bool:
+    """Restore persisted values to a metric series.
+
+    Return whether values could be restored.
+
+    """
+    match metric_type:
+        case "counter":
+            series._value.set(values[0])
+            series._created = values[1]
+        case "gauge":
+            series._value.set(values[0])
+        case "histogram":
+            buckets = series._buckets
+            if len(values) != len(buckets) + 2:
+                # buckets have changed
+                return False
+            series._sum.set(values[0])
+            series._created = values[1]
+            for bucket, value in zip(buckets, values[2:], strict=True):
+                bucket.set(value)
+        case "summary":
+            series._count.set(values[0])
+            series._sum.set(values[1])
+            series._created = values[2]
+    return True
+
+
+class _IndexEntry(t.NamedTuple):
+    """Index entry for a metric in a snapshot."""
+
+    name: str
+    type: str
+    label_names: list[str]
+    # label values, offset and count of values for each series
+    series: list[tuple[list[str], int, int]]
+
+
+def _metric_series(
+    metric: MetricWrapperBase,
+) -> list[tuple[t.Sequence[str], t.Any]]:
+    if not metric._labelnames:
+        return [((), metric)]
+    with metric._lock:
+        return list(metric._metrics.items())
+
+
+def dump_snapshot(registry: MetricsRegistry) -> bytes:
+    """Return a snapshot of values for metrics in the registry.
+
+    The snapshot contains a JSON index of metrics and series, followed by
+    an array of doubles with values, so that it can be loaded from a
+    memory-mapped file without copying values.  Values for enum and info
+    metrics are not included.
+
+    """
+    index = []
+    values = array("d")
+    for name, metric in registry._metrics.items():
+        metric_type = t.cast(str, metric._type)
+        entries = []
+        for label_values, series in _metric_series(metric):
+            series_values = _series_values(metric_type, series)
+            if not series_values:
+                break
+            entries.append([label_values, len(values), len(series_values)])
+            values.extend(series_values)
+        if entries:
+            index.append([name, metric_type, metric._labelnames, entries])
+    index_data = json.dumps(
+        {"byteorder": sys.byteorder, "metrics": index},
+        separators=(",", ":"),
+    ).encode()
+    index_data += b" " * (-(_HEADER.size + len(index_data)) % _VALUE_SIZE)
+    header = _HEADER.pack(_MAGIC, _VERSION, len(index_data))
+    return header + index_data + values.tobytes()
+
+
+def save_snapshot(registry: MetricsRegistry, path: Path) -> None:
+    """Save a snapshot of metric values to a file, atomically."""
+    _write_file(path, dump_snapshot(registry))
+
+
+def load_snapshot(registry: MetricsRegistry, path: Path) -> int:
+    """Restore metric values from a snapshot file.
+
+    Only series for metrics defined in the registry, with the same type and
+    labels, are restored.  Return the number of restored series.
+
+    """
+    with path.open("rb") as fd:
+        if os.fstat(fd.fileno()).st_size < _HEADER.size:
+            raise SnapshotError(path, "file too short")
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            view = memoryview(data)
+            try:
+                return _restore(registry, path, view)
+            finally:
+                view.release()
+
+
+def _restore(registry: MetricsRegistry, path: Path, view: memoryview) -> int:
+    magic, version, index_size = _HEADER.unpack_from(view)
+    if magic != _MAGIC:
+        raise SnapshotError(path, "unknown file format")
+    if version != _VERSION:
+        raise SnapshotError(path, f"unsupported version {version}")
+    values_offset = _HEADER.size + index_size
+    if values_offset > len(view) or (len(view) - values_offset) % _VALUE_SIZE:
+        raise SnapshotError(path, "truncated file")
+    try:
+        index = json.loads(bytes(view[_HEADER.size : values_offset]))
+        if index["byteorder"] != sys.byteorder:
+            raise SnapshotError(path, "incompatible byte order")
+        entries = _parse_index(index["metrics"])
+    except (KeyError, TypeError, ValueError):
+        raise SnapshotError(path, "invalid index") from None
+    values = view[values_offset:].cast("d")
+    try:
+        # check the whole snapshot before restoring values, so that they're
+        # not partially restored
+        for entry in entries:
+            for _, offset, count in entry.series:
+                if offset + count > len(values):
+                    raise SnapshotError(path, "truncated values")
+        restored = 0
+        for name, metric_type, label_names, series_entries in entries:
+            config = registry._configs.get(name)
+            if (
+                config is None
+                or config.type != metric_type
+                or list(config.labels) != label_names
+            ):
+                continue
+            metric = registry._get_or_register_metric(name)
+            for label_values, offset, count in series_entries:
+                series = (
+                    metric.labels(*label_values) if label_values else metric
+                )
+                if _restore_values(
+                    metric_type, series, values[offset : offset + count]
+                ):
+                    restored += 1
+        return restored
+    finally:
+        values.release()
+
+
+def _parse_index(metrics: t.Any) -> list[_IndexEntry]:
+    """Return validated entries from a snapshot index.
+
+    Raise `ValueError` (or `TypeError`) if the index is invalid.
+
+    """
+    entries = []
+    for name, metric_type, label_names, series in metrics:
+        if not (
+            isinstance(name, str)
+            and metric_type in _SERIES_VALUES
+            and _is_str_list(label_names)
+        ):
+            raise ValueError("Invalid metric")
+        series_entries = []
+        for label_values, offset, count in series:
+            if not (
+                _is_str_list(label_values)
+                and len(label_values) == len(label_names)
+                and isinstance(offset, int)
+                and isinstance(count, int)
+                and offset >= 0
+                and count >= _SERIES_VALUES[metric_type]
+            ):
+                raise ValueError("Invalid series")
+            series_entries.append((label_values, offset, count))
+        entries.append(
+            _IndexEntry(name, metric_type, label_names, series_entries)
+        )
+    return entries
+
+
+def _is_str_list(value: t.Any) -> bool:
+    return isinstance(value, list) and all(
+        isinstance(item, str) for item in value
+    )
+
+
+def _write_file(path: Path, data: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.unlink(tmp_path)
+        raise
+
+
+class MetricsSnapshotter:
+    """Periodically save metric values to a snapshot file.
+
+    Values are restored from the file at application startup (before the
+    server starts listening), saved every `interval` seconds, and one last
+    time at application shutdown, so that counters and histograms don't
+    reset when the exporter is restarted.
+
+    """
+
+    def __init__(
+        self,
+        registry: MetricsRegistry,
+        path: Path,
+        interval: float = 60.0,
+        logger: structlog.stdlib.BoundLogger | None = None,
+    ) -> None:
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.logger = logger or structlog.get_logger()
+        self._task: asyncio.Task[None] | None = None
+
+    def load(self) -> int:
+        """Restore metric values from the snapshot, if present.
+
+        Return the number of restored series.  Errors are logged, and no
+        values are restored.
+
+        """
+        try:
+            restored = load_snapshot(self.registry, self.path)
+        except FileNotFoundError:
+            return 0
+        except (OSError, SnapshotError) as e:
+            self.logger.warning(
+                "snapshot restore failed", path=str(self.path), error=str(e)
+            )
+            return 0
+        self.logger.info(
+            "snapshot restored", path=str(self.path), series=restored
+        )
+        return restored
+
+    async def save(self) -> None:
+        """Save metric values to the snapshot, logging errors."""
+        # values are collected in the loop, and written from a thread
+        data = dump_snapshot(self.registry)
+        try:
+            await asyncio.to_thread(_write_file, self.path, data)
+        except OSError as e:
+            self.logger.warning(
+                "snapshot save failed", path=str(self.path), error=str(e)
+            )
+
+    async def start(self, app: Application) -> None:
+        """Restore values and start saving them periodically."""
+        self.load()
+        self._task = asyncio.create_task(self._save_periodically())
+
+    async def stop(self, app: Application) -> None:
+        """Stop saving periodically, and save values one last time."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.save()
+
+    async def _save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
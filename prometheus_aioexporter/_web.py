@@ -1,36 +1,88 @@
 """AioHTTP application for exposing metrics to Prometheus."""
 
+import asyncio
 from collections.abc import (
+    AsyncIterable,
     Awaitable,
     Callable,
+    Iterable,
+    Mapping,
 )
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+from enum import StrEnum
+from functools import partial
+import gzip
+import importlib
 import logging
+import os
+from pathlib import Path
+import socket
 from ssl import SSLContext
 from textwrap import dedent
+import time
 import typing as t
 
+from aiohttp import hdrs
 from aiohttp.web import (
     AppKey,
     Application,
     Request,
     Response,
     StreamResponse,
+    json_response,
     run_app,
 )
-from prometheus_client.aiohttp import make_aiohttp_handler
+from prometheus_client.exposition import (
+    choose_encoder,
+    generate_latest,
+    gzip_accepted,
+)
 from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics import (
+    exposition as openmetrics_exposition,
+)
+from prometheus_client.registry import Collector
 import structlog
 
-from ._log import AccessLogger
-from ._metric import MetricsRegistry
+from ._admission import ScrapeAdmission
+from ._cardinality import SeriesBudget
+from ._exposition import OpenMetricsEncoder, TextEncoder
+from ._ingest import UpdateWriter
+from ._log import REQUEST_PHASES_KEY, AccessLogger
+from ._loop_monitor import LoopMonitor
+from ._metric import MetricDelta, MetricsRegistry
+from ._probe import Prober
 
 # Signature for update handler
-UpdateHandler = Callable[[dict[str, MetricWrapperBase]], Awaitable[None]]
+UpdateHandler = Callable[[Mapping[str, MetricWrapperBase]], Awaitable[None]]
+
+# Signature for delta update handler, either returning or yielding deltas
+DeltaUpdateHandler = Callable[
+    [Mapping[str, MetricWrapperBase]],
+    Awaitable[Iterable[MetricDelta]] | AsyncIterable[MetricDelta],
+]
 
 # The application key to get the exporter from the configuration.
 EXPORTER_APP_KEY: AppKey["PrometheusExporter"] = AppKey("exporter")
 
+# First file descriptor passed by systemd socket activation
+SD_LISTEN_FDS_START = 3
+
+# Size of metrics output above which it's compressed in a thread, to avoid
+# blocking the event loop
+COMPRESS_IN_THREAD_SIZE = 4096
+
+# Compression level for metrics output, favoring speed over size
+COMPRESS_LEVEL = 1
+
+
+class EventLoop(StrEnum):
+    """Event loop implementation."""
+
+    ASYNCIO = "asyncio"
+    UVLOOP = "uvloop"
+
 
 @dataclass(frozen=True)
 class PrometheusExporterConfig:
@@ -40,7 +92,41 @@ class PrometheusExporterConfig:
     hosts: list[str]
     port: int
     metrics_path: str = "/metrics"
+    probe_path: str = "/probe"
     ssl_context: SSLContext | None = None
+    # If set, listen on a Unix socket instead of TCP
+    unix_socket: Path | None = None
+    # If set, listen on sockets passed via systemd socket activation (if any)
+    # instead of TCP
+    socket_activation: bool = False
+    backlog: int = 128
+    keepalive_timeout: float = 75.0
+    event_loop: EventLoop = EventLoop.ASYNCIO
+    # Admission control for scrape requests, see ScrapeAdmission
+    scrape_concurrency: int = 0
+    scrape_queue_size: int = 0
+    scrape_queue_timeout: float = 10.0
+    scrape_min_interval: float = 0.0
+    scrape_client_header: str | None = None
+    # If set, the exporter is only ready if metrics were updated within the
+    # specified number of seconds
+    ready_max_age: float = 0.0
+    # If set, measure event loop lag at the specified interval (in seconds),
+    # and log callbacks blocking the loop for longer than
+    # slow_callback_duration
+    loop_monitor_interval: float = 0.0
+    slow_callback_duration: float = 0.1
+    # Whether to include durations of scrape phases in a Server-Timing header
+    server_timing: bool = False
+    # Whether to expose metrics cardinality at /debug/cardinality
+    debug_cardinality: bool = False
+    # Limits for series and resident memory, see SeriesBudget
+    series_budget: SeriesBudget = field(default_factory=SeriesBudget)
+    # If set, apply queued metric updates at the specified interval (in
+    # seconds), other than at every update
+    update_queue_interval: float = 0.0
+    # Maximum number of queued metric updates, 0 for unlimited
+    update_queue_size: int = 100000
     server_version: str = field(init=False)
 
     def __post_init__(self):
@@ -57,6 +143,10 @@ class PrometheusExporter:
     app: Application
 
     _update_handler: UpdateHandler | None = None
+    _delta_handler: DeltaUpdateHandler | None = None
+    _sockets: list[socket.socket]
+    # Monotonic time of the last successful metrics update
+    _last_update: float | None = None
 
     def __init__(
         self,
@@ -64,42 +154,185 @@ class PrometheusExporter:
         registry: MetricsRegistry,
         logger: structlog.stdlib.BoundLogger | None = None,
     ) -> None:
+        if config.debug_cardinality and not registry.track_series:
+            raise ValueError("Series tracking is not enabled")
         self.config = config
         self.registry = registry
         self.logger = logger or structlog.get_logger()
         self.app = self._make_application()
+        self._sockets = []
+        self._admission = ScrapeAdmission(
+            concurrency=config.scrape_concurrency,
+            queue_size=config.scrape_queue_size,
+            queue_timeout=config.scrape_queue_timeout,
+            min_interval=config.scrape_min_interval,
+            client_header=config.scrape_client_header,
+        )
+        if self._admission.enabled:
+            self.registry.register_additional_collector(self._admission)
+        if config.series_budget.enabled:
+            self.registry.set_series_budget(config.series_budget)
+        self.registry.update_queue_size = config.update_queue_size
+        if config.update_queue_interval:
+            writer = UpdateWriter(
+                self.registry,
+                interval=config.update_queue_interval,
+                logger=self.logger,
+            )
+            self.app.on_startup.append(writer.start)
+            self.app.on_cleanup.append(writer.stop)
+        if config.loop_monitor_interval:
+            monitor = LoopMonitor(
+                interval=config.loop_monitor_interval,
+                slow_callback_duration=config.slow_callback_duration,
+                logger=self.logger,
+            )
+            self.registry.register_additional_collector(monitor)
+            self.app.on_startup.append(monitor.start)
+            self.app.on_cleanup.append(monitor.stop)
 
-        self._metrics_handler = make_aiohttp_handler(self.registry.registry)
+        self._encoder = TextEncoder()
+        # OpenMetrics encoders by names escaping
+        self._openmetrics_encoders: dict[str, OpenMetricsEncoder] = {}
 
     def set_metric_update_handler(self, handler: UpdateHandler) -> None:
         """Set a handler to update metrics.
 
-        The provided coroutine function is called at every request with a dict
-        as argument, mapping metric names to metrics.  The signature is the
+        The provided coroutine function is called at every request with a
+        mapping of metric names to metrics as argument.  The signature is the
         following:
 
-          async def update_handler(metrics: dict[str, MetricWrapperBase]) -> None:
+          async def update_handler(
+              metrics: Mapping[str, MetricWrapperBase],
+          ) -> None:
+
+        If the registry is double-buffered, the handler is passed a new
+        generation of metrics, with no series, which is published once the
+        handler completes.
 
         """
         self._update_handler = handler
 
+    def set_metric_delta_handler(self, handler: DeltaUpdateHandler) -> None:
+        """Set a handler to update metrics with deltas.
+
+        Like the update handler, the provided function is called at every
+        request with a mapping of metric names to metrics, but it returns or
+        yields only changes to metrics, as `MetricUpdate`s and
+        `MetricRemoval`s, which are applied to the registry in one pass.  The
+        signature is either of the following:
+
+          async def delta_handler(
+              metrics: Mapping[str, MetricWrapperBase],
+          ) -> Iterable[MetricDelta]:
+
+          async def delta_handler(
+              metrics: Mapping[str, MetricWrapperBase],
+          ) -> AsyncIterator[MetricDelta]:
+
+        If an update handler is also set, it's called first.  Delta handlers
+        are not supported for double-buffered registries.
+
+        """
+        if self.registry.double_buffered:
+            raise ValueError(
+                "Updates are not supported for double-buffered registries"
+            )
+        self._delta_handler = handler
+
+    def set_prober(self, prober: Prober) -> None:
+        """Set a prober for multi-target probes.
+
+        Probes are exposed at the configured `probe_path`.  If the prober
+        has a registries cache, its metrics are included in the exporter
+        ones.
+
+        """
+        prober.setup(self.app, self.config.probe_path)
+        if prober.cache is not None:
+            self.registry.register_additional_collector(prober.cache)
+
+    async def update_metrics(self) -> None:
+        """Update metrics.
+
+        Queued updates are applied first, then the update handler (if set)
+        and async collectors are run concurrently.  The series budget (if
+        set) is enforced after updates.
+
+        """
+        self.registry.apply_queued_updates(logger=self.logger)
+        await asyncio.gather(
+            self._call_update_handler(),
+            self.registry.collect_async(logger=self.logger),
+        )
+        self.registry.enforce_series_budget(logger=self.logger)
+        self._last_update = time.monotonic()
+
     def run(self) -> None:
         """Run the Application for the exporter."""
+        if self.config.socket_activation:
+            self._sockets = get_systemd_sockets()
+        listen: dict[str, t.Any]
+        if self.config.unix_socket or self._sockets:
+            listen = {
+                "path": self.config.unix_socket,
+                "sock": self._sockets or None,
+            }
+        else:
+            listen = {"host": self.config.hosts, "port": self.config.port}
+        if loop := self._new_event_loop():
+            listen["loop"] = loop
         run_app(
             self.app,
-            host=self.config.hosts,
-            port=self.config.port,
+            **listen,
+            backlog=self.config.backlog,
+            keepalive_timeout=self.config.keepalive_timeout,
             print=lambda *args, **kargs: None,
             access_log_class=AccessLogger,
             ssl_context=self.config.ssl_context,
         )
 
+    async def _call_update_handler(self) -> None:
+        if self._update_handler:
+            if self.registry.double_buffered:
+                # metrics are only published if the update succeeds
+                generation = self.registry.start_generation()
+                await self._update_handler(generation)
+                self.registry.publish_generation(generation)
+            else:
+                await self._update_handler(self.registry.get_metrics())
+        if self._delta_handler:
+            result = self._delta_handler(self.registry.get_metrics())
+            if isinstance(result, AsyncIterable):
+                deltas = [delta async for delta in result]
+            else:
+                deltas = await result
+            self.registry.apply_updates(deltas, logger=self.logger)
+
+    def _new_event_loop(self) -> asyncio.AbstractEventLoop | None:
+        """Return a new event loop, or None to use the default one."""
+        if self.config.event_loop == EventLoop.ASYNCIO:
+            return None
+        try:
+            module = importlib.import_module(self.config.event_loop.value)
+        except ImportError:
+            self.logger.warning(
+                "event loop not available, using default",
+                event_loop=self.config.event_loop,
+            )
+            return None
+        return t.cast(asyncio.AbstractEventLoop, module.new_event_loop())
+
     def _make_application(self) -> Application:
         """Setup the aiohttp Application."""
         app = Application(logger=t.cast(logging.Logger, self.logger))
         app[EXPORTER_APP_KEY] = self
         app.router.add_get("/", self._handle_home)
+        app.router.add_get("/-/healthy", self._handle_healthy)
+        app.router.add_get("/-/ready", self._handle_ready)
         app.router.add_get(self.config.metrics_path, self._handle_metrics)
+        if self.config.debug_cardinality:
+            app.router.add_get("/debug/cardinality", self._handle_cardinality)
         app.on_startup.append(self._log_startup_message)
 
         async def on_prepare(request: Request, response: Response) -> None:
@@ -111,10 +344,28 @@ class PrometheusExporter:
 
     async def _log_startup_message(self, app: Application) -> None:
         """Log message about application startup."""
+        loop = asyncio.get_running_loop()
+        self.logger.info(
+            "event loop", event_loop=type(loop).__module__.partition(".")[0]
+        )
+        protocol = "https" if self.config.ssl_context else "http"
+        if self.config.unix_socket or self._sockets:
+            if self.config.unix_socket:
+                self.logger.info(
+                    "listening",
+                    url=f"{protocol}+unix://{self.config.unix_socket}",
+                )
+            for sock in self._sockets:
+                self.logger.info(
+                    "listening",
+                    url=_socket_url(sock, protocol),
+                    fd=sock.fileno(),
+                )
+            return
+
         for host in self.config.hosts:
             if ":" in host:
                 host = f"[{host}]"
-            protocol = "https" if self.config.ssl_context else "http"
             self.logger.info(
                 "listening", url=f"{protocol}://{host}:{self.config.port}"
             )
@@ -142,8 +393,165 @@ class PrometheusExporter:
         )
         return Response(content_type="text/html", text=text)
 
+    async def _handle_healthy(self, request: Request) -> Response:
+        """Liveness check handler."""
+        return Response(text="OK")
+
+    async def _handle_ready(self, request: Request) -> Response:
+        """Readiness check handler.
+
+        The exporter is ready once metrics have been updated, and (if
+        configured) if the last update is recent enough.
+
+        """
+        if self._last_update is None:
+            return Response(status=503, text="Metrics not collected yet")
+        max_age = self.config.ready_max_age
+        if max_age and time.monotonic() - self._last_update > max_age:
+            return Response(status=503, text="Metrics are stale")
+        return Response(text="OK")
+
+    async def _handle_cardinality(self, request: Request) -> Response:
+        """Handler for metrics cardinality details.
+
+        The `top` query parameter sets how many of the most common values
+        are reported for each label.
+
+        """
+        top = request.query.get("top", "10")
+        if not top.isdecimal():
+            return Response(status=400, text="Invalid top values count")
+        families = self.registry.cardinality(top=int(top))
+        return json_response(
+            {"families": [asdict(family) for family in families]}
+        )
+
     async def _handle_metrics(self, request: Request) -> StreamResponse:
-        """Handler for metrics."""
-        if self._update_handler:
-            await self._update_handler(self.registry.get_metrics())
-        return await self._metrics_handler(request)
+        """Handler for metrics.
+
+        Durations of each phase of the request are recorded for the access
+        log, and optionally returned in the Server-Timing header.
+
+        """
+        timer = _PhaseTimer()
+        request[REQUEST_PHASES_KEY] = timer.phases
+        async with self._admission.admit(request):
+            timer.mark("admission")
+            await self.update_metrics()
+            timer.mark("update")
+            accept = ",".join(request.headers.getall(hdrs.ACCEPT, []))
+            encoder, content_type = choose_encoder(accept)
+            registry: Collector = self.registry.registry
+            if names := request.query.getall("name[]", []):
+                registry = self.registry.registry.restricted_registry(names)
+            families = list(registry.collect())
+            timer.mark("collect")
+            # other formats, and filtered metrics (which would evict cached
+            # series), are encoded by the client library
+            cached_encoder = None if names else self._cached_encoder(encoder)
+            if cached_encoder:
+                body = cached_encoder.encode_metrics(families)
+            else:
+                body = encoder(_CollectedMetrics(families))
+            timer.mark("encode")
+            headers = {
+                hdrs.CONTENT_TYPE: content_type,
+                hdrs.VARY: hdrs.ACCEPT_ENCODING,
+            }
+            if gzip_accepted(request.headers.get(hdrs.ACCEPT_ENCODING, "")):
+                if len(body) > COMPRESS_IN_THREAD_SIZE:
+                    body = await asyncio.to_thread(
+                        gzip.compress, body, COMPRESS_LEVEL
+                    )
+                else:
+                    body = gzip.compress(body, COMPRESS_LEVEL)
+                headers[hdrs.CONTENT_ENCODING] = "gzip"
+                timer.mark("compress")
+            if self.config.server_timing:
+                headers["Server-Timing"] = timer.server_timing()
+            response = Response(body=body, headers=headers)
+            await response.prepare(request)
+            await response.write_eof()
+            timer.mark("write")
+            return response
+
+    def _cached_encoder(
+        self, encoder: Callable[..., bytes]
+    ) -> TextEncoder | OpenMetricsEncoder | None:
+        """Return the caching encoder for a client library one, if any."""
+        if encoder is generate_latest:
+            return self._encoder
+        if (
+            isinstance(encoder, partial)
+            and encoder.func is openmetrics_exposition.generate_latest
+            and encoder.keywords["version"] == "1.0.0"
+        ):
+            escaping = encoder.keywords["escaping"]
+            openmetrics_encoder = self._openmetrics_encoders.get(escaping)
+            if openmetrics_encoder is None:
+                openmetrics_encoder = self._openmetrics_encoders[escaping] = (
+                    OpenMetricsEncoder(escaping=escaping)
+                )
+            return openmetrics_encoder
+        return None
+
+
+class _CollectedMetrics(Collector):
+    """Collector for already collected metrics."""
+
+    def __init__(self, families: list[Metric]) -> None:
+        self.families = families
+
+    def collect(self) -> Iterable[Metric]:
+        return self.families
+
+
+class _PhaseTimer:
+    """Record durations of consecutive phases of a request."""
+
+    def __init__(self) -> None:
+        self.phases: dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def mark(self, phase: str) -> None:
+        """Record the end of a phase, started at the end of the previous one."""
+        now = time.perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def server_timing(self) -> str:
+        """Return the value for a Server-Timing header, in milliseconds."""
+        return ", ".join(
+            f"{phase};dur={duration * 1000:.3f}"
+            for phase, duration in self.phases.items()
+        )
+
+
+def get_systemd_sockets() -> list[socket.socket]:
+    """Return sockets passed by systemd socket activation.
+
+    Environment variables for socket activation are unset, so that they're
+    not inherited by child processes.
+
+    """
+    listen_pid = os.environ.pop("LISTEN_PID", None)
+    listen_fds = os.environ.pop("LISTEN_FDS", None)
+    os.environ.pop("LISTEN_FDNAMES", None)
+    if listen_pid != str(os.getpid()) or not listen_fds:
+        return []
+    return [
+        socket.socket(fileno=fd)
+        for fd in range(
+            SD_LISTEN_FDS_START, SD_LISTEN_FDS_START + int(listen_fds)
+        )
+    ]
+
+
+def _socket_url(sock: socket.socket, protocol: str) -> str:
+    address = sock.getsockname()
+    if sock.family == socket.AF_UNIX:
+        return f"{protocol}+unix://{address}"
+    host, port = address[:2]
+    if ":" in host:
+        host = f"[{host}]"
+    return f"{protocol}://{host}:{port}"
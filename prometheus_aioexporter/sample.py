@@ -1,3 +1,4 @@
+from collections.abc import Mapping
 import random
 import typing as t
 
@@ -40,7 +41,7 @@ class SampleScript(PrometheusExporterScript):
         )
 
     async def _update_handler(
-        self, metrics: dict[str, MetricWrapperBase]
+        self, metrics: Mapping[str, MetricWrapperBase]
     ) -> None:
         gauge = t.cast(Gauge, metrics["a_gauge"])
         gauge.labels(
@@ -0,0 +1,179 @@
+import asyncio
+from collections.abc import Callable, Iterator
+from unittest import mock
+
+from aiohttp.web import HTTPServiceUnavailable, HTTPTooManyRequests
+from prometheus_client import CollectorRegistry
+import pytest
+from pytest_mock import MockerFixture
+
+from prometheus_aioexporter._admission import ScrapeAdmission
+
+
+@pytest.fixture
+def make_request() -> Iterator[Callable[..., mock.Mock]]:
+    def make(
+        remote: str = "10.0.0.1", headers: dict[str, str] | None = None
+    ) -> mock.Mock:
+        return mock.Mock(remote=remote, headers=headers or {})
+
+    yield make
+
+
+async def hold(
+    admission: ScrapeAdmission, request: mock.Mock, event: asyncio.Event
+) -> None:
+    async with admission.admit(request):
+        await event.wait()
+
+
+def sample(admission: ScrapeAdmission, name: str, **labels: str) -> float:
+    registry = CollectorRegistry()
+    registry.register(admission)
+    value = registry.get_sample_value(name, labels)
+    assert value is not None
+    return value
+
+
+class TestScrapeAdmission:
+    async def test_disabled(
+        self, make_request: Callable[..., mock.Mock]
+    ) -> None:
+        admission = ScrapeAdmission()
+        assert not admission.enabled
+        for _ in range(3):
+            async with admission.admit(make_request("10.0.0.1")):
+                pass
+
+    async def test_min_interval(
+        self,
+        mocker: MockerFixture,
+        make_request: Callable[..., mock.Mock],
+    ) -> None:
+        monotonic = mocker.patch("time.monotonic", return_value=100.0)
+        admission = ScrapeAdmission(min_interval=10.0)
+        assert admission.enabled
+        async with admission.admit(make_request("10.0.0.1")):
+            pass
+        # other clients are not limited
+        async with admission.admit(make_request("10.0.0.2")):
+            pass
+        monotonic.return_value = 105.5
+        with pytest.raises(HTTPTooManyRequests) as error:
+            async with admission.admit(make_request("10.0.0.1")):
+                pass
+        assert error.value.headers["Retry-After"] == "5"
+        monotonic.return_value = 110.0
+        async with admission.admit(make_request("10.0.0.1")):
+            pass
+        assert (
+            sample(
+                admission,
+                "exporter_scrapes_rejected_total",
+                reason="rate_limited",
+            )
+            == 1
+        )
+
+    async def test_min_interval_client_header(
+        self,
+        mocker: MockerFixture,
+        make_request: Callable[..., mock.Mock],
+    ) -> None:
+        mocker.patch("time.monotonic", return_value=100.0)
+        admission = ScrapeAdmission(
+            min_interval=10.0, client_header="X-Forwarded-For"
+        )
+        headers = {"X-Forwarded-For": "10.1.0.1, 10.0.0.1"}
+        async with admission.admit(make_request("10.9.0.1", headers)):
+            pass
+        # clients behind the same proxy are limited separately
+        async with admission.admit(
+            make_request("10.9.0.1", {"X-Forwarded-For": "10.0.0.2"})
+        ):
+            pass
+        with pytest.raises(HTTPTooManyRequests):
+            async with admission.admit(
+                make_request("10.9.0.2", {"X-Forwarded-For": "10.0.0.1"})
+            ):
+                pass
+        # the peer address is used without the header
+        async with admission.admit(make_request("10.9.0.1")):
+            pass
+        assert list(admission._last_seen) == [
+            "10.0.0.1",
+            "10.0.0.2",
+            "10.9.0.1",
+        ]
+
+    async def test_min_interval_prune_clients(
+        self,
+        mocker: MockerFixture,
+        make_request: Callable[..., mock.Mock],
+    ) -> None:
+        mocker.patch(
+            "prometheus_aioexporter._admission._MAX_TRACKED_CLIENTS", 3
+        )
+        monotonic = mocker.patch("time.monotonic", return_value=100.0)
+        admission = ScrapeAdmission(min_interval=10.0)
+        for client in ("c1", "c2"):
+            async with admission.admit(make_request(client)):
+                pass
+        monotonic.return_value = 111.0
+        for client in ("c3", "c4"):
+            async with admission.admit(make_request(client)):
+                pass
+        assert list(admission._last_seen) == ["c3", "c4"]
+
+    async def test_concurrency(
+        self, make_request: Callable[..., mock.Mock]
+    ) -> None:
+        admission = ScrapeAdmission(concurrency=2, queue_size=1)
+        event = asyncio.Event()
+        tasks = [
+            asyncio.create_task(hold(admission, make_request(), event))
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0)
+        assert sample(admission, "exporter_scrapes_in_flight") == 2
+        assert sample(admission, "exporter_scrapes_queued") == 1
+        with pytest.raises(HTTPServiceUnavailable) as error:
+            async with admission.admit(make_request()):
+                pass
+        assert error.value.headers["Retry-After"] == "1"
+        event.set()
+        await asyncio.gather(*tasks)
+        assert sample(admission, "exporter_scrapes_in_flight") == 0
+        assert sample(admission, "exporter_scrapes_queued") == 0
+        assert (
+            sample(
+                admission,
+                "exporter_scrapes_rejected_total",
+                reason="queue_full",
+            )
+            == 1
+        )
+
+    async def test_queue_timeout(
+        self, make_request: Callable[..., mock.Mock]
+    ) -> None:
+        admission = ScrapeAdmission(
+            concurrency=1, queue_size=1, queue_timeout=0.01
+        )
+        event = asyncio.Event()
+        task = asyncio.create_task(hold(admission, make_request(), event))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPServiceUnavailable):
+            async with admission.admit(make_request()):
+                pass
+        event.set()
+        await task
+        assert (
+            sample(
+                admission,
+                "exporter_scrapes_rejected_total",
+                reason="queue_timeout",
+            )
+            == 1
+        )
+        assert sample(admission, "exporter_scrapes_queued") == 0
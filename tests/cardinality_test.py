@@ -0,0 +1,557 @@
+import sys
+import typing as t
+
+from prometheus_client import Counter, Enum, Gauge, Histogram
+import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._cardinality import (
+    FamilyCardinality,
+    InternedMetric,
+    LabelCardinality,
+    SeriesBudget,
+    SeriesTotal,
+    TrackedMetric,
+    interned_metric_class,
+    resident_memory,
+    tracked_metric_class,
+)
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+
+
+def make_gauge() -> Gauge:
+    cls = tracked_metric_class(Gauge)
+    return cls("gauge", "A gauge", ["a", "b"], registry=None)
+
+
+def stats(metric: t.Any) -> t.Any:
+    return t.cast(TrackedMetric, metric).series_stats
+
+
+class TestInternedMetric:
+    def test_class(self) -> None:
+        cls = interned_metric_class(Counter)
+        assert issubclass(cls, Counter)
+        assert cls.__name__ == "Counter"
+        assert interned_metric_class(Counter) is cls
+
+    def test_label_values_interned(self) -> None:
+        cls = interned_metric_class(Gauge)
+        gauge = cls("gauge", "A gauge", ["a", "b"], registry=None)
+        first = gauge.labels(a="".join(["x", "y"]), b="1")
+        second = gauge.labels(a="".join(["x", "y"]), b="2")
+        assert first._labelvalues[0] is second._labelvalues[0]
+        # the key is shared with the series
+        [key] = [key for key in gauge._metrics if key[1] == "1"]
+        assert key is first._labelvalues
+
+    def test_clear(self) -> None:
+        cls = interned_metric_class(Gauge)
+        gauge = cls("gauge", "A gauge", ["a"], registry=None)
+        gauge.labels(a="x")
+        gauge.clear()
+        assert gauge._metrics == {}
+        series = gauge.labels(a="".join(["y", "z"]))
+        assert series._labelvalues[0] is sys.intern("yz")
+
+    def test_clear_no_labels(self) -> None:
+        cls = interned_metric_class(Counter)
+        counter = cls("counter", "A counter", registry=None)
+        counter.inc()
+        counter.clear()
+        assert counter._value.get() == 1
+
+
+class TestTrackedMetric:
+    def test_class(self) -> None:
+        cls = tracked_metric_class(Counter)
+        assert issubclass(cls, Counter)
+        assert cls.__name__ == "Counter"
+        assert tracked_metric_class(Counter) is cls
+
+    def test_series_added(self) -> None:
+        gauge = make_gauge()
+        gauge.labels(a="x", b="1").set(1)
+        gauge.labels(a="x", b="2").set(2)
+        gauge.labels(a="y", b="1").set(3)
+        # existing series are not counted again
+        gauge.labels(a="x", b="1").set(4)
+        report = stats(gauge).report("gauge", "gauge", 10)
+        assert report.series == 3
+        assert report.labels == (
+            LabelCardinality(name="a", values=2, top=(("x", 2), ("y", 1))),
+            LabelCardinality(name="b", values=2, top=(("1", 2), ("2", 1))),
+        )
+
+    def test_label_values_interned(self) -> None:
+        gauge = make_gauge()
+        first = gauge.labels(a="".join(["x", "y"]), b="1")
+        second = gauge.labels(a="".join(["x", "y"]), b="2")
+        assert first._labelvalues[0] is second._labelvalues[0]
+        # the key is shared with the series
+        [key] = [key for key in gauge._metrics if key[1] == "1"]
+        assert key is first._labelvalues
+
+    def test_series_removed(self) -> None:
+        gauge = make_gauge()
+        gauge.labels(a="x", b="1")
+        gauge.labels(a="x", b="2")
+        gauge.labels(a="y", b="1")
+        gauge.remove("y", "1")
+        gauge.remove_by_labels({"b": "2"})
+        report = stats(gauge).report("gauge", "gauge", 10)
+        assert report.series == 1
+        assert report.labels == (
+            LabelCardinality(name="a", values=1, top=(("x", 1),)),
+            LabelCardinality(name="b", values=1, top=(("1", 1),)),
+        )
+
+    def test_clear(self) -> None:
+        gauge = make_gauge()
+        gauge.labels(a="x", b="1")
+        gauge.clear()
+        assert stats(gauge).report("gauge", "gauge", 10).series == 0
+        # series are still tracked after clearing
+        gauge.labels(a="y", b="1")
+        assert stats(gauge).report("gauge", "gauge", 10).series == 1
+
+    def test_clear_no_labels(self) -> None:
+        cls = tracked_metric_class(Counter)
+        counter = cls("counter", "A counter", registry=None)
+        counter.clear()
+        report = stats(counter).report("counter", "counter", 10)
+        assert report.series == 1
+        assert report.labels == ()
+
+    def test_child_series_not_tracked(self) -> None:
+        gauge = make_gauge()
+        series = gauge.labels(a="x", b="1")
+        assert not hasattr(series, "series_stats")
+
+    def test_total(self) -> None:
+        total = SeriesTotal()
+        gauge = make_gauge()
+        gauge.labels(a="x", b="1")
+        stats(gauge).set_total(total)
+        assert total.series == 1
+        gauge.labels(a="x", b="2")
+        gauge.labels(a="x", b="3")
+        assert total.series == 3
+        gauge.remove("x", "1")
+        assert total.series == 2
+        gauge.clear()
+        assert total.series == 0
+        gauge.labels(a="x", b="1")
+        # series are removed from the previous total
+        other = SeriesTotal()
+        stats(gauge).set_total(other)
+        assert total.series == 0
+        assert other.series == 1
+        stats(gauge).set_total(None)
+        assert other.series == 0
+
+    def test_enum(self) -> None:
+        cls = tracked_metric_class(Enum)
+        enum = cls("enum", "An enum", ["l"], states=["a", "b"], registry=None)
+        enum.labels(l="x").state("b")
+        assert stats(enum).report("enum", "enum", 10).series == 1
+
+    def test_top(self) -> None:
+        gauge = make_gauge()
+        for b in range(3):
+            gauge.labels(a="x", b=str(b))
+        gauge.labels(a="y", b="0")
+        report = stats(gauge).report("gauge", "gauge", 1)
+        assert report.labels[0].top == (("x", 3),)
+        assert report.labels[1].values == 3
+
+    def test_growth(self) -> None:
+        gauge = make_gauge()
+        gauge.labels(a="x", b="1")
+        gauge.labels(a="x", b="2")
+        assert stats(gauge).report("gauge", "gauge", 10).growth == 2
+        gauge.labels(a="x", b="3")
+        assert stats(gauge).report("gauge", "gauge", 10).growth == 1
+        gauge.remove("x", "1")
+        gauge.remove("x", "2")
+        assert stats(gauge).report("gauge", "gauge", 10).growth == -2
+
+    def test_estimated_bytes(self) -> None:
+        cls = tracked_metric_class(Histogram)
+        histogram = cls("histogram", "A histogram", ["l"], registry=None)
+        assert (
+            stats(histogram).report("h", "histogram", 0).estimated_bytes == 0
+        )
+        histogram.labels(l="a")
+        one = stats(histogram).report("h", "histogram", 0).estimated_bytes
+        histogram.labels(l="b")
+        two = stats(histogram).report("h", "histogram", 0).estimated_bytes
+        assert one > 0
+        assert two == 2 * one
+
+
+class TestMetricsRegistryCardinality:
+    def test_cardinality(self) -> None:
+        registry = MetricsRegistry(track_series=True)
+        metrics = registry.create_metrics(
+            [
+                MetricConfig("counter", "A counter", "counter"),
+                MetricConfig("gauge", "A gauge", "gauge", labels=["l"]),
+                MetricConfig("other", "A gauge", "gauge", labels=["l"]),
+            ]
+        )
+        gauge = t.cast(Gauge, metrics["gauge"])
+        gauge.labels(l="a")
+        gauge.labels(l="b")
+        families = registry.cardinality(top=1)
+        assert [
+            (family.name, family.type, family.series) for family in families
+        ] == [
+            ("gauge", "gauge", 2),
+            ("counter", "counter", 1),
+            ("other", "gauge", 0),
+        ]
+        assert families[0].labels == (
+            LabelCardinality(name="l", values=2, top=(("a", 1),)),
+        )
+        assert all(
+            isinstance(family, FamilyCardinality) for family in families
+        )
+
+    def test_cardinality_lazy(self) -> None:
+        registry = MetricsRegistry(lazy=True, track_series=True)
+        registry.create_metrics(
+            [
+                MetricConfig("counter", "A counter", "counter"),
+                MetricConfig("gauge", "A gauge", "gauge"),
+            ]
+        )
+        registry.get_metric("gauge")
+        # only instantiated metrics are reported
+        assert [family.name for family in registry.cardinality()] == ["gauge"]
+
+    def test_cardinality_reconciled(self) -> None:
+        registry = MetricsRegistry(track_series=True)
+        metrics = registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        t.cast(Gauge, metrics["gauge"]).labels(l="a")
+        registry.reconcile_metrics(
+            [MetricConfig("gauge", "A gauge", "counter", labels=["l"])]
+        )
+        [family] = registry.cardinality()
+        assert family.type == "counter"
+        assert family.series == 0
+
+    def test_not_tracked(self) -> None:
+        registry = MetricsRegistry()
+        metrics = registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        assert not isinstance(metrics["gauge"], TrackedMetric)
+        # label values are interned regardless
+        assert isinstance(metrics["gauge"], InternedMetric)
+        with pytest.raises(ValueError, match="Series tracking is not enabled"):
+            registry.cardinality()
+        with pytest.raises(ValueError, match="Series tracking is not enabled"):
+            registry.set_series_budget(SeriesBudget(max_series=10))
+
+
+class TestSeriesBudget:
+    def test_enabled(self) -> None:
+        assert not SeriesBudget().enabled
+        assert SeriesBudget(max_series=10).enabled
+        assert SeriesBudget(soft_max_memory=10).enabled
+
+    def test_memory_limited(self) -> None:
+        assert not SeriesBudget(max_series=10).memory_limited
+        assert SeriesBudget(max_memory=10).memory_limited
+
+
+class TestResidentMemory:
+    def test_resident_memory(self) -> None:
+        assert resident_memory() > 0
+
+    def test_resident_memory_unknown(self, mocker: MockerFixture) -> None:
+        mocker.patch("builtins.open", side_effect=FileNotFoundError)
+        assert resident_memory() == 0
+
+
+@pytest.fixture
+def budget_registry() -> MetricsRegistry:
+    registry = MetricsRegistry(track_series=True)
+    registry.create_metrics(
+        [
+            MetricConfig("low", "Low priority", "gauge", labels=["l"]),
+            MetricConfig(
+                "high", "High priority", "gauge", labels=["l"], priority=1
+            ),
+            MetricConfig("other", "Other", "gauge", labels=["l"]),
+            MetricConfig("plain", "No labels", "counter"),
+        ]
+    )
+    return registry
+
+
+def add_series(registry: MetricsRegistry, name: str, count: int) -> None:
+    metric = t.cast(Gauge, registry.get_metric(name))
+    for index in range(count):
+        metric.labels(l=f"{name}{index}").set(index)
+
+
+def budget_value(
+    registry: MetricsRegistry, name: str, labels: dict[str, str] | None = None
+) -> float | None:
+    return registry.registry.get_sample_value(name, labels)
+
+
+class TestMetricsRegistrySeriesBudget:
+    def test_hard_limit(self, budget_registry: MetricsRegistry) -> None:
+        budget_registry.set_series_budget(SeriesBudget(max_series=4))
+        add_series(budget_registry, "low", 5)
+        gauge = t.cast(Gauge, budget_registry.get_metric("low"))
+        # the unlabeled metric counts as a series
+        assert len(gauge._metrics) == 3
+        # refused series can be updated, but values are discarded
+        gauge.labels(l="low4").set(10)
+        assert budget_value(budget_registry, "low", {"l": "low4"}) is None
+        # existing series are still updated
+        gauge.labels(l="low0").set(10)
+        assert budget_value(budget_registry, "low", {"l": "low0"}) == 10
+        assert (
+            budget_value(
+                budget_registry, "exporter_budget_refused_series_total"
+            )
+            == 3
+        )
+
+    def test_hard_limit_new_metrics(self) -> None:
+        registry = MetricsRegistry(lazy=True, track_series=True)
+        registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        registry.set_series_budget(SeriesBudget(max_series=1))
+        add_series(registry, "gauge", 2)
+        gauge = t.cast(Gauge, registry.get_metric("gauge"))
+        assert list(gauge._metrics) == [("gauge0",)]
+
+    def test_memory_hard_limit(
+        self, mocker: MockerFixture, budget_registry: MetricsRegistry
+    ) -> None:
+        mocker.patch(
+            "prometheus_aioexporter._metric.resident_memory",
+            return_value=2000,
+        )
+        budget_registry.set_series_budget(SeriesBudget(max_memory=1000))
+        add_series(budget_registry, "low", 1)
+        budget_registry.enforce_series_budget()
+        add_series(budget_registry, "other", 1)
+        assert len(budget_registry.get_metric("low")._metrics) == 1
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        assert budget_value(
+            budget_registry, "exporter_budget_memory_bytes"
+        ) == (2000)
+
+    def test_soft_limit_sheds(
+        self, log: StructuredLogCapture, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(soft_max_series=9))
+        add_series(budget_registry, "low", 3)
+        add_series(budget_registry, "high", 5)
+        add_series(budget_registry, "other", 4)
+        budget_registry.enforce_series_budget()
+        # metrics with lowest priority, and then most series, are shed
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        assert len(budget_registry.get_metric("low")._metrics) == 3
+        assert log.has(
+            "series budget exceeded",
+            series=9,
+            memory=0,
+            shed=["other"],
+            level="warning",
+        )
+        # new series for shed metrics are refused
+        add_series(budget_registry, "other", 1)
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        assert (
+            budget_value(budget_registry, "exporter_budget_shed_metrics") == 1
+        )
+
+    def test_soft_limit_sheds_by_priority(
+        self, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(soft_max_series=3))
+        add_series(budget_registry, "low", 2)
+        add_series(budget_registry, "high", 3)
+        add_series(budget_registry, "other", 1)
+        budget_registry.enforce_series_budget()
+        assert len(budget_registry.get_metric("low")._metrics) == 0
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        assert len(budget_registry.get_metric("high")._metrics) == 0
+
+    def test_soft_memory_limit(
+        self, mocker: MockerFixture, budget_registry: MetricsRegistry
+    ) -> None:
+        memory = mocker.patch(
+            "prometheus_aioexporter._metric.resident_memory",
+            return_value=1000,
+        )
+        budget_registry.set_series_budget(
+            SeriesBudget(soft_max_memory=1_000_000)
+        )
+        add_series(budget_registry, "low", 1)
+        add_series(budget_registry, "other", 2)
+        memory.return_value = 1_000_001
+        budget_registry.enforce_series_budget()
+        # a single metric is enough to get back within the limit
+        assert len(budget_registry.get_metric("low")._metrics) == 1
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        # the metric is restored once it's expected to fit again
+        memory.return_value = 999_999
+        budget_registry.enforce_series_budget()
+        add_series(budget_registry, "other", 2)
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        memory.return_value = 100_000
+        budget_registry.enforce_series_budget()
+        add_series(budget_registry, "other", 2)
+        assert len(budget_registry.get_metric("other")._metrics) == 2
+
+    def test_restore(
+        self, log: StructuredLogCapture, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(soft_max_series=5))
+        add_series(budget_registry, "low", 2)
+        add_series(budget_registry, "other", 4)
+        budget_registry.enforce_series_budget()
+        assert len(budget_registry.get_metric("other")._metrics) == 0
+        # the metric doesn't fit yet
+        budget_registry.enforce_series_budget()
+        assert not log.has("shed metrics restored")
+        budget_registry.get_metric("low").clear()
+        budget_registry.enforce_series_budget()
+        assert log.has(
+            "shed metrics restored", restored=["other"], level="info"
+        )
+        add_series(budget_registry, "other", 4)
+        assert len(budget_registry.get_metric("other")._metrics) == 4
+        assert (
+            budget_value(budget_registry, "exporter_budget_shed_metrics") == 0
+        )
+
+    def test_hard_limit_double_buffered(self) -> None:
+        registry = MetricsRegistry(double_buffered=True, track_series=True)
+        registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        registry.set_series_budget(SeriesBudget(max_series=10))
+        for _ in range(3):
+            generation = registry.start_generation()
+            gauge = t.cast(Gauge, generation["gauge"])
+            for index in range(20):
+                gauge.labels(l=str(index)).set(index)
+            # series in the generation being filled are limited
+            assert len(gauge._metrics) == 10
+            registry.publish_generation(generation)
+            assert budget_value(registry, "exporter_budget_series") == 10
+
+    def test_hard_limit_reconciled(
+        self, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(max_series=4))
+        add_series(budget_registry, "other", 3)
+        budget_registry.reconcile_metrics([], managed=["other"])
+        # series from removed metrics are not counted
+        add_series(budget_registry, "low", 3)
+        gauge = t.cast(Gauge, budget_registry.get_metric("low"))
+        assert len(gauge._metrics) == 3
+        assert budget_value(budget_registry, "exporter_budget_series") == 4
+
+    def test_hard_limit_reconcile_rollback(
+        self, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(max_series=4))
+        add_series(budget_registry, "other", 3)
+        with pytest.raises(ValueError):
+            budget_registry.reconcile_metrics(
+                [
+                    MetricConfig(
+                        "enum", "An enum", "enum", config={"states": []}
+                    )
+                ],
+                managed=["other", "enum"],
+            )
+        # series from restored metrics are still counted, along with the
+        # one for the metric without labels
+        assert budget_value(budget_registry, "exporter_budget_series") == 4
+
+    def test_shed_metric_reconciled(
+        self, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(soft_max_series=2))
+        add_series(budget_registry, "other", 3)
+        budget_registry.enforce_series_budget()
+        budget_registry.reconcile_metrics(
+            [MetricConfig("other", "Other", "counter", labels=["l"])],
+            managed=["other"],
+        )
+        budget_registry.enforce_series_budget()
+        assert (
+            budget_value(budget_registry, "exporter_budget_shed_metrics") == 0
+        )
+
+    def test_shed_double_buffered(self) -> None:
+        registry = MetricsRegistry(double_buffered=True, track_series=True)
+        registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        registry.set_series_budget(SeriesBudget(soft_max_series=2))
+        generation = registry.start_generation()
+        for value in ("a", "b", "c"):
+            t.cast(Gauge, generation["gauge"]).labels(l=value)
+        registry.publish_generation(generation)
+        registry.enforce_series_budget()
+        # the metric is still shed in following generations
+        generation = registry.start_generation()
+        t.cast(Gauge, generation["gauge"]).labels(l="a")
+        assert generation["gauge"]._metrics == {}
+        registry.publish_generation(generation)
+        registry.enforce_series_budget()
+        assert budget_value(registry, "exporter_budget_shed_metrics") == 1
+
+    def test_enforce_no_budget(self, budget_registry: MetricsRegistry) -> None:
+        add_series(budget_registry, "low", 3)
+        budget_registry.enforce_series_budget()
+        assert len(budget_registry.get_metric("low")._metrics) == 3
+
+    def test_metrics(self, budget_registry: MetricsRegistry) -> None:
+        budget_registry.set_series_budget(
+            SeriesBudget(
+                soft_max_series=10,
+                max_series=20,
+                soft_max_memory=1000,
+                max_memory=2000,
+            )
+        )
+        add_series(budget_registry, "low", 2)
+        value = budget_registry.registry.get_sample_value
+        assert value("exporter_budget_series") == 3
+        assert value("exporter_budget_series_limit", {"limit": "soft"}) == 10
+        assert value("exporter_budget_series_limit", {"limit": "hard"}) == 20
+        assert (
+            value("exporter_budget_memory_limit_bytes", {"limit": "soft"})
+            == 1000
+        )
+        assert (
+            value("exporter_budget_memory_limit_bytes", {"limit": "hard"})
+            == 2000
+        )
+        assert value("exporter_budget_refused_series_total") == 0
+
+    def test_metrics_limits_disabled(
+        self, budget_registry: MetricsRegistry
+    ) -> None:
+        budget_registry.set_series_budget(SeriesBudget(max_series=20))
+        value = budget_registry.registry.get_sample_value
+        assert value("exporter_budget_series_limit", {"limit": "soft"}) is None
+        assert value("exporter_budget_series_limit", {"limit": "hard"}) == 20
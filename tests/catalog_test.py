@@ -0,0 +1,461 @@
+import asyncio
+from collections.abc import Callable, Iterator
+import json
+import os
+from pathlib import Path
+import signal
+from textwrap import dedent
+import typing as t
+
+from aiohttp.web import Application
+from prometheus_client import Gauge
+import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._catalog import (
+    InvalidMetricsConfig,
+    MetricsConfigReloader,
+    load_metric_configs,
+)
+from prometheus_aioexporter._metric import (
+    MetricChanges,
+    MetricConfig,
+    MetricsRegistry,
+)
+
+WriteConfig = Callable[[t.Any], Path]
+
+
+@pytest.fixture
+def write_config(tmp_path: Path) -> Iterator[WriteConfig]:
+    def write(data: t.Any) -> Path:
+        path = tmp_path / "metrics.json"
+        path.write_text(json.dumps(data))
+        return path
+
+    yield write
+
+
+class TestLoadMetricConfigs:
+    def test_load_json(self, write_config: WriteConfig) -> None:
+        path = write_config(
+            {
+                "metrics": [
+                    {"name": "m1", "description": "desc1", "type": "gauge"},
+                    {
+                        "name": "m2",
+                        "description": "desc2",
+                        "type": "histogram",
+                        "labels": ["foo", "bar"],
+                        "config": {"buckets": [10, 20]},
+                        "priority": 2,
+                    },
+                ]
+            }
+        )
+        assert load_metric_configs(path) == [
+            MetricConfig("m1", "desc1", "gauge"),
+            MetricConfig(
+                "m2",
+                "desc2",
+                "histogram",
+                labels=("bar", "foo"),
+                config={"buckets": [10, 20]},
+                priority=2,
+            ),
+        ]
+
+    def test_load_yaml(self, tmp_path: Path) -> None:
+        path = tmp_path / "metrics.yaml"
+        path.write_text(
+            dedent(
+                """\
+                metrics:
+                  - name: m1
+                    description: desc1
+                    type: counter
+                    labels: [foo]
+                """
+            )
+        )
+        assert load_metric_configs(path) == [
+            MetricConfig("m1", "desc1", "counter", labels=("foo",))
+        ]
+
+    def test_load_toml(self, tmp_path: Path) -> None:
+        path = tmp_path / "metrics.toml"
+        path.write_text(
+            dedent(
+                """\
+                [[metrics]]
+                name = "m1"
+                description = "desc1"
+                type = "enum"
+                config = { states = ["on", "off"] }
+                """
+            )
+        )
+        assert load_metric_configs(path) == [
+            MetricConfig(
+                "m1", "desc1", "enum", config={"states": ["on", "off"]}
+            )
+        ]
+
+    def test_unsupported_extension(self, tmp_path: Path) -> None:
+        path = tmp_path / "metrics.ini"
+        path.write_text("")
+        with pytest.raises(InvalidMetricsConfig) as error:
+            load_metric_configs(path)
+        assert str(error.value) == (
+            f"Invalid metrics config {path}: unsupported file extension, "
+            "must be one of .json, .toml, .yaml, .yml"
+        )
+
+    def test_parse_error(self, tmp_path: Path) -> None:
+        path = tmp_path / "metrics.json"
+        path.write_text("{not json")
+        with pytest.raises(InvalidMetricsConfig) as error:
+            load_metric_configs(path)
+        assert "parse error" in error.value.details
+        assert isinstance(error.value.__cause__, json.JSONDecodeError)
+
+    @pytest.mark.parametrize("data", [[], {}, {"metrics": {}}])
+    def test_no_metrics_list(
+        self, write_config: WriteConfig, data: t.Any
+    ) -> None:
+        with pytest.raises(InvalidMetricsConfig) as error:
+            load_metric_configs(write_config(data))
+        assert error.value.details == "must contain a 'metrics' list"
+
+    @pytest.mark.parametrize(
+        "entry,details",
+        [
+            ("m1", "must be a mapping"),
+            ({"name": "m1"}, "missing keys: description, type"),
+            (
+                {"name": "m1", "description": "d", "type": "gauge", "x": 1},
+                "unknown keys: x",
+            ),
+            (
+                {"name": "no-dash", "description": "d", "type": "gauge"},
+                "invalid name: 'no-dash'",
+            ),
+            (
+                {"name": "m1", "description": 3, "type": "gauge"},
+                "description must be a string",
+            ),
+            (
+                {"name": "m1", "description": "d", "type": ["gauge"]},
+                "type must be a string",
+            ),
+            (
+                {
+                    "name": "m1",
+                    "description": "d",
+                    "type": "gauge",
+                    "labels": ["1abc"],
+                },
+                "labels must be a list of valid label names",
+            ),
+            (
+                {
+                    "name": "m1",
+                    "description": "d",
+                    "type": "gauge",
+                    "config": [],
+                },
+                "config must be a mapping",
+            ),
+            (
+                {
+                    "name": "m1",
+                    "description": "d",
+                    "type": "gauge",
+                    "priority": True,
+                },
+                "priority must be an integer",
+            ),
+            (
+                {"name": "m1", "description": "d", "type": "unknown"},
+                "Invalid type for m1: must be one of counter, enum, "
+                "gauge, histogram, info, summary",
+            ),
+        ],
+    )
+    def test_invalid_entry(
+        self, write_config: WriteConfig, entry: t.Any, details: str
+    ) -> None:
+        with pytest.raises(InvalidMetricsConfig) as error:
+            load_metric_configs(write_config({"metrics": [entry]}))
+        assert error.value.details == f"metric #0: {details}"
+
+    def test_duplicated_name(self, write_config: WriteConfig) -> None:
+        entry = {"name": "m1", "description": "d", "type": "gauge"}
+        with pytest.raises(InvalidMetricsConfig) as error:
+            load_metric_configs(write_config({"metrics": [entry, entry]}))
+        assert error.value.details == "duplicated metric name: m1"
+
+    def test_cache(
+        self, tmp_path: Path, mocker: MockerFixture, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        path = write_config(
+            {"metrics": [{"name": "m1", "description": "d", "type": "gauge"}]}
+        )
+        configs = load_metric_configs(path, cache_dir=cache_dir)
+        [cache_file] = cache_dir.iterdir()
+        assert cache_file.suffix == ".json"
+        parse = mocker.patch(
+            "prometheus_aioexporter._catalog._parse_metric_configs"
+        )
+        assert load_metric_configs(path, cache_dir=cache_dir) == configs
+        parse.assert_not_called()
+
+    def test_cache_changed_file(
+        self, tmp_path: Path, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        entry = {"name": "m1", "description": "d", "type": "gauge"}
+        load_metric_configs(
+            write_config({"metrics": [entry]}), cache_dir=cache_dir
+        )
+        entry["name"] = "m2"
+        [config] = load_metric_configs(
+            write_config({"metrics": [entry]}), cache_dir=cache_dir
+        )
+        assert config.name == "m2"
+        # the entry for the previous content is removed
+        [cache_file] = cache_dir.iterdir()
+        assert json.loads(cache_file.read_text())[0]["name"] == "m2"
+
+    def test_cache_other_files_kept(
+        self, tmp_path: Path, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        cache_dir.mkdir()
+        (cache_dir / "metrics-v2-old.json").write_text("[]")
+        (cache_dir / "other.json").write_text("[]")
+        load_metric_configs(
+            write_config(
+                {
+                    "metrics": [
+                        {"name": "m1", "description": "d", "type": "gauge"}
+                    ]
+                }
+            ),
+            cache_dir=cache_dir,
+        )
+        assert len(list(cache_dir.iterdir())) == 3
+
+    def test_cache_prune_error(
+        self, tmp_path: Path, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        # an entry that can't be removed
+        (cache_dir / "metrics-v3-old.json").mkdir(parents=True)
+        [config] = load_metric_configs(
+            write_config(
+                {
+                    "metrics": [
+                        {"name": "m1", "description": "d", "type": "gauge"}
+                    ]
+                }
+            ),
+            cache_dir=cache_dir,
+        )
+        assert config.name == "m1"
+        assert len(list(cache_dir.iterdir())) == 2
+
+    @pytest.mark.parametrize(
+        "content",
+        [
+            b"garbage",
+            b"\x80\x04N.",
+            b"{}",
+            b"[{}]",
+            b'[{"name": "m1", "description": "d", "type": "unknown"}]',
+        ],
+    )
+    def test_cache_invalid(
+        self, tmp_path: Path, write_config: WriteConfig, content: bytes
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        path = write_config(
+            {"metrics": [{"name": "m1", "description": "d", "type": "gauge"}]}
+        )
+        load_metric_configs(path, cache_dir=cache_dir)
+        [cache_file] = cache_dir.iterdir()
+        cache_file.write_bytes(content)
+        [config] = load_metric_configs(path, cache_dir=cache_dir)
+        assert config.name == "m1"
+
+    def test_cache_not_writable(
+        self, tmp_path: Path, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        cache_dir.write_text("not a directory")
+        path = write_config(
+            {"metrics": [{"name": "m1", "description": "d", "type": "gauge"}]}
+        )
+        [config] = load_metric_configs(path, cache_dir=cache_dir)
+        assert config.name == "m1"
+
+    def test_cache_config_values(
+        self, tmp_path: Path, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        entry = {
+            "name": "m1",
+            "description": "d",
+            "type": "histogram",
+            "labels": ["l2", "l1"],
+            "config": {"buckets": [0.1, 1.0]},
+            "priority": 2,
+        }
+        path = write_config({"metrics": [entry]})
+        configs = load_metric_configs(path, cache_dir=cache_dir)
+        assert load_metric_configs(path, cache_dir=cache_dir) == configs
+
+    def test_cache_not_serializable(
+        self, tmp_path: Path, mocker: MockerFixture, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        path = write_config(
+            {"metrics": [{"name": "m1", "description": "d", "type": "gauge"}]}
+        )
+        mocker.patch(
+            "prometheus_aioexporter._catalog._parse_metric_configs",
+            return_value=[
+                MetricConfig("m1", "d", "gauge", config={"value": object()})
+            ],
+        )
+        [config] = load_metric_configs(path, cache_dir=cache_dir)
+        assert config.name == "m1"
+        assert list(cache_dir.iterdir()) == []
+
+    def test_cache_write_error(
+        self, tmp_path: Path, mocker: MockerFixture, write_config: WriteConfig
+    ) -> None:
+        cache_dir = tmp_path / "cache"
+        mocker.patch("os.replace", side_effect=OSError)
+        path = write_config(
+            {"metrics": [{"name": "m1", "description": "d", "type": "gauge"}]}
+        )
+        [config] = load_metric_configs(path, cache_dir=cache_dir)
+        assert config.name == "m1"
+        assert list(cache_dir.iterdir()) == []
+
+
+def metrics_config(*names: str) -> dict[str, t.Any]:
+    return {
+        "metrics": [
+            {"name": name, "description": "a gauge", "type": "gauge"}
+            for name in names
+        ]
+    }
+
+
+class TestMetricsConfigReloader:
+    def test_load(self, write_config: WriteConfig) -> None:
+        registry = MetricsRegistry()
+        reloader = MetricsConfigReloader(
+            registry, write_config(metrics_config("m1", "m2"))
+        )
+        assert reloader.load() == MetricChanges(added=("m1", "m2"))
+        assert list(registry.get_metrics()) == ["m1", "m2"]
+
+    async def test_reload(
+        self, log: StructuredLogCapture, write_config: WriteConfig
+    ) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("other", "other", "gauge")])
+        reloader = MetricsConfigReloader(
+            registry, write_config(metrics_config("m1", "m2"))
+        )
+        reloader.load()
+        gauge = t.cast(Gauge, registry.get_metric("m1"))
+        gauge.set(3)
+        write_config(metrics_config("m1", "m3"))
+        await reloader.reload()
+        assert list(registry.get_metrics()) == ["other", "m1", "m3"]
+        assert registry.registry.get_sample_value("m1") == 3
+        assert log.has(
+            "metrics config reloaded",
+            added=("m3",),
+            updated=(),
+            removed=("m2",),
+            level="info",
+        )
+
+    async def test_reload_error(
+        self, log: StructuredLogCapture, write_config: WriteConfig
+    ) -> None:
+        registry = MetricsRegistry()
+        path = write_config(metrics_config("m1"))
+        reloader = MetricsConfigReloader(registry, path)
+        reloader.load()
+        path.write_text("{invalid")
+        await reloader.reload()
+        assert list(registry.get_metrics()) == ["m1"]
+        assert log.has(
+            "metrics config reload failed", path=str(path), level="error"
+        )
+
+    async def test_reload_on_sighup(self, write_config: WriteConfig) -> None:
+        registry = MetricsRegistry()
+        reloader = MetricsConfigReloader(
+            registry, write_config(metrics_config("m1"))
+        )
+        reloader.load()
+        app = Application()
+        await reloader.start(app)
+        write_config(metrics_config("m2"))
+        os.kill(os.getpid(), signal.SIGHUP)
+        for _ in range(100):
+            if "m2" in registry.get_metrics():
+                break
+            await asyncio.sleep(0.01)
+        await reloader.stop(app)
+        assert list(registry.get_metrics()) == ["m2"]
+
+    async def test_reload_on_file_change(
+        self, write_config: WriteConfig
+    ) -> None:
+        registry = MetricsRegistry()
+        path = write_config(metrics_config("m1"))
+        reloader = MetricsConfigReloader(registry, path, watch_interval=0.01)
+        reloader.load()
+        app = Application()
+        await reloader.start(app)
+        path.unlink()
+        await asyncio.sleep(0.05)
+        # the file being missing is logged as a failed reload
+        assert list(registry.get_metrics()) == ["m1"]
+        write_config(metrics_config("m2", "m3"))
+        for _ in range(100):
+            if "m3" in registry.get_metrics():
+                break
+            await asyncio.sleep(0.01)
+        await reloader.stop(app)
+        assert list(registry.get_metrics()) == ["m2", "m3"]
+
+    async def test_reload_on_file_change_failed_once(
+        self, log: StructuredLogCapture, write_config: WriteConfig
+    ) -> None:
+        registry = MetricsRegistry()
+        path = write_config(metrics_config("m1"))
+        reloader = MetricsConfigReloader(registry, path, watch_interval=0.01)
+        reloader.load()
+        app = Application()
+        await reloader.start(app)
+        path.write_text("{invalid content")
+        await asyncio.sleep(0.1)
+        await reloader.stop(app)
+        # a failing change is only attempted once
+        failures = [
+            event
+            for event in log.events
+            if event["event"] == "metrics config reload failed"
+        ]
+        assert len(failures) == 1
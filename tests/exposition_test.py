@@ -0,0 +1,184 @@
+from collections.abc import Iterator
+import typing as t
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Enum,
+    Gauge,
+    Histogram,
+    Info,
+    Summary,
+    generate_latest,
+)
+from prometheus_client.core import (
+    CounterMetricFamily,
+    GaugeHistogramMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+    Metric,
+)
+from prometheus_client.openmetrics.exposition import (
+    ALLOWUTF8,
+    DOTS,
+    UNDERSCORES,
+    generate_latest as generate_latest_openmetrics,
+)
+from prometheus_client.samples import Exemplar, NativeHistogram, Sample
+import pytest
+
+from prometheus_aioexporter._exposition import OpenMetricsEncoder, TextEncoder
+
+# samples without a value, which the client library allows despite types
+NO_VALUE = t.cast(float, None)
+
+
+class SampleCollector:
+    def collect(self) -> Iterator[Metric]:
+        yield GaugeHistogramMetricFamily(
+            "gauge_histogram",
+            "A gauge histogram",
+            buckets=[("1.0", 2), ("+Inf", 3)],
+            gsum_value=4,
+        )
+        gauge = GaugeMetricFamily(
+            "timestamped", "A timestamped gauge", labels=["l"]
+        )
+        gauge.add_metric(["a"], 3, timestamp=12.5)
+        yield gauge
+        yield Metric("untyped", "An untyped metric", "unknown")
+        yield Metric("utf8.name", "A metric with UTF-8 name", "gauge")
+
+
+class OpenMetricsCollector:
+    """Collector with samples specific to OpenMetrics."""
+
+    def collect(self) -> Iterator[Metric]:
+        yield GaugeMetricFamily(
+            "temperature", "A temperature", value=20, unit="celsius"
+        )
+        counter = CounterMetricFamily("requests", "Requests", labels=["l"])
+        counter.add_metric(["a"], 1)
+        counter.samples.append(
+            Sample(
+                "requests_total",
+                {"l": "b"},
+                2,
+                exemplar=Exemplar({"trace": "abc"}, 1.0, 1.5),
+            )
+        )
+        yield counter
+        histogram = HistogramMetricFamily("native", "A native histogram")
+        histogram.samples.append(
+            Sample(
+                "native",
+                {},
+                NO_VALUE,
+                native_histogram=NativeHistogram(1, 1.0, 0, 0.0, 0),
+            )
+        )
+        histogram.samples.append(Sample("native_count", {}, NO_VALUE))
+        yield histogram
+        utf8 = GaugeMetricFamily(
+            "utf8.labelled", "A labelled metric", labels=["l.abel"]
+        )
+        utf8.add_metric(["a"], 1)
+        yield utf8
+
+
+@pytest.fixture
+def registry() -> CollectorRegistry:
+    registry = CollectorRegistry()
+    counter = Counter(
+        "counter",
+        "A counter\\ with\nnewline",
+        ["b", "a"],
+        registry=registry,
+    )
+    counter.labels(b='quote"\nnewline\\', a="x").inc()
+    Histogram("histogram", "A histogram", registry=registry).observe(1)
+    Summary("summary", "A summary", ["l"], registry=registry).labels(
+        "v"
+    ).observe(2)
+    Info("info", "An info", registry=registry).info({"version": "1.0"})
+    Enum("enum", "An enum", states=["on", "off"], registry=registry)
+    Gauge("gauge", "A gauge", registry=registry).set(float("inf"))
+    registry.register(SampleCollector())
+    return registry
+
+
+@pytest.fixture
+def openmetrics_registry(registry: CollectorRegistry) -> CollectorRegistry:
+    registry.register(OpenMetricsCollector())
+    return registry
+
+
+class TestTextEncoder:
+    def test_encode(self, registry: CollectorRegistry) -> None:
+        encoder = TextEncoder()
+        assert encoder.encode(registry) == generate_latest(registry)
+
+    def test_encode_cached(self, registry: CollectorRegistry) -> None:
+        encoder = TextEncoder()
+        encoder.encode(registry)
+        prefixes = dict(encoder._prefixes)
+        assert encoder.encode(registry) == generate_latest(registry)
+        assert encoder._prefixes == prefixes
+
+    def test_encode_changed_series(self) -> None:
+        registry = CollectorRegistry()
+        gauge = Gauge("gauge", "A gauge", ["l"], registry=registry)
+        encoder = TextEncoder()
+        for i in range(10):
+            gauge.clear()
+            gauge.labels(str(i)).set(i)
+            assert encoder.encode(registry) == generate_latest(registry)
+        # prefixes for removed series are eventually dropped
+        assert len(encoder._prefixes) <= 2
+
+    def test_encode_changed_families(self) -> None:
+        registry = CollectorRegistry()
+        encoder = TextEncoder()
+        for i in range(10):
+            gauge = Gauge(f"gauge{i}", "A gauge", registry=registry)
+            assert encoder.encode(registry) == generate_latest(registry)
+            registry.unregister(gauge)
+        assert len(encoder._headers) <= 2
+
+
+class TestOpenMetricsEncoder:
+    @pytest.mark.parametrize("escaping", [UNDERSCORES, ALLOWUTF8, DOTS])
+    def test_encode(
+        self, openmetrics_registry: CollectorRegistry, escaping: str
+    ) -> None:
+        encoder = OpenMetricsEncoder(escaping=escaping)
+        assert encoder.encode(
+            openmetrics_registry
+        ) == generate_latest_openmetrics(
+            openmetrics_registry, escaping=escaping
+        )
+
+    def test_encode_cached(
+        self, openmetrics_registry: CollectorRegistry
+    ) -> None:
+        encoder = OpenMetricsEncoder()
+        encoder.encode(openmetrics_registry)
+        prefixes = dict(encoder._prefixes)
+        headers = dict(encoder._headers)
+        assert encoder.encode(
+            openmetrics_registry
+        ) == generate_latest_openmetrics(openmetrics_registry)
+        assert encoder._prefixes == prefixes
+        assert encoder._headers == headers
+
+    def test_encode_changed_series(self) -> None:
+        registry = CollectorRegistry()
+        gauge = Gauge("gauge", "A gauge", ["l"], registry=registry)
+        encoder = OpenMetricsEncoder()
+        for i in range(10):
+            gauge.clear()
+            gauge.labels(str(i)).set(i)
+            assert encoder.encode(registry) == generate_latest_openmetrics(
+                registry
+            )
+        assert len(encoder._prefixes) <= 2
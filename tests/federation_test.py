@@ -0,0 +1,257 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Iterator
+from textwrap import dedent
+import typing as t
+
+from aiohttp.test_utils import TestServer
+from aiohttp.web import Application, Request, Response
+from prometheus_client import CollectorRegistry, Gauge, generate_latest
+import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._federation import FederationCollector
+
+AiohttpServerFixture = Callable[..., Awaitable[TestServer]]
+
+
+class Upstream:
+    """A stand-in upstream exporter."""
+
+    def __init__(self, text: str, status: int = 200, delay: float = 0.0):
+        self.text = dedent(text)
+        self.status = status
+        self.delay = delay
+        self.scrapes = 0
+
+    async def handle(self, request: Request) -> Response:
+        self.scrapes += 1
+        await asyncio.sleep(self.delay)
+        return Response(status=self.status, text=self.text)
+
+
+@pytest.fixture
+def make_upstream(
+    aiohttp_server: AiohttpServerFixture,
+) -> Iterator[Callable[..., Awaitable[tuple[Upstream, str]]]]:
+    async def make(*args: t.Any, **kwargs: t.Any) -> tuple[Upstream, str]:
+        upstream = Upstream(*args, **kwargs)
+        app = Application()
+        app.router.add_get("/metrics", upstream.handle)
+        server = await aiohttp_server(app)
+        return upstream, str(server.make_url("/metrics"))
+
+    yield make
+
+
+UPSTREAM_A = """\
+    # HELP requests_total Requests
+    # TYPE requests_total counter
+    requests_total{path="/"} 3.0
+    # HELP temperature Temperature
+    # TYPE temperature gauge
+    temperature 20.5
+    """
+
+UPSTREAM_B = """\
+    # HELP requests_total Requests
+    # TYPE requests_total counter
+    requests_total{path="/"} 5.0
+    # HELP temperature Temperature
+    # TYPE temperature counter
+    temperature 1.0
+    """
+
+
+async def start_collector(collector: FederationCollector) -> Application:
+    """Start the collector, waiting for the first scrape of upstreams."""
+    app = Application()
+    await collector.start(app)
+    for _ in range(100):
+        if all(state.duration for state in collector._states.values()):
+            break
+        await asyncio.sleep(0.01)
+    return app
+
+
+def collect(collector: FederationCollector) -> CollectorRegistry:
+    registry = CollectorRegistry()
+    registry.register(collector)
+    return registry
+
+
+class TestFederationCollector:
+    async def test_refresh_merge(
+        self,
+        log: StructuredLogCapture,
+        make_upstream: Callable[..., Awaitable[tuple[Upstream, str]]],
+    ) -> None:
+        _, url_a = await make_upstream(UPSTREAM_A)
+        _, url_b = await make_upstream(UPSTREAM_B)
+        collector = FederationCollector({"a": url_a, "b": url_b})
+        app = await start_collector(collector)
+        await collector.stop(app)
+        registry = collect(collector)
+        for upstream, value in [("a", 3.0), ("b", 5.0)]:
+            assert (
+                registry.get_sample_value(
+                    "requests_total", {"path": "/", "upstream": upstream}
+                )
+                == value
+            )
+            assert (
+                registry.get_sample_value(
+                    "exporter_federation_upstream_up", {"upstream": upstream}
+                )
+                == 1
+            )
+        assert (
+            registry.get_sample_value("temperature", {"upstream": "a"}) == 20.5
+        )
+        # the metric with a conflicting type is skipped
+        assert (
+            registry.get_sample_value("temperature_total", {"upstream": "b"})
+            is None
+        )
+        output = generate_latest(registry).decode()
+        assert output.count("# TYPE requests_total counter") == 1
+        # the conflict is only logged once
+        generate_latest(registry)
+        conflicts = [
+            (event["upstream"], event["metric"], event["reason"])
+            for event in log.events
+            if event["event"] == "federated metric skipped"
+        ]
+        assert conflicts == [("b", "temperature", "type conflict")]
+
+    async def test_refresh_local_metric(
+        self,
+        log: StructuredLogCapture,
+        make_upstream: Callable[..., Awaitable[tuple[Upstream, str]]],
+    ) -> None:
+        _, url = await make_upstream(UPSTREAM_A)
+        registry = CollectorRegistry(auto_describe=True)
+        Gauge("temperature", "Local temperature", registry=registry).set(18)
+        collector = FederationCollector({"a": url}, registry=registry)
+        registry.register(collector)
+        app = await start_collector(collector)
+        await collector.stop(app)
+        output = generate_latest(registry).decode()
+        # the upstream metric colliding with the local one is skipped
+        assert output.count("# TYPE temperature gauge") == 1
+        assert registry.get_sample_value("temperature") == 18
+        assert (
+            registry.get_sample_value("temperature", {"upstream": "a"}) is None
+        )
+        assert (
+            registry.get_sample_value(
+                "requests_total", {"path": "/", "upstream": "a"}
+            )
+            == 3.0
+        )
+        assert log.has(
+            "federated metric skipped",
+            upstream="a",
+            metric="temperature",
+            reason="local metric",
+            level="warning",
+        )
+
+    async def test_refresh_periodically(
+        self, make_upstream: Callable[..., Awaitable[tuple[Upstream, str]]]
+    ) -> None:
+        upstream, url = await make_upstream(UPSTREAM_A)
+        collector = FederationCollector(
+            {"a": url}, label="instance", interval=0.01
+        )
+        app = Application()
+        await collector.start(app)
+        for _ in range(100):
+            if upstream.scrapes >= 2:
+                break
+            await asyncio.sleep(0.01)
+        await collector.stop(app)
+        registry = collect(collector)
+        assert (
+            registry.get_sample_value("temperature", {"instance": "a"}) == 20.5
+        )
+
+    @pytest.mark.parametrize(
+        "status,delay,error",
+        [
+            (500, 0.0, "500, message='Internal Server Error', url="),
+            (200, 1.0, "TimeoutError"),
+        ],
+    )
+    async def test_refresh_failure(
+        self,
+        log: StructuredLogCapture,
+        make_upstream: Callable[..., Awaitable[tuple[Upstream, str]]],
+        status: int,
+        delay: float,
+        error: str,
+    ) -> None:
+        _, url_a = await make_upstream(UPSTREAM_A)
+        failing, url_b = await make_upstream(UPSTREAM_B)
+        collector = FederationCollector({"a": url_a, "b": url_b}, timeout=0.2)
+        app = await start_collector(collector)
+        failing.status = status
+        failing.delay = delay
+        await collector.refresh()
+        await collector.stop(app)
+        registry = collect(collector)
+        assert (
+            registry.get_sample_value(
+                "exporter_federation_upstream_up", {"upstream": "b"}
+            )
+            == 0
+        )
+        # metrics from the previous scrape are still reported
+        assert (
+            registry.get_sample_value(
+                "requests_total", {"path": "/", "upstream": "b"}
+            )
+            == 5.0
+        )
+        [event] = [
+            event
+            for event in log.events
+            if event["event"] == "upstream scrape failed"
+        ]
+        assert event["upstream"] == "b"
+        assert event["error"].startswith(error)
+
+    async def test_max_age(
+        self,
+        mocker: MockerFixture,
+        make_upstream: Callable[..., Awaitable[tuple[Upstream, str]]],
+    ) -> None:
+        _, url = await make_upstream(UPSTREAM_A)
+        collector = FederationCollector({"a": url}, interval=10.0)
+        app = await start_collector(collector)
+        await collector.stop(app)
+        assert collector.max_age == 30.0
+        monotonic = mocker.patch("time.monotonic")
+        updated = collector._states["a"].updated
+        assert updated is not None
+        monotonic.return_value = updated + 31
+        registry = collect(collector)
+        assert (
+            registry.get_sample_value("temperature", {"upstream": "a"}) is None
+        )
+        assert (
+            registry.get_sample_value(
+                "exporter_federation_upstream_up", {"upstream": "a"}
+            )
+            == 1
+        )
+
+    def test_collect_not_scraped(self) -> None:
+        collector = FederationCollector({"a": "http://localhost/metrics"})
+        registry = collect(collector)
+        assert (
+            registry.get_sample_value(
+                "exporter_federation_upstream_up", {"upstream": "a"}
+            )
+            == 0
+        )
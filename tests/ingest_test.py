@@ -0,0 +1,50 @@
+import asyncio
+import typing as t
+
+from aiohttp.web import Application
+import pytest
+
+from prometheus_aioexporter._ingest import UpdateWriter
+from prometheus_aioexporter._metric import (
+    MetricConfig,
+    MetricsRegistry,
+    MetricUpdate,
+)
+
+
+@pytest.fixture
+def registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.create_metrics([MetricConfig("counter", "A counter", "counter")])
+    return registry
+
+
+def counter_value(registry: MetricsRegistry) -> t.Any:
+    return registry.registry.get_sample_value("counter_total")
+
+
+class TestUpdateWriter:
+    async def test_apply_periodically(self, registry: MetricsRegistry) -> None:
+        writer = UpdateWriter(registry, interval=0.01)
+        await writer.start(Application())
+        registry.queue_updates([MetricUpdate("counter", 2)])
+        await asyncio.sleep(0.05)
+        assert counter_value(registry) == 2
+        registry.queue_updates([MetricUpdate("counter", 3)])
+        await asyncio.sleep(0.05)
+        assert counter_value(registry) == 5
+        await writer.stop(Application())
+
+    async def test_stop_applies_pending(
+        self, registry: MetricsRegistry
+    ) -> None:
+        writer = UpdateWriter(registry, interval=10)
+        await writer.start(Application())
+        registry.queue_updates([MetricUpdate("counter", 2)])
+        await writer.stop(Application())
+        assert counter_value(registry) == 2
+        assert writer._task is None
+        # stopping again only applies pending updates
+        registry.queue_updates([MetricUpdate("counter", 1)])
+        await writer.stop(Application())
+        assert counter_value(registry) == 3
@@ -1,18 +1,40 @@
+from collections.abc import Iterator
+import io
+import json
 import logging
 from unittest.mock import Mock
 
 import pytest
+from pytest_mock import MockerFixture
 from pytest_structlog import StructuredLogCapture
 import structlog
+from structlog.typing import EventDict, WrappedLogger
 
 from prometheus_aioexporter._log import (
+    REQUEST_PHASES_KEY,
     AccessLogger,
     LogFormat,
     LogLevel,
+    QueueLogger,
+    QueueLogWriter,
     setup_logging,
 )
 
 
+@pytest.fixture
+def restore_structlog_config() -> Iterator[None]:
+    config = structlog.get_config()
+    yield
+    structlog.configure(**config)
+    AccessLogger.sample_rate = 1.0
+
+
+def render(
+    logger: WrappedLogger, method_name: str, event_dict: EventDict
+) -> str:
+    return json.dumps(event_dict, sort_keys=True)
+
+
 class TestLogLevel:
     @pytest.mark.parametrize("level", list(LogLevel))
     def test_repr(self, level: LogLevel) -> None:
@@ -32,6 +54,47 @@ class TestSetupLogging:
         assert "timestamp" in event
         assert event["some"] == "context"
 
+    @pytest.mark.usefixtures("restore_structlog_config")
+    def test_json_renderer(self, mocker: MockerFixture) -> None:
+        orjson = mocker.patch("prometheus_aioexporter._log.orjson")
+        assert setup_logging(log_format=LogFormat.JSON) is None
+        config = structlog.get_config()
+        assert isinstance(
+            config["logger_factory"], structlog.BytesLoggerFactory
+        )
+        renderer = config["processors"][-1]
+        assert isinstance(renderer, structlog.processors.JSONRenderer)
+        assert renderer._dumps is orjson.dumps
+
+    @pytest.mark.usefixtures("restore_structlog_config")
+    def test_json_renderer_no_orjson(self, mocker: MockerFixture) -> None:
+        mocker.patch("prometheus_aioexporter._log.orjson", None)
+        logger_factory = structlog.get_config()["logger_factory"]
+        assert setup_logging(log_format=LogFormat.JSON) is None
+        config = structlog.get_config()
+        assert config["logger_factory"] is logger_factory
+        renderer = config["processors"][-1]
+        assert isinstance(renderer, structlog.processors.JSONRenderer)
+        assert renderer._dumps is json.dumps
+
+    @pytest.mark.usefixtures("restore_structlog_config")
+    def test_queue(self) -> None:
+        writer = setup_logging(log_format=LogFormat.JSON, queue_size=10)
+        assert writer is not None
+        config = structlog.get_config()
+        assert config["logger_factory"] == writer.logger_factory
+        # rendering is done by the writer
+        assert not any(
+            isinstance(processor, structlog.processors.JSONRenderer)
+            for processor in config["processors"]
+        )
+        writer.stop()
+
+    @pytest.mark.usefixtures("restore_structlog_config")
+    def test_access_log_sample_rate(self) -> None:
+        setup_logging(access_log_sample_rate=0.5)
+        assert AccessLogger.sample_rate == 0.5
+
 
 class TestAccessLogger:
     def test_log_request(self, log: StructuredLogCapture) -> None:
@@ -50,3 +113,107 @@ class TestAccessLogger:
             duration=duration,
             level="debug",
         )
+
+    def test_log_request_phases(self, log: StructuredLogCapture) -> None:
+        logger = AccessLogger(logging.getLogger(), "ignored format")
+        phases = {"update": 0.1, "encode": 0.2}
+        request = Mock(method="GET", path="/foo", remote="192.168.1.1")
+        request.get = {REQUEST_PHASES_KEY: phases}.get
+        response = Mock(status=200, body_length=123)
+        logger.log(request, response, 0.3)
+        assert log.has("request", path="/foo", phases=phases)
+
+    @pytest.mark.parametrize("status", [200, 500])
+    def test_log_request_sampled_out(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        log: StructuredLogCapture,
+        status: int,
+    ) -> None:
+        monkeypatch.setattr(AccessLogger, "sample_rate", 0.0)
+        logger = AccessLogger(logging.getLogger(), "ignored format")
+        request = Mock(method="GET", path="/foo", remote="192.168.1.1")
+        response = Mock(status=status, body_length=123)
+        logger.log(request, response, 0.1)
+        # errors are always logged
+        assert log.has("request", status=status) == (status == 500)
+
+    @pytest.mark.parametrize("enabled", [True, False])
+    def test_enabled(self, enabled: bool) -> None:
+        logger = AccessLogger(logging.getLogger(), "ignored format")
+        logger.__dict__["_logger"] = Mock(is_enabled_for=lambda level: enabled)
+        assert logger.enabled == enabled
+
+
+class TestQueueLogWriter:
+    def test_write(self) -> None:
+        output = io.StringIO()
+        writer = QueueLogWriter(render, file=output)
+        writer.start()
+        writer.write({"event": "foo"})
+        writer.write({"event": "bar"})
+        writer.stop()
+        assert output.getvalue() == '{"event": "foo"}\n{"event": "bar"}\n'
+
+    def test_write_bytes(self) -> None:
+        output = io.StringIO()
+        writer = QueueLogWriter(
+            lambda logger, name, event_dict: b"entry", file=output
+        )
+        writer.start()
+        writer.write({"event": "foo"})
+        writer.stop()
+        assert output.getvalue() == "entry\n"
+
+    def test_write_render_error(self) -> None:
+        def render(
+            logger: WrappedLogger, name: str, event_dict: EventDict
+        ) -> str:
+            raise ValueError("boom")
+
+        output = io.StringIO()
+        writer = QueueLogWriter(render, file=output)
+        writer.start()
+        writer.write({"event": "foo"})
+        writer.stop()
+        assert output.getvalue() == (
+            "failed rendering log entry: ValueError('boom')\n"
+        )
+
+    def test_drop(self) -> None:
+        output = io.StringIO()
+        writer = QueueLogWriter(render, file=output, maxsize=1)
+        writer.write({"event": "foo"})
+        writer.write({"event": "bar"})
+        assert writer.dropped == 1
+        writer.start()
+        writer.stop()
+        assert output.getvalue() == '{"event": "foo"}\n'
+
+    def test_stop_not_started(self) -> None:
+        writer = QueueLogWriter(render)
+        writer.stop()
+
+    def test_collect(self) -> None:
+        writer = QueueLogWriter(render, maxsize=1)
+        writer.write({"event": "foo"})
+        writer.write({"event": "bar"})
+        [metric] = writer.collect()
+        assert metric.name == "exporter_log_entries_dropped"
+        [sample] = metric.samples
+        assert sample.name == "exporter_log_entries_dropped_total"
+        assert sample.value == 1
+
+    @pytest.mark.parametrize("level", ["debug", "info", "error", "msg"])
+    def test_logger(self, level: str) -> None:
+        writer = Mock()
+        logger = QueueLogger(writer)
+        getattr(logger, level)(event="foo", some="context")
+        writer.write.assert_called_once_with(
+            {"event": "foo", "some": "context"}
+        )
+
+    def test_logger_factory(self) -> None:
+        writer = QueueLogWriter(render)
+        logger = writer.logger_factory("name")
+        assert logger._writer is writer
@@ -0,0 +1,107 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable, Callable
+import time
+import typing as t
+
+from aiohttp.web import Application
+from prometheus_client import CollectorRegistry
+import pytest
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._loop_monitor import LoopMonitor
+
+
+@pytest.fixture
+async def start_monitor() -> AsyncIterator[
+    Callable[..., Awaitable[LoopMonitor]]
+]:
+    monitors = []
+
+    async def start(**kwargs: t.Any) -> LoopMonitor:
+        monitor = LoopMonitor(**kwargs)
+        await monitor.start(Application())
+        monitors.append(monitor)
+        return monitor
+
+    yield start
+    for monitor in monitors:
+        await monitor.stop(Application())
+
+
+def sample_value(monitor: LoopMonitor, name: str) -> float | None:
+    registry = CollectorRegistry()
+    registry.register(monitor)
+    return registry.get_sample_value(name)
+
+
+def block_loop(duration: float) -> None:
+    time.sleep(duration)
+
+
+class TestLoopMonitor:
+    async def test_lag(
+        self, start_monitor: Callable[..., Awaitable[LoopMonitor]]
+    ) -> None:
+        monitor = await start_monitor(interval=0.01)
+        await asyncio.sleep(0.05)
+        count = sample_value(monitor, "exporter_event_loop_lag_seconds_count")
+        assert count is not None and count >= 2
+
+    async def test_slow_callback_duration_set(
+        self, start_monitor: Callable[..., Awaitable[LoopMonitor]]
+    ) -> None:
+        await start_monitor(slow_callback_duration=0.3)
+        assert asyncio.get_running_loop().slow_callback_duration == 0.3
+
+    async def test_slow_callback(
+        self,
+        log: StructuredLogCapture,
+        start_monitor: Callable[..., Awaitable[LoopMonitor]],
+    ) -> None:
+        monitor = await start_monitor(
+            interval=0.01, slow_callback_duration=0.05
+        )
+        await asyncio.sleep(0.02)
+        block_loop(0.2)
+        await asyncio.sleep(0.02)
+        # blocking is reported once
+        assert (
+            sample_value(monitor, "exporter_event_loop_slow_callbacks_total")
+            == 1
+        )
+        [event] = [
+            event for event in log.events if event["event"] == "slow callback"
+        ]
+        assert event["level"] == "warning"
+        assert event["blocked"] >= 0.05
+        assert "in block_loop" in event["stack"]
+        lag_sum = sample_value(monitor, "exporter_event_loop_lag_seconds_sum")
+        assert lag_sum is not None and lag_sum >= 0.15
+
+    async def test_no_slow_callback(
+        self,
+        log: StructuredLogCapture,
+        start_monitor: Callable[..., Awaitable[LoopMonitor]],
+    ) -> None:
+        monitor = await start_monitor(interval=0.01, slow_callback_duration=1)
+        await asyncio.sleep(0.05)
+        assert (
+            sample_value(monitor, "exporter_event_loop_slow_callbacks_total")
+            == 0
+        )
+        assert not log.has("slow callback")
+
+    async def test_loop_stack_missing_thread(self) -> None:
+        monitor = LoopMonitor()
+        assert monitor._loop_stack() == ""
+
+    async def test_stop(self) -> None:
+        monitor = LoopMonitor(interval=0.01)
+        await monitor.start(Application())
+        watchdog = monitor._watchdog
+        await monitor.stop(Application())
+        assert monitor._task is None
+        assert monitor._watchdog is None
+        assert watchdog is not None and not watchdog.is_alive()
+        # stopping again is a no-op
+        await monitor.stop(Application())
@@ -1,12 +1,25 @@
+import asyncio
+from collections.abc import AsyncIterator
+import threading
 import typing as t
+from unittest import mock
 
-from prometheus_client import Histogram
+from prometheus_client import Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.metrics_core import Metric
 import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
 
 from prometheus_aioexporter._metric import (
+    AsyncCollector,
     InvalidMetricType,
+    MetricChanges,
     MetricConfig,
+    MetricRemoval,
     MetricsRegistry,
+    MetricUpdate,
 )
 
 
@@ -86,3 +99,750 @@ class TestMetricsRegistry:
         registry.create_metrics(configs)
         metric = registry.get_metric("m", {"l1": "v1", "l2": "v2"})
         assert metric._labelvalues == ("v1", "v2")
+
+
+@pytest.fixture
+def delta_registry() -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [
+            MetricConfig("gauge", "a gauge", "gauge", labels=("l",)),
+            MetricConfig("plain", "a gauge", "gauge"),
+            MetricConfig("counter", "a counter", "counter"),
+            MetricConfig("histogram", "a histogram", "histogram"),
+            MetricConfig("summary", "a summary", "summary"),
+            MetricConfig(
+                "enum", "an enum", "enum", config={"states": ["on", "off"]}
+            ),
+            MetricConfig("info", "an info", "info"),
+        ]
+    )
+    return registry
+
+
+class TestApplyUpdates:
+    def test_updates(self, delta_registry: MetricsRegistry) -> None:
+        changed = delta_registry.apply_updates(
+            [
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("gauge", 4, {"l": "b"}),
+                MetricUpdate("plain", 5),
+                MetricUpdate("counter", 2),
+                MetricUpdate("counter", 3),
+                MetricUpdate("histogram", 0.2),
+                MetricUpdate("summary", 1.5),
+                MetricUpdate("enum", "off"),
+                MetricUpdate("info", {"version": "1.0"}),
+            ]
+        )
+        assert changed == {
+            "gauge",
+            "plain",
+            "counter",
+            "histogram",
+            "summary",
+            "enum",
+            "info",
+        }
+        value = delta_registry.registry.get_sample_value
+        assert value("gauge", {"l": "a"}) == 3
+        assert value("gauge", {"l": "b"}) == 4
+        assert value("plain") == 5
+        assert value("counter_total") == 5
+        assert value("histogram_count") == 1
+        assert value("summary_sum") == 1.5
+        assert value("enum", {"enum": "off"}) == 1
+        assert value("info_info", {"version": "1.0"}) == 1
+
+    def test_removals(self, delta_registry: MetricsRegistry) -> None:
+        delta_registry.apply_updates(
+            [
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("gauge", 4, {"l": "b"}),
+            ]
+        )
+        changed = delta_registry.apply_updates(
+            [MetricRemoval("gauge", {"l": "a"})]
+        )
+        assert changed == {"gauge"}
+        value = delta_registry.registry.get_sample_value
+        assert value("gauge", {"l": "a"}) is None
+        assert value("gauge", {"l": "b"}) == 4
+        delta_registry.apply_updates([MetricRemoval("gauge")])
+        assert value("gauge", {"l": "b"}) is None
+
+    def test_remove_missing(self, delta_registry: MetricsRegistry) -> None:
+        changed = delta_registry.apply_updates(
+            [MetricRemoval("gauge", {"l": "a"})]
+        )
+        assert changed == set()
+
+    def test_failed(
+        self, log: StructuredLogCapture, delta_registry: MetricsRegistry
+    ) -> None:
+        changed = delta_registry.apply_updates(
+            [
+                MetricUpdate("unknown", 1),
+                MetricUpdate("gauge", 1, {"l": "a", "extra": "b"}),
+                MetricUpdate("gauge", 2),
+                MetricRemoval("gauge", {"l": "a", "extra": "b"}),
+                MetricRemoval("plain", {}),
+                MetricUpdate("counter", 2),
+            ]
+        )
+        # failed deltas are skipped
+        assert changed == {"counter"}
+        value = delta_registry.registry.get_sample_value
+        assert value("counter_total") == 2
+        assert log.has(
+            "metric update failed",
+            metric="unknown",
+            error="'unknown'",
+            level="warning",
+        )
+        assert log.has(
+            "metric update failed",
+            metric="gauge",
+            error="Incorrect label names: extra, l (expected l)",
+        )
+        assert log.has(
+            "metric update failed",
+            metric="gauge",
+            error="Incorrect label names: none (expected l)",
+        )
+        assert log.has(
+            "metric update failed",
+            metric="plain",
+            error="Metric has no labels, series can't be removed",
+        )
+
+    def test_lazy(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "a gauge", "gauge"),
+                MetricConfig("m2", "a gauge", "gauge"),
+            ]
+        )
+        registry.apply_updates([MetricUpdate("m1", 1)])
+        assert registry.registry.get_sample_value("m1") == 1
+        assert registry.registry.get_sample_value("m2") is None
+
+
+class SampleAsyncCollector(AsyncCollector):
+    """An async collector yielding a gauge."""
+
+    timeout = 0.1
+
+    def __init__(
+        self, name: str, delay: float = 0.0, error: Exception | None = None
+    ) -> None:
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def collect(self) -> AsyncIterator[Metric]:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        yield GaugeMetricFamily(self.name, "an async gauge", value=self.calls)
+
+
+class TestQueuedUpdates:
+    def test_apply_empty(self, delta_registry: MetricsRegistry) -> None:
+        assert delta_registry.apply_queued_updates() == 0
+
+    def test_apply(self, delta_registry: MetricsRegistry) -> None:
+        delta_registry.queue_updates(
+            [
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("counter", 2),
+            ]
+        )
+        delta_registry.queue_updates([MetricUpdate("histogram", 0.2)])
+        value = delta_registry.registry.get_sample_value
+        # updates are not applied until requested
+        assert value("gauge", {"l": "a"}) is None
+        assert delta_registry.apply_queued_updates() == 3
+        assert value("gauge", {"l": "a"}) == 3
+        assert value("counter_total") == 2
+        assert value("histogram_count") == 1
+        assert delta_registry.apply_queued_updates() == 0
+
+    def test_coalesce(
+        self, mocker: MockerFixture, delta_registry: MetricsRegistry
+    ) -> None:
+        apply_delta = mocker.spy(delta_registry, "_apply_delta")
+        delta_registry.queue_updates(
+            [
+                MetricUpdate("counter", 2),
+                MetricUpdate("gauge", 1, {"l": "a"}),
+                MetricUpdate("gauge", 2, {"l": "b"}),
+                MetricUpdate("counter", 3),
+                MetricUpdate("histogram", 0.2),
+                MetricUpdate("histogram", 0.3),
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("enum", "on"),
+                MetricUpdate("enum", "off"),
+                MetricUpdate("info", {"version": "1"}),
+                MetricUpdate("info", {"version": "2"}),
+            ]
+        )
+        assert delta_registry.apply_queued_updates() == 11
+        assert [call.args[0] for call in apply_delta.call_args_list] == (
+            [
+                MetricUpdate("counter", 5),
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("gauge", 2, {"l": "b"}),
+                MetricUpdate("histogram", 0.2),
+                MetricUpdate("histogram", 0.3),
+                MetricUpdate("enum", "off"),
+                MetricUpdate("info", {"version": "2"}),
+            ]
+        )
+        value = delta_registry.registry.get_sample_value
+        assert value("counter_total") == 5
+        assert value("gauge", {"l": "a"}) == 3
+        assert value("histogram_count") == 2
+
+    def test_coalesce_removals(
+        self, mocker: MockerFixture, delta_registry: MetricsRegistry
+    ) -> None:
+        apply_delta = mocker.spy(delta_registry, "_apply_delta")
+        delta_registry.queue_updates(
+            [
+                MetricUpdate("gauge", 1, {"l": "a"}),
+                MetricUpdate("gauge", 1, {"l": "b"}),
+                MetricRemoval("gauge", {"l": "a"}),
+                MetricUpdate("gauge", 2, {"l": "a"}),
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("plain", 1),
+                MetricRemoval("gauge"),
+                MetricUpdate("gauge", 4, {"l": "b"}),
+                MetricUpdate("plain", 2),
+            ]
+        )
+        delta_registry.apply_queued_updates()
+        assert [call.args[0] for call in apply_delta.call_args_list] == (
+            [
+                MetricUpdate("gauge", 1, {"l": "a"}),
+                MetricUpdate("gauge", 1, {"l": "b"}),
+                MetricRemoval("gauge", {"l": "a"}),
+                MetricUpdate("gauge", 3, {"l": "a"}),
+                MetricUpdate("plain", 2),
+                MetricRemoval("gauge"),
+                MetricUpdate("gauge", 4, {"l": "b"}),
+            ]
+        )
+        value = delta_registry.registry.get_sample_value
+        assert value("gauge", {"l": "a"}) is None
+        assert value("gauge", {"l": "b"}) == 4
+        assert value("plain") == 2
+
+    def test_failed(
+        self, log: StructuredLogCapture, delta_registry: MetricsRegistry
+    ) -> None:
+        delta_registry.queue_updates(
+            [
+                MetricUpdate("gauge", 1, {"l": "a"}),
+                MetricUpdate("unknown", 1),
+                MetricUpdate("gauge", 2, {"wrong": "b"}),
+                MetricUpdate("counter", 2),
+            ]
+        )
+        assert delta_registry.apply_queued_updates() == 4
+        value = delta_registry.registry.get_sample_value
+        assert value("gauge", {"l": "a"}) == 1
+        assert value("counter_total") == 2
+        assert log.has(
+            "metric update failed",
+            metric="unknown",
+            error="'unknown'",
+            level="warning",
+        )
+        assert log.has(
+            "metric update failed",
+            metric="gauge",
+            error="Incorrect label names: wrong (expected l)",
+        )
+
+    def test_failed_not_reapplied(
+        self, log: StructuredLogCapture, delta_registry: MetricsRegistry
+    ) -> None:
+        delta_registry.queue_updates(
+            [
+                MetricUpdate("counter", 1),
+                MetricUpdate("gauge", 1, {"wrong": "b"}),
+            ]
+        )
+        delta_registry.apply_queued_updates()
+        # updates before the failing one are only applied once
+        value = delta_registry.registry.get_sample_value
+        assert value("counter_total") == 1
+        assert log.has("metric update failed", metric="gauge")
+
+    def test_queue_size(self, delta_registry: MetricsRegistry) -> None:
+        delta_registry.update_queue_size = 3
+        delta_registry.queue_updates(
+            [MetricUpdate("counter", 1), MetricUpdate("counter", 2)]
+        )
+        delta_registry.queue_updates(
+            [MetricUpdate("counter", 3), MetricUpdate("counter", 4)]
+        )
+        delta_registry.queue_updates([MetricUpdate("counter", 5)])
+        value = delta_registry.registry.get_sample_value
+        assert value("exporter_update_queue_pending") == 3
+        assert value("exporter_update_queue_dropped_total") == 2
+        assert delta_registry.apply_queued_updates() == 3
+        assert value("counter_total") == 6
+        assert value("exporter_update_queue_pending") == 0
+
+    def test_queue_size_unlimited(
+        self, delta_registry: MetricsRegistry
+    ) -> None:
+        delta_registry.update_queue_size = 0
+        delta_registry.queue_updates(
+            MetricUpdate("counter", 1) for _ in range(200000)
+        )
+        value = delta_registry.registry.get_sample_value
+        assert value("exporter_update_queue_pending") == 200000
+        assert value("exporter_update_queue_dropped_total") == 0
+
+    def test_queue_metrics_not_registered(
+        self, delta_registry: MetricsRegistry
+    ) -> None:
+        # metrics are only included once updates are queued
+        value = delta_registry.registry.get_sample_value
+        assert value("exporter_update_queue_pending") is None
+        delta_registry.queue_updates([])
+        assert value("exporter_update_queue_pending") == 0
+
+    def test_multiple_threads(self, delta_registry: MetricsRegistry) -> None:
+        def produce() -> None:
+            for _ in range(1000):
+                delta_registry.queue_updates([MetricUpdate("counter", 1)])
+
+        threads = [threading.Thread(target=produce) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        applied = 0
+        while any(thread.is_alive() for thread in threads):
+            applied += delta_registry.apply_queued_updates()
+        for thread in threads:
+            thread.join()
+        applied += delta_registry.apply_queued_updates()
+        assert applied == 4000
+        value = delta_registry.registry.get_sample_value
+        assert value("counter_total") == 4000
+
+
+class TestAsyncCollectors:
+    async def test_collect_async(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("m", "a gauge", "gauge")])
+        registry.register_additional_collector(SampleAsyncCollector("a1"))
+        registry.register_additional_collector(SampleAsyncCollector("a2"))
+        # metrics are not included until collected
+        assert registry.registry.get_sample_value("a1") is None
+        await registry.collect_async()
+        await registry.collect_async()
+        assert registry.registry.get_sample_value("a1") == 2
+        assert registry.registry.get_sample_value("a2") == 2
+        assert registry.registry.get_sample_value("m") == 0
+        output = generate_latest(registry.registry).decode()
+        assert "# TYPE a1 gauge" in output
+
+    async def test_collect_async_concurrent(self) -> None:
+        registry = MetricsRegistry()
+        for i in range(5):
+            registry.register_additional_collector(
+                SampleAsyncCollector(f"a{i}", delay=0.05)
+            )
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await registry.collect_async()
+        assert loop.time() - start < 0.2
+
+    async def test_collect_async_errors(
+        self, log: StructuredLogCapture
+    ) -> None:
+        registry = MetricsRegistry()
+        registry.register_additional_collector(SampleAsyncCollector("ok"))
+        registry.register_additional_collector(
+            SampleAsyncCollector("slow", delay=1.0)
+        )
+        registry.register_additional_collector(
+            SampleAsyncCollector("failing", error=Exception("fail"))
+        )
+        await registry.collect_async()
+        assert registry.registry.get_sample_value("ok") == 1
+        assert registry.registry.get_sample_value("slow") is None
+        assert registry.registry.get_sample_value("failing") is None
+        assert log.has(
+            "async collector failed",
+            collector="SampleAsyncCollector",
+            error="TimeoutError",
+            level="warning",
+        )
+        assert log.has(
+            "async collector failed",
+            collector="SampleAsyncCollector",
+            error="fail",
+            level="warning",
+        )
+
+
+class TestLazyMetricsRegistry:
+    def test_create_metrics_not_registered(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        metrics = registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "counter"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        assert list(metrics) == ["m1", "m2"]
+        assert len(metrics) == 2
+        assert registry.registry._names_to_collectors == {}
+
+    def test_get_metric_registers(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        metric = registry.get_metric("m1")
+        assert metric._name == "m1"
+        assert registry.get_metric("m1") is metric
+        assert list(registry.registry._names_to_collectors) == ["m1"]
+
+    def test_get_metric_with_labels(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics(
+            [MetricConfig("m", "desc", "gauge", labels=("l1", "l2"))]
+        )
+        metric = registry.get_metric("m", {"l1": "v1", "l2": "v2"})
+        assert metric._labelvalues == ("v1", "v2")
+
+    def test_get_metric_unknown(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        with pytest.raises(KeyError):
+            registry.get_metric("unknown")
+
+    def test_get_metrics_registers_on_access(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "counter"),
+            ]
+        )
+        metrics = registry.get_metrics()
+        assert "m2" in metrics
+        assert registry.registry._names_to_collectors == {}
+        assert metrics["m2"]._type == "counter"
+        assert list(registry.registry._names_to_collectors) == [
+            "m2",
+            "m2_total",
+            "m2_created",
+        ]
+
+    def test_get_metrics_unknown(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics([MetricConfig("m1", "desc1", "gauge")])
+        with pytest.raises(KeyError):
+            registry.get_metrics()["unknown"]
+
+
+class TestReconcileMetrics:
+    def test_add(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("m1", "desc1", "gauge")])
+        changes = registry.reconcile_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "counter"),
+            ]
+        )
+        assert changes == MetricChanges(added=("m2",))
+        assert list(registry.get_metrics()) == ["m1", "m2"]
+        assert "m2_total" in registry.registry._names_to_collectors
+
+    def test_unchanged_keeps_values(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("m1", "desc1", "gauge")])
+        gauge = t.cast(Gauge, registry.get_metric("m1"))
+        gauge.set(10)
+        changes = registry.reconcile_metrics(
+            [MetricConfig("m1", "desc1", "gauge")]
+        )
+        assert changes == MetricChanges()
+        assert registry.get_metric("m1") is gauge
+        assert registry.registry.get_sample_value("m1") == 10
+
+    def test_priority_change_keeps_values(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("m1", "desc1", "gauge")])
+        gauge = t.cast(Gauge, registry.get_metric("m1"))
+        gauge.set(10)
+        changes = registry.reconcile_metrics(
+            [MetricConfig("m1", "desc1", "gauge", priority=5)]
+        )
+        assert changes == MetricChanges()
+        assert registry.get_metric("m1") is gauge
+        assert registry.registry.get_sample_value("m1") == 10
+        # the new priority is used
+        assert registry._configs["m1"].priority == 5
+
+    def test_update(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics([MetricConfig("m1", "desc1", "gauge")])
+        metric = registry.get_metric("m1")
+        changes = registry.reconcile_metrics(
+            [MetricConfig("m1", "desc1", "counter")]
+        )
+        assert changes == MetricChanges(updated=("m1",))
+        assert registry.get_metric("m1") is not metric
+        assert registry.get_metric("m1")._type == "counter"
+
+    def test_remove(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        changes = registry.reconcile_metrics(
+            [MetricConfig("m1", "desc1", "gauge")]
+        )
+        assert changes == MetricChanges(removed=("m2",))
+        assert list(registry.get_metrics()) == ["m1"]
+        assert list(registry.registry._names_to_collectors) == ["m1"]
+
+    def test_remove_only_managed(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        changes = registry.reconcile_metrics([], managed=["m2", "other"])
+        assert changes == MetricChanges(removed=("m2",))
+        assert list(registry.get_metrics()) == ["m1"]
+
+    def test_lazy(self) -> None:
+        registry = MetricsRegistry(lazy=True)
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        registry.get_metric("m1")
+        changes = registry.reconcile_metrics(
+            [
+                MetricConfig("m1", "desc1", "counter"),
+                MetricConfig("m3", "desc3", "gauge"),
+            ]
+        )
+        assert changes == MetricChanges(
+            added=("m3",), updated=("m1",), removed=("m2",)
+        )
+        assert registry.registry._names_to_collectors == {}
+        assert registry.get_metric("m1")._type == "counter"
+
+    def test_rollback_on_error(self) -> None:
+        registry = MetricsRegistry()
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "gauge"),
+            ]
+        )
+        metrics = registry.get_metrics()
+        registry.register_additional_collector(
+            Gauge("conflict", "conflicting metric", registry=None)
+        )
+        with pytest.raises(ValueError):
+            registry.reconcile_metrics(
+                [
+                    MetricConfig("m1", "desc1", "counter"),
+                    MetricConfig("m3", "desc3", "gauge"),
+                    MetricConfig("conflict", "desc", "gauge"),
+                ]
+            )
+        assert registry.get_metrics() == metrics
+        assert set(registry.registry._names_to_collectors) == {
+            "m1",
+            "m2",
+            "conflict",
+        }
+
+
+@pytest.fixture
+def double_buffered_registry() -> MetricsRegistry:
+    registry = MetricsRegistry(double_buffered=True)
+    registry.create_metrics(
+        [
+            MetricConfig("gauge", "A gauge", "gauge", labels=["l"]),
+            MetricConfig("counter", "A counter", "counter"),
+        ]
+    )
+    return registry
+
+
+def fill_generation(
+    registry: MetricsRegistry, labels: t.Iterable[str], count: float = 1
+) -> t.Mapping[str, MetricWrapperBase]:
+    generation = registry.start_generation()
+    gauge = t.cast(Gauge, generation["gauge"])
+    for label in labels:
+        gauge.labels(l=label).set(count)
+    t.cast(Counter, generation["counter"]).inc(count)
+    return generation
+
+
+class TestDoubleBufferedMetricsRegistry:
+    @pytest.mark.parametrize(
+        "kwargs",
+        [{"lazy": True}, {"value_store": mock.Mock()}],
+    )
+    def test_unsupported(self, kwargs: dict[str, t.Any]) -> None:
+        with pytest.raises(ValueError) as error:
+            MetricsRegistry(double_buffered=True, **kwargs)
+        assert str(error.value) == (
+            "Double buffering is not supported for lazy metrics or shared "
+            "values"
+        )
+
+    def test_not_double_buffered(self) -> None:
+        with pytest.raises(ValueError) as error:
+            MetricsRegistry().start_generation()
+        assert str(error.value) == "Registry is not double-buffered"
+
+    def test_publish_not_generation(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        with pytest.raises(ValueError) as error:
+            double_buffered_registry.publish_generation({})
+        assert str(error.value) == "Not a generation of metrics"
+
+    def test_updates_not_supported(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        update = MetricUpdate("counter", 3)
+        with pytest.raises(ValueError) as error:
+            double_buffered_registry.apply_updates([update])
+        assert (
+            str(error.value)
+            == "Updates are not supported for double-buffered registries"
+        )
+        with pytest.raises(ValueError):
+            double_buffered_registry.queue_updates([update])
+        assert double_buffered_registry.apply_queued_updates() == 0
+
+    def test_publish(self, double_buffered_registry: MetricsRegistry) -> None:
+        value = double_buffered_registry.registry.get_sample_value
+        generation = fill_generation(double_buffered_registry, ["a", "b"])
+        # the generation is not exported until published
+        assert value("gauge", {"l": "a"}) is None
+        double_buffered_registry.publish_generation(generation)
+        assert value("gauge", {"l": "a"}) == 1
+        assert value("gauge", {"l": "b"}) == 1
+        assert value("counter_total") == 1
+        # while the next generation is filled, the published one is
+        # exported
+        generation = fill_generation(double_buffered_registry, ["c"], count=2)
+        assert value("gauge", {"l": "a"}) == 1
+        assert value("gauge", {"l": "c"}) is None
+        assert double_buffered_registry.publish_generation(generation)
+        assert value("gauge", {"l": "a"}) is None
+        assert value("gauge", {"l": "c"}) == 2
+        assert value("counter_total") == 2
+
+    def test_published_metrics(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        generation = fill_generation(double_buffered_registry, ["a"])
+        assert (
+            double_buffered_registry.get_metric("gauge")
+            is not (generation["gauge"])
+        )
+        double_buffered_registry.publish_generation(generation)
+        assert double_buffered_registry.get_metrics() == generation
+
+    def test_recycle(self, double_buffered_registry: MetricsRegistry) -> None:
+        first = fill_generation(double_buffered_registry, ["a"])
+        double_buffered_registry.publish_generation(first)
+        generation = fill_generation(double_buffered_registry, ["b"])
+        double_buffered_registry.publish_generation(generation)
+        third = double_buffered_registry.start_generation()
+        # metrics with labels from the first generation are reused, without
+        # series
+        assert third["gauge"] is first["gauge"]
+        assert third["gauge"]._metrics == {}
+        # metrics without labels are replaced
+        assert third["counter"] is not first["counter"]
+        assert t.cast(Counter, third["counter"])._value.get() == 0
+
+    def test_concurrent(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        value = double_buffered_registry.registry.get_sample_value
+        first = fill_generation(double_buffered_registry, ["a"])
+        double_buffered_registry.publish_generation(first)
+        second = double_buffered_registry.start_generation()
+        third = double_buffered_registry.start_generation()
+        # concurrent generations don't share metrics
+        assert second["gauge"] is not third["gauge"]
+        t.cast(Gauge, second["gauge"]).labels(l="b").set(2)
+        t.cast(Gauge, third["gauge"]).labels(l="c").set(3)
+        assert double_buffered_registry.publish_generation(third)
+        assert value("gauge", {"l": "c"}) == 3
+        # the older generation is discarded, as a newer one is published
+        assert not double_buffered_registry.publish_generation(second)
+        assert value("gauge", {"l": "b"}) is None
+        assert value("gauge", {"l": "c"}) == 3
+        # publishing again has no effect
+        assert not double_buffered_registry.publish_generation(third)
+
+    def test_reconcile(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        generation = fill_generation(double_buffered_registry, ["a"])
+        double_buffered_registry.publish_generation(generation)
+        generation = fill_generation(double_buffered_registry, ["a"])
+        double_buffered_registry.publish_generation(generation)
+        double_buffered_registry.reconcile_metrics(
+            [MetricConfig("gauge", "A gauge", "counter", labels=["l"])]
+        )
+        generation = double_buffered_registry.start_generation()
+        assert list(generation) == ["gauge"]
+        assert generation["gauge"]._type == "counter"
+        t.cast(Counter, generation["gauge"]).labels(l="a").inc()
+        double_buffered_registry.publish_generation(generation)
+        value = double_buffered_registry.registry.get_sample_value
+        assert value("gauge_total", {"l": "a"}) == 1
+        assert value("counter_total") is None
+
+    def test_reconcile_rollback(
+        self, double_buffered_registry: MetricsRegistry
+    ) -> None:
+        metrics = double_buffered_registry.get_metrics()
+        with pytest.raises(ValueError):
+            double_buffered_registry.reconcile_metrics(
+                [
+                    MetricConfig("gauge", "A gauge", "counter"),
+                    MetricConfig("counter", "A counter", "counter"),
+                    MetricConfig(
+                        "enum", "An enum", "enum", config={"states": []}
+                    ),
+                ]
+            )
+        assert double_buffered_registry.get_metrics() == metrics
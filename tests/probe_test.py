@@ -0,0 +1,391 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Iterator, Mapping
+import typing as t
+
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestClient
+from prometheus_client import CollectorRegistry, Gauge
+from prometheus_client.metrics import MetricWrapperBase
+import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._probe import (
+    CLIENT_SESSION_APP_KEY,
+    Prober,
+    RegistryCache,
+)
+from prometheus_aioexporter._web import (
+    PrometheusExporter,
+    PrometheusExporterConfig,
+)
+
+AiohttpClientFixture = Callable[..., Awaitable[TestClient]]
+
+
+class ProbeRecorder:
+    """Probe handler recording calls and concurrency."""
+
+    def __init__(self) -> None:
+        self.targets: list[str] = []
+        self.sessions: list[ClientSession] = []
+        self.active: dict[str, int] = {}
+        self.max_active = 0
+        self.max_active_per_target = 0
+        self.delay = 0.0
+        self.error: Exception | None = None
+
+    async def __call__(
+        self,
+        target: str,
+        metrics: Mapping[str, MetricWrapperBase],
+        session: ClientSession,
+    ) -> None:
+        self.targets.append(target)
+        self.sessions.append(session)
+        self.active[target] = self.active.get(target, 0) + 1
+        self.max_active = max(self.max_active, sum(self.active.values()))
+        self.max_active_per_target = max(
+            self.max_active_per_target, self.active[target]
+        )
+        try:
+            await asyncio.sleep(self.delay)
+            if self.error:
+                raise self.error
+            t.cast(Gauge, metrics["target_length"]).set(len(target))
+        finally:
+            self.active[target] -= 1
+
+
+@pytest.fixture
+def recorder() -> Iterator[ProbeRecorder]:
+    yield ProbeRecorder()
+
+
+@pytest.fixture
+def make_prober(
+    recorder: ProbeRecorder,
+) -> Iterator[Callable[..., Prober]]:
+    def make(**kwargs: t.Any) -> Prober:
+        return Prober(
+            [MetricConfig("target_length", "length of target", "gauge")],
+            recorder,
+            **kwargs,
+        )
+
+    yield make
+
+
+@pytest.fixture
+def make_client(
+    aiohttp_client: AiohttpClientFixture,
+) -> Iterator[Callable[[Prober], Awaitable[TestClient]]]:
+    async def make(prober: Prober) -> TestClient:
+        config = PrometheusExporterConfig(
+            "test-exporter", "1.2.3", "A test exporter", ["localhost"], 8000
+        )
+        exporter = PrometheusExporter(config, MetricsRegistry())
+        exporter.set_prober(prober)
+        return await aiohttp_client(exporter.app)
+
+    yield make
+
+
+class TestProber:
+    async def test_probe(
+        self,
+        recorder: ProbeRecorder,
+        make_prober: Callable[..., Prober],
+        make_client: Callable[[Prober], Awaitable[TestClient]],
+    ) -> None:
+        client = await make_client(make_prober())
+        response = await client.get("/probe", params={"target": "host1"})
+        assert response.status == 200
+        text = await response.text()
+        assert "target_length 5.0" in text
+        assert "probe_success 1.0" in text
+        assert "probe_duration_seconds " in text
+        assert recorder.targets == ["host1"]
+        [session] = recorder.sessions
+        assert session is client.app[CLIENT_SESSION_APP_KEY]
+
+    async def test_probe_separate_registries(
+        self,
+        recorder: ProbeRecorder,
+        make_prober: Callable[..., Prober],
+        make_client: Callable[[Prober], Awaitable[TestClient]],
+    ) -> None:
+        client = await make_client(make_prober())
+        await client.get("/probe", params={"target": "longer-host"})
+        response = await client.get("/probe", params={"target": "host"})
+        assert "target_length 4.0" in await response.text()
+        # the client session is shared across probes
+        assert recorder.sessions[0] is recorder.sessions[1]
+
+    async def test_probe_missing_target(
+        self,
+        make_prober: Callable[..., Prober],
+        make_client: Callable[[Prober], Awaitable[TestClient]],
+    ) -> None:
+        client = await make_client(make_prober())
+        response = await client.get("/probe")
+        assert response.status == 400
+        assert await response.text() == "Missing 'target' parameter"
+
+    async def test_probe_failure(
+        self,
+        log: StructuredLogCapture,
+        recorder: ProbeRecorder,
+        make_prober: Callable[..., Prober],
+        make_client: Callable[[Prober], Awaitable[TestClient]],
+    ) -> None:
+        recorder.error = Exception("unreachable")
+        client = await make_client(make_prober())
+        response = await client.get("/probe", params={"target": "host1"})
+        assert response.status == 200
+        assert "probe_success 0.0" in await response.text()
+        assert log.has(
+            "probe failed",
+            target="host1",
+            error="unreachable",
+            level="warning",
+        )
+
+    async def test_probe_timeout(
+        self,
+        log: StructuredLogCapture,
+        recorder: ProbeRecorder,
+        make_prober: Callable[..., Prober],
+    ) -> None:
+        recorder.delay = 1.0
+        prober = make_prober(timeout=0.01)
+        async with ClientSession() as session:
+            registry = await prober.probe("host1", session)
+        assert registry.registry.get_sample_value("probe_success") == 0.0
+        assert log.has("probe failed", error="TimeoutError")
+
+    async def test_probe_target_concurrency(
+        self, recorder: ProbeRecorder, make_prober: Callable[..., Prober]
+    ) -> None:
+        recorder.delay = 0.01
+        prober = make_prober(max_target_concurrency=2)
+        async with ClientSession() as session:
+            await asyncio.gather(
+                *(prober.probe(target, session) for target in ["a", "b"] * 3)
+            )
+        assert recorder.max_active_per_target == 2
+        assert recorder.max_active == 4
+        # per-target limits are dropped when unused
+        assert prober._target_slots == {}
+
+    async def test_probe_global_concurrency(
+        self, recorder: ProbeRecorder, make_prober: Callable[..., Prober]
+    ) -> None:
+        recorder.delay = 0.01
+        prober = make_prober(max_concurrency=3)
+        async with ClientSession() as session:
+            await asyncio.gather(
+                *(prober.probe(str(i), session) for i in range(10))
+            )
+        assert recorder.max_active == 3
+        assert len(recorder.targets) == 10
+
+    async def test_probe_cancelled_while_waiting(
+        self, recorder: ProbeRecorder, make_prober: Callable[..., Prober]
+    ) -> None:
+        recorder.delay = 0.05
+        prober = make_prober()
+        async with ClientSession() as session:
+            first = asyncio.create_task(prober.probe("a", session))
+            second = asyncio.create_task(prober.probe("a", session))
+            await asyncio.sleep(0.01)
+            second.cancel()
+            await first
+            with pytest.raises(asyncio.CancelledError):
+                await second
+        assert prober._target_slots == {}
+
+    async def test_probe_cached_registry(
+        self,
+        recorder: ProbeRecorder,
+        make_prober: Callable[..., Prober],
+        make_client: Callable[[Prober], Awaitable[TestClient]],
+    ) -> None:
+        prober = make_prober(cache=RegistryCache())
+        client = await make_client(prober)
+        await client.get("/probe", params={"target": "host1"})
+        assert prober.cache is not None
+        registry = prober.cache.get("host1")
+        await client.get("/probe", params={"target": "host1"})
+        # the same registry is reused
+        assert prober.cache.get("host1") is registry
+        response = await client.get("/metrics")
+        text = await response.text()
+        assert 'exporter_probe_cache_requests_total{result="hit"} 3.0' in text
+        assert "exporter_probe_cache_registries 1.0" in text
+
+    async def test_probe_cached_registry_series_cleared(self) -> None:
+        labels = iter([["a", "b"], ["c"]])
+
+        async def handler(
+            target: str,
+            metrics: Mapping[str, MetricWrapperBase],
+            session: ClientSession,
+        ) -> None:
+            values = next(labels, None)
+            if values is None:
+                raise Exception("unreachable")
+            gauge = t.cast(Gauge, metrics["labelled"])
+            for value in values:
+                gauge.labels(l=value).set(1)
+
+        prober = Prober(
+            [MetricConfig("labelled", "a gauge", "gauge", labels=("l",))],
+            handler,
+            cache=RegistryCache(),
+        )
+        async with ClientSession() as session:
+            await prober.probe("host1", session)
+            registry = await prober.probe("host1", session)
+            value = registry.registry.get_sample_value
+            # series from the previous probe are removed
+            assert value("labelled", {"l": "a"}) is None
+            assert value("labelled", {"l": "c"}) == 1
+            registry = await prober.probe("host1", session)
+        # series from the last successful probe are not exported for a
+        # failed one
+        assert value("labelled", {"l": "c"}) is None
+        assert value("probe_success") == 0
+
+    async def test_probe_cached_registry_concurrent(self) -> None:
+        async def handler(
+            target: str,
+            metrics: Mapping[str, MetricWrapperBase],
+            session: ClientSession,
+        ) -> None:
+            gauge = t.cast(Gauge, metrics["labelled"])
+            gauge.labels(l=str(id(asyncio.current_task()))).set(1)
+            await asyncio.sleep(0.01)
+
+        prober = Prober(
+            [MetricConfig("labelled", "a gauge", "gauge", labels=("l",))],
+            handler,
+            max_target_concurrency=2,
+            cache=RegistryCache(),
+        )
+        async with ClientSession() as session:
+            await prober.probe("host1", session)
+            registries = await asyncio.gather(
+                prober.probe("host1", session),
+                prober.probe("host1", session),
+            )
+        # the cached registry is not shared by concurrent probes, so series
+        # from one are not cleared by the other
+        assert registries[0] is not registries[1]
+        for registry in registries:
+            [metric] = [
+                metric
+                for metric in registry.registry.collect()
+                if metric.name == "labelled"
+            ]
+            assert len(metric.samples) == 1
+
+
+def make_registry(series: int = 0) -> MetricsRegistry:
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [
+            MetricConfig("plain", "a gauge", "gauge"),
+            MetricConfig("labelled", "a gauge", "gauge", labels=("l",)),
+        ]
+    )
+    gauge = t.cast(Gauge, registry.get_metric("labelled"))
+    for i in range(series):
+        gauge.labels(l=str(i)).set(i)
+    return registry
+
+
+class TestRegistryCache:
+    def test_get_miss(self) -> None:
+        cache = RegistryCache()
+        assert cache.get("host1") is None
+        assert cache.size == 0
+
+    def test_put_get(self) -> None:
+        cache = RegistryCache()
+        registry = make_registry(series=2)
+        cache.put("host1", registry)
+        assert cache.get("host1") is registry
+        assert cache.size == 1
+        assert cache.series == 3
+
+    def test_put_replace(self) -> None:
+        cache = RegistryCache()
+        cache.put("host1", make_registry(series=2))
+        registry = make_registry(series=5)
+        cache.put("host1", registry)
+        assert cache.get("host1") is registry
+        assert cache.series == 6
+
+    def test_evict_lru(self) -> None:
+        cache = RegistryCache(max_size=2)
+        cache.put("host1", make_registry())
+        cache.put("host2", make_registry())
+        cache.get("host1")
+        cache.put("host3", make_registry())
+        assert cache.get("host2") is None
+        assert cache.get("host1") is not None
+        assert cache.get("host3") is not None
+
+    def test_evict_max_series(self) -> None:
+        cache = RegistryCache(max_series=10)
+        cache.put("host1", make_registry(series=4))
+        cache.put("host2", make_registry(series=4))
+        cache.put("host3", make_registry(series=4))
+        assert cache.get("host1") is None
+        assert cache.series == 10
+
+    def test_evict_expired(self, mocker: MockerFixture) -> None:
+        monotonic = mocker.patch("time.monotonic", return_value=100.0)
+        cache = RegistryCache(ttl=10.0)
+        cache.put("host1", make_registry())
+        cache.put("host2", make_registry())
+        monotonic.return_value = 105.0
+        # using an entry extends its expiry
+        assert cache.get("host2") is not None
+        monotonic.return_value = 112.0
+        assert cache.get("host1") is None
+        assert cache.get("host2") is not None
+        monotonic.return_value = 130.0
+        assert cache.get("host2") is None
+
+    def test_collect(self, mocker: MockerFixture) -> None:
+        monotonic = mocker.patch("time.monotonic", return_value=100.0)
+        cache = RegistryCache(max_size=1, ttl=10.0)
+        cache.put("host1", make_registry(series=2))
+        cache.get("host1")
+        cache.put("host2", make_registry(series=1))
+        monotonic.return_value = 200.0
+        cache.get("host2")
+        cache.put("host3", make_registry())
+        registry = CollectorRegistry()
+        registry.register(cache)
+        assert (
+            registry.get_sample_value("exporter_probe_cache_registries") == 1
+        )
+        assert registry.get_sample_value("exporter_probe_cache_series") == 1
+        for result, value in [("hit", 1), ("miss", 1)]:
+            assert (
+                registry.get_sample_value(
+                    "exporter_probe_cache_requests_total", {"result": result}
+                )
+                == value
+            )
+        for reason, value in [("expired", 1), ("size", 1), ("series", 0)]:
+            assert (
+                registry.get_sample_value(
+                    "exporter_probe_cache_evictions_total", {"reason": reason}
+                )
+                == value
+            )
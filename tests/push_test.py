@@ -0,0 +1,235 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Iterator, Mapping
+from dataclasses import dataclass, field
+import typing as t
+
+from aiohttp.test_utils import TestServer
+from aiohttp.web import Application, Request, Response
+from prometheus_client import Gauge
+from prometheus_client.metrics import MetricWrapperBase
+import pytest
+from pytest_mock import MockerFixture
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._push import (
+    MetricsPusher,
+    PushError,
+    pushgateway_url,
+    retry_with_backoff,
+)
+from prometheus_aioexporter._web import (
+    PrometheusExporter,
+    PrometheusExporterConfig,
+)
+
+AiohttpServerFixture = Callable[..., Awaitable[TestServer]]
+
+
+@dataclass
+class Pushgateway:
+    """A stand-in Pushgateway."""
+
+    statuses: list[int] = field(default_factory=list)
+    pushes: list[tuple[str, dict[str, str], bytes]] = field(
+        default_factory=list
+    )
+
+    async def handle(self, request: Request) -> Response:
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = await request.read()
+        self.pushes.append((request.path, dict(request.headers), body))
+        return Response(status=status, text="" if status < 300 else "failed")
+
+
+@pytest.fixture
+def pushgateway() -> Iterator[Pushgateway]:
+    yield Pushgateway()
+
+
+@pytest.fixture
+async def pushgateway_server(
+    aiohttp_server: AiohttpServerFixture, pushgateway: Pushgateway
+) -> TestServer:
+    app = Application()
+    app.router.add_put("/metrics/{path:.*}", pushgateway.handle)
+    return await aiohttp_server(app)
+
+
+@pytest.fixture
+def exporter() -> Iterator[PrometheusExporter]:
+    registry = MetricsRegistry()
+    registry.create_metrics([MetricConfig("test_gauge", "a gauge", "gauge")])
+    config = PrometheusExporterConfig(
+        "test-exporter", "1.2.3", "A test exporter", ["localhost"], 8000
+    )
+    exporter = PrometheusExporter(config, registry)
+
+    async def update_handler(metrics: Mapping[str, MetricWrapperBase]) -> None:
+        t.cast(Gauge, metrics["test_gauge"]).inc()
+
+    exporter.set_metric_update_handler(update_handler)
+    yield exporter
+
+
+@pytest.fixture
+def make_pusher(
+    exporter: PrometheusExporter, pushgateway_server: TestServer
+) -> Iterator[Callable[..., MetricsPusher]]:
+    def make(**kwargs: t.Any) -> MetricsPusher:
+        kwargs.setdefault("backoff", 0.0)
+        return MetricsPusher(
+            exporter,
+            str(pushgateway_server.make_url("/")),
+            "test-job",
+            **kwargs,
+        )
+
+    yield make
+
+
+class TestRetryWithBackoff:
+    async def test_success(self) -> None:
+        calls = []
+
+        async def call() -> None:
+            calls.append(None)
+
+        await retry_with_backoff(call, 3, 0.0)
+        assert len(calls) == 1
+
+    async def test_retry(self, mocker: MockerFixture) -> None:
+        sleep = mocker.patch("asyncio.sleep")
+        mocker.patch("random.uniform", return_value=1.0)
+        calls = []
+
+        async def call() -> None:
+            calls.append(None)
+            if len(calls) < 3:
+                raise ValueError("fail")
+
+        await retry_with_backoff(call, 3, 1.0, retry_on=(ValueError,))
+        assert len(calls) == 3
+        assert [c.args for c in sleep.call_args_list] == [(1.0,), (2.0,)]
+
+    async def test_max_backoff(self, mocker: MockerFixture) -> None:
+        sleep = mocker.patch("asyncio.sleep")
+        mocker.patch("random.uniform", return_value=1.0)
+
+        async def call() -> None:
+            raise ValueError("fail")
+
+        with pytest.raises(ValueError):
+            await retry_with_backoff(call, 3, 1.0, max_backoff=1.5)
+        assert [c.args for c in sleep.call_args_list] == [
+            (1.0,),
+            (1.5,),
+            (1.5,),
+        ]
+
+    async def test_not_retried(self) -> None:
+        calls = []
+
+        async def call() -> None:
+            calls.append(None)
+            raise KeyError("fail")
+
+        with pytest.raises(KeyError):
+            await retry_with_backoff(call, 3, 0.0, retry_on=(ValueError,))
+        assert len(calls) == 1
+
+
+class TestPushgatewayURL:
+    @pytest.mark.parametrize(
+        "grouping,path",
+        [
+            (None, "/metrics/job/myjob"),
+            ({"instance": "foo"}, "/metrics/job/myjob/instance/foo"),
+            ({"path": "a/b"}, "/metrics/job/myjob/path@base64/YS9i"),
+            ({"empty": ""}, "/metrics/job/myjob/empty@base64/="),
+            ({"space": "a b"}, "/metrics/job/myjob/space/a%20b"),
+        ],
+    )
+    def test_url(self, grouping: dict[str, str] | None, path: str) -> None:
+        assert (
+            pushgateway_url("http://gw:9091/", "myjob", grouping)
+            == f"http://gw:9091{path}"
+        )
+
+
+class TestMetricsPusher:
+    async def test_push(
+        self,
+        exporter: PrometheusExporter,
+        pushgateway: Pushgateway,
+        make_pusher: Callable[..., MetricsPusher],
+    ) -> None:
+        pusher = make_pusher(grouping={"instance": "foo"})
+        await pusher.start(exporter.app)
+        await pusher.push()
+        await pusher.stop(exporter.app)
+        [(path, headers, body), _] = pushgateway.pushes
+        assert path == "/metrics/job/test-job/instance/foo"
+        assert headers["Content-Encoding"] == "gzip"
+        assert headers["Content-Type"].startswith("text/plain")
+        # the server decompresses the payload
+        assert b"test_gauge 1.0" in body
+
+    async def test_push_retry(
+        self,
+        exporter: PrometheusExporter,
+        pushgateway: Pushgateway,
+        make_pusher: Callable[..., MetricsPusher],
+    ) -> None:
+        pushgateway.statuses = [503, 429]
+        pusher = make_pusher()
+        await pusher.start(exporter.app)
+        await pusher.push()
+        assert len(pushgateway.pushes) == 3
+        await pusher.stop(exporter.app)
+
+    async def test_push_error(
+        self,
+        exporter: PrometheusExporter,
+        pushgateway: Pushgateway,
+        make_pusher: Callable[..., MetricsPusher],
+    ) -> None:
+        pushgateway.statuses = [400]
+        pusher = make_pusher()
+        await pusher.start(exporter.app)
+        with pytest.raises(PushError) as error:
+            await pusher.push()
+        assert error.value.details == "status 400: failed"
+        assert len(pushgateway.pushes) == 1
+        await pusher.stop(exporter.app)
+
+    async def test_periodic_push(
+        self,
+        log: StructuredLogCapture,
+        exporter: PrometheusExporter,
+        pushgateway: Pushgateway,
+        make_pusher: Callable[..., MetricsPusher],
+    ) -> None:
+        pushgateway.statuses = [400]
+        pusher = make_pusher(interval=0.01)
+        await pusher.start(exporter.app)
+        for _ in range(100):
+            if len(pushgateway.pushes) >= 2:
+                break
+            await asyncio.sleep(0.01)
+        await pusher.stop(exporter.app)
+        assert log.has("push failed", url=pusher.url, level="error")
+        assert log.has("metrics pushed", url=pusher.url, level="debug")
+
+    async def test_final_push_error(
+        self,
+        log: StructuredLogCapture,
+        exporter: PrometheusExporter,
+        pushgateway: Pushgateway,
+        make_pusher: Callable[..., MetricsPusher],
+    ) -> None:
+        pushgateway.statuses = [400]
+        pusher = make_pusher()
+        await pusher.start(exporter.app)
+        await pusher.stop(exporter.app)
+        assert log.has("final push failed", url=pusher.url, level="error")
@@ -0,0 +1,440 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Iterator, Mapping
+from dataclasses import dataclass, field
+import struct
+import typing as t
+
+from aiohttp.test_utils import TestServer
+from aiohttp.web import Application, Request, Response
+import cramjam
+from prometheus_client import CollectorRegistry, Counter, Gauge
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.registry import Collector
+import pytest
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._remote_write import (
+    RemoteWriter,
+    TimeSeries,
+    _snappy_compress_literal,
+    encode_write_request,
+    registry_series,
+    snappy_compress,
+)
+from prometheus_aioexporter._web import (
+    PrometheusExporter,
+    PrometheusExporterConfig,
+)
+
+AiohttpServerFixture = Callable[..., Awaitable[TestServer]]
+
+
+def _read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _fields(data: bytes) -> Iterator[tuple[int, t.Any]]:
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 0x07
+        if wire_type == 0:
+            value, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            value = data[pos : pos + 8]
+            pos += 8
+        else:
+            length, pos = _read_varint(data, pos)
+            value = data[pos : pos + length]
+            pos += length
+        yield number, value
+
+
+def decode_write_request(data: bytes) -> list[TimeSeries]:
+    """Decode a WriteRequest protobuf message."""
+    series = []
+    for _, timeseries in _fields(data):
+        labels = []
+        value, timestamp = 0.0, 0
+        for number, content in _fields(timeseries):
+            if number == 1:
+                label = dict(_fields(content))
+                labels.append((label[1].decode(), label[2].decode()))
+            else:
+                sample = dict(_fields(content))
+                [value] = struct.unpack("<d", sample[1])
+                timestamp = sample[2]
+        series.append(TimeSeries(tuple(labels), value, timestamp))
+    return series
+
+
+@dataclass
+class Receiver:
+    """A stand-in remote-write receiver."""
+
+    statuses: list[int] = field(default_factory=list)
+    requests: list[tuple[dict[str, str], list[TimeSeries]]] = field(
+        default_factory=list
+    )
+
+    async def handle(self, request: Request) -> Response:
+        status = self.statuses.pop(0) if self.statuses else 204
+        body = bytes(cramjam.snappy.decompress_raw(await request.read()))
+        self.requests.append(
+            (dict(request.headers), decode_write_request(body))
+        )
+        return Response(status=status, text="" if status < 300 else "failed")
+
+    @property
+    def series(self) -> list[TimeSeries]:
+        return [series for _, batch in self.requests for series in batch]
+
+
+@pytest.fixture
+def receiver() -> Iterator[Receiver]:
+    yield Receiver()
+
+
+@pytest.fixture
+async def receiver_server(
+    aiohttp_server: AiohttpServerFixture, receiver: Receiver
+) -> TestServer:
+    app = Application()
+    app.router.add_post("/api/v1/write", receiver.handle)
+    return await aiohttp_server(app)
+
+
+@pytest.fixture
+def exporter() -> Iterator[PrometheusExporter]:
+    registry = MetricsRegistry()
+    registry.create_metrics(
+        [MetricConfig("test_gauge", "a gauge", "gauge", labels=("id",))]
+    )
+    config = PrometheusExporterConfig(
+        "test-exporter", "1.2.3", "A test exporter", ["localhost"], 8000
+    )
+    exporter = PrometheusExporter(config, registry)
+
+    async def update_handler(metrics: Mapping[str, MetricWrapperBase]) -> None:
+        gauge = t.cast(Gauge, metrics["test_gauge"])
+        for i in range(10):
+            gauge.labels(id=str(i)).set(i)
+
+    exporter.set_metric_update_handler(update_handler)
+    yield exporter
+
+
+@pytest.fixture
+def make_writer(
+    exporter: PrometheusExporter, receiver_server: TestServer
+) -> Iterator[Callable[..., RemoteWriter]]:
+    def make(**kwargs: t.Any) -> RemoteWriter:
+        kwargs.setdefault("backoff", 0.0)
+        kwargs.setdefault("batch_deadline", 0.0)
+        return RemoteWriter(
+            exporter,
+            str(receiver_server.make_url("/api/v1/write")),
+            **kwargs,
+        )
+
+    yield make
+
+
+def gauge_series(series: list[TimeSeries]) -> dict[str, float]:
+    return {
+        dict(labels)["id"]: value
+        for labels, value, _ in series
+        if dict(labels)["__name__"] == "test_gauge"
+    }
+
+
+class TestEncodeWriteRequest:
+    def test_encode(self) -> None:
+        series = [
+            TimeSeries((("__name__", "foo"), ("a", "b")), 1.5, 1000),
+            TimeSeries((("__name__", "bar"),), -3.0, 1700000000000),
+        ]
+        assert decode_write_request(encode_write_request(series)) == series
+
+    def test_encode_empty(self) -> None:
+        assert encode_write_request([]) == b""
+
+    def test_encode_long_values(self) -> None:
+        series = [TimeSeries((("__name__", "foo"), ("a", "x" * 300)), 0, 0)]
+        assert decode_write_request(encode_write_request(series)) == series
+
+
+class TestSnappyCompress:
+    def test_compress(self) -> None:
+        data = b"foo" * 1000
+        compressed = snappy_compress(data)
+        assert len(compressed) < len(data)
+        assert bytes(cramjam.snappy.decompress_raw(compressed)) == data
+
+    @pytest.mark.parametrize("size", [0, 1, 60, 200, 300, 70000])
+    def test_compress_literal(self, size: int) -> None:
+        data = bytes(i % 251 for i in range(size))
+        compressed = _snappy_compress_literal(data)
+        assert bytes(cramjam.snappy.decompress_raw(compressed)) == data
+
+
+class TestRegistrySeries:
+    def test_series(self) -> None:
+        registry = CollectorRegistry()
+        counter = Counter("c", "a counter", ["a"], registry=registry)
+        counter.labels(a="x").inc(3)
+        series = list(
+            registry_series(registry, 1000, external_labels={"site": "s1"})
+        )
+        assert series == [
+            TimeSeries(
+                (("__name__", "c_total"), ("a", "x"), ("site", "s1")),
+                3.0,
+                1000,
+            )
+        ]
+
+    def test_series_labels_override_external(self) -> None:
+        registry = CollectorRegistry()
+        gauge = Gauge("g", "a gauge", ["site"], registry=registry)
+        gauge.labels(site="local").set(1)
+        [series] = registry_series(registry, 1000, {"site": "s1"})
+        assert series.labels == (("__name__", "g"), ("site", "local"))
+
+    def test_series_sample_timestamp(self) -> None:
+        class TimestampCollector(Collector):
+            def collect(self) -> Iterator[GaugeMetricFamily]:
+                metric = GaugeMetricFamily("g", "a gauge")
+                metric.add_metric([], 2.0, timestamp=12.5)
+                yield metric
+
+        registry = CollectorRegistry()
+        registry.register(TimestampCollector())
+        [series] = registry_series(registry, 1000)
+        assert series.timestamp == 12500
+
+
+class TestRemoteWriter:
+    async def test_send(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer(
+            shards=2, external_labels={"site": "s1"}, interval=60
+        )
+        await writer.start(exporter.app)
+        await writer.collect()
+        await writer.stop(exporter.app)
+        [(headers, _), *_] = receiver.requests
+        assert headers["Content-Encoding"] == "snappy"
+        assert headers["Content-Type"] == "application/x-protobuf"
+        assert headers["X-Prometheus-Remote-Write-Version"] == "0.1.0"
+        assert gauge_series(receiver.series) == {
+            str(i): float(i) for i in range(10)
+        }
+        assert all(
+            dict(series.labels)["site"] == "s1" for series in receiver.series
+        )
+        # samples are sent again at shutdown
+        assert [
+            dict(series.labels)["__name__"] for series in receiver.series
+        ].count("test_gauge") == 20
+        registry = exporter.registry.registry
+        assert registry.get_sample_value(
+            "exporter_remote_write_samples_sent_total"
+        ) == len(receiver.series)
+        assert registry.get_sample_value(
+            "exporter_remote_write_send_duration_seconds_count"
+        ) == len(receiver.requests)
+        assert (
+            registry.get_sample_value(
+                "exporter_remote_write_pending_samples", {"shard": "1"}
+            )
+            == 0
+        )
+
+    async def test_send_batches(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer(shards=1, max_samples_per_send=4, interval=60)
+        await writer.start(exporter.app)
+        await writer.stop(exporter.app)
+        assert all(len(batch) <= 4 for _, batch in receiver.requests)
+        assert len(gauge_series(receiver.series)) == 10
+
+    async def test_batch_deadline(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer(shards=1, batch_deadline=0.05, interval=60)
+        await writer.start(exporter.app)
+        await writer.collect()
+        await asyncio.sleep(0.01)
+        # more samples are added to the batch before the deadline
+        await writer.collect()
+        for _ in range(100):
+            if receiver.requests:
+                break
+            await asyncio.sleep(0.01)
+        await writer.stop(exporter.app)
+        [(_, batch), *_] = receiver.requests
+        assert [dict(series.labels)["__name__"] for series in batch].count(
+            "test_gauge"
+        ) == 20
+
+    async def test_queue_full(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer(shards=1, capacity=5, interval=60)
+        await exporter.update_metrics()
+        samples = len(list(registry_series(exporter.registry.registry, 0)))
+        await writer.collect()
+        assert (
+            exporter.registry.registry.get_sample_value(
+                "exporter_remote_write_pending_samples", {"shard": "0"}
+            )
+            == 5
+        )
+        assert (
+            exporter.registry.registry.get_sample_value(
+                "exporter_remote_write_samples_dropped_total",
+                {"reason": "queue_full"},
+            )
+            == samples - 5
+        )
+
+    async def test_send_retry(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        receiver.statuses = [503, 429]
+        writer = make_writer(shards=1, interval=60)
+        await writer.start(exporter.app)
+        await writer.stop(exporter.app)
+        assert len(receiver.requests) == 3
+        assert gauge_series(receiver.requests[-1][1]) == {
+            str(i): float(i) for i in range(10)
+        }
+
+    @pytest.mark.parametrize(
+        "statuses,reason", [([400], "rejected"), ([500, 500], "failed")]
+    )
+    async def test_send_error(
+        self,
+        log: StructuredLogCapture,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+        statuses: list[int],
+        reason: str,
+    ) -> None:
+        receiver.statuses = list(statuses)
+        writer = make_writer(shards=1, retries=1, interval=60)
+        await writer.start(exporter.app)
+        await writer.stop(exporter.app)
+        assert len(receiver.requests) == len(statuses)
+        [(_, batch)] = receiver.requests[:1]
+        assert exporter.registry.registry.get_sample_value(
+            "exporter_remote_write_samples_dropped_total", {"reason": reason}
+        ) == len(batch)
+        assert log.has("remote write failed", url=writer.url, level="error")
+
+    async def test_periodic_collection(
+        self,
+        log: StructuredLogCapture,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        calls = 0
+
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise Exception("update failed")
+            t.cast(Gauge, metrics["test_gauge"]).labels(id="x").set(1)
+
+        exporter.set_metric_update_handler(update_handler)
+        writer = make_writer(interval=0.01)
+        await writer.start(exporter.app)
+        for _ in range(100):
+            if receiver.requests:
+                break
+            await asyncio.sleep(0.01)
+        await writer.stop(exporter.app)
+        assert gauge_series(receiver.series) == {"x": 1.0}
+        assert log.has(
+            "remote write collection failed",
+            error="update failed",
+            level="error",
+        )
+
+    async def test_flush_error(
+        self,
+        log: StructuredLogCapture,
+        exporter: PrometheusExporter,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            raise Exception("update failed")
+
+        exporter.set_metric_update_handler(update_handler)
+        writer = make_writer(interval=60)
+        await writer.start(exporter.app)
+        await writer.stop(exporter.app)
+        assert log.has(
+            "remote write flush failed",
+            url=writer.url,
+            error="update failed",
+            level="error",
+        )
+
+    async def test_stop_not_started(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer()
+        await writer.stop(exporter.app)
+        assert receiver.requests == []
+
+    async def test_stop_twice(
+        self,
+        exporter: PrometheusExporter,
+        receiver: Receiver,
+        make_writer: Callable[..., RemoteWriter],
+    ) -> None:
+        writer = make_writer(interval=60)
+        await writer.start(exporter.app)
+        await writer.stop(exporter.app)
+        requests = len(receiver.requests)
+        # stopping again is a no-op
+        await writer.stop(exporter.app)
+        assert len(receiver.requests) == requests
@@ -1,4 +1,4 @@
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterator, Mapping
 from importlib.metadata import PackageNotFoundError
 from pathlib import Path
 from ssl import SSLContext
@@ -6,16 +6,28 @@ from textwrap import dedent
 import typing as t
 from unittest import mock
 
+from aiohttp import ClientSession
 import click
 from click.testing import CliRunner, Result
+from prometheus_client.metrics import MetricWrapperBase
 import pytest
 from pytest_mock import MockerFixture
 from pytest_structlog import StructuredLogCapture
 
-from prometheus_aioexporter._log import AccessLogger, LogFormat, LogLevel
+from prometheus_aioexporter._cardinality import SeriesBudget
+from prometheus_aioexporter._log import (
+    AccessLogger,
+    LogFormat,
+    LogLevel,
+    QueueLogWriter,
+)
 from prometheus_aioexporter._metric import MetricConfig
+from prometheus_aioexporter._probe import Prober
+from prometheus_aioexporter._push import MetricsPusher
+from prometheus_aioexporter._remote_write import RemoteWriter
 from prometheus_aioexporter._script import Arguments, PrometheusExporterScript
-from prometheus_aioexporter._web import PrometheusExporterConfig
+from prometheus_aioexporter._snapshot import MetricsSnapshotter
+from prometheus_aioexporter._web import EventLoop, PrometheusExporterConfig
 
 
 class SampleScript(PrometheusExporterScript):
@@ -37,10 +49,45 @@ def make_arguments() -> Iterator[Callable[..., Arguments]]:
         args = {
             "host": ("localhost",),
             "port": 9090,
+            "unix_socket": None,
+            "socket_activation": False,
+            "listen_backlog": 128,
+            "keepalive_timeout": 75.0,
+            "event_loop": EventLoop.ASYNCIO,
             "metrics_path": "/metrics",
             "log_level": LogLevel.INFO,
             "log_format": LogFormat.PLAIN,
+            "log_queue_size": 0,
+            "access_log_sample_rate": 1.0,
             "process_stats": False,
+            "metrics_config": None,
+            "metrics_config_cache": None,
+            "metrics_config_watch_interval": 0.0,
+            "scrape_concurrency": 0,
+            "scrape_queue_size": 0,
+            "scrape_queue_timeout": 10.0,
+            "scrape_min_interval": 0.0,
+            "scrape_client_header": None,
+            "ready_max_age": 0.0,
+            "loop_monitor_interval": 0.0,
+            "slow_callback_duration": 0.1,
+            "server_timing": False,
+            "debug_cardinality": False,
+            "series_soft_limit": 0,
+            "series_hard_limit": 0,
+            "memory_soft_limit": 0,
+            "memory_hard_limit": 0,
+            "update_queue_interval": 0.0,
+            "update_queue_size": 100000,
+            "push_gateway": None,
+            "push_interval": 15.0,
+            "push_job": "sample-script",
+            "push_grouping": {},
+            "remote_write_url": None,
+            "remote_write_interval": 15.0,
+            "remote_write_shards": 4,
+            "snapshot_file": None,
+            "snapshot_interval": 60.0,
             "ssl_private_key": None,
             "ssl_public_key": None,
             "ssl_ca": None,
@@ -208,6 +255,12 @@ class TestPrometheusExporterScript:
         assert args.log_format == LogFormat.JSON
         assert args.log_level == LogLevel.DEBUG
 
+    def test_arguments_event_loop(
+        self, parse_arguments: Callable[..., Arguments]
+    ) -> None:
+        args = parse_arguments("--event-loop", "uvloop")
+        assert args.event_loop == EventLoop.UVLOOP
+
     def test_arguments_from_cli(
         self,
         make_arguments: Callable[..., Arguments],
@@ -312,6 +365,18 @@ class TestPrometheusExporterScript:
         assert metrics["m1"]._type == "counter"
         assert metrics["m2"]._type == "histogram"
 
+    def test_lazy_metrics(self) -> None:
+        class Script(PrometheusExporterScript):
+            lazy_metrics = True
+
+        assert Script().registry.lazy
+
+    def test_double_buffered_metrics(self) -> None:
+        class Script(PrometheusExporterScript):
+            double_buffered_metrics = True
+
+        assert Script().registry.double_buffered
+
     def test_change_metrics_path(
         self,
         script: PrometheusExporterScript,
@@ -321,6 +386,159 @@ class TestPrometheusExporterScript:
         config = get_exporter_config(script, args)
         assert config.metrics_path == "/other-path"
 
+    def test_listen_options(
+        self,
+        tmp_path: Path,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(
+            unix_socket=tmp_path / "exporter.sock",
+            socket_activation=True,
+            listen_backlog=10,
+            keepalive_timeout=5.0,
+        )
+        config = get_exporter_config(script, args)
+        assert config.unix_socket == tmp_path / "exporter.sock"
+        assert config.socket_activation
+        assert config.backlog == 10
+        assert config.keepalive_timeout == 5.0
+
+    def test_scrape_admission_options(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments(
+            "--scrape-concurrency",
+            "2",
+            "--scrape-queue-size",
+            "5",
+            "--scrape-queue-timeout",
+            "3",
+            "--scrape-min-interval",
+            "10",
+            "--scrape-client-header",
+            "X-Forwarded-For",
+        )
+        config = get_exporter_config(script, args)
+        assert config.scrape_concurrency == 2
+        assert config.scrape_queue_size == 5
+        assert config.scrape_queue_timeout == 3.0
+        assert config.scrape_min_interval == 10.0
+        assert config.scrape_client_header == "X-Forwarded-For"
+
+    def test_ready_max_age(
+        self,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(ready_max_age=30.0)
+        config = get_exporter_config(script, args)
+        assert config.ready_max_age == 30.0
+
+    def test_loop_monitor(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments(
+            "--loop-monitor-interval", "1", "--slow-callback-duration", "0.5"
+        )
+        config = get_exporter_config(script, args)
+        assert config.loop_monitor_interval == 1.0
+        assert config.slow_callback_duration == 0.5
+
+    def test_server_timing(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments("--server-timing")
+        config = get_exporter_config(script, args)
+        assert config.server_timing
+
+    def test_debug_cardinality(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments("--debug-cardinality")
+        script.registry.track_series = True
+        config = get_exporter_config(script, args)
+        assert config.debug_cardinality
+
+    @pytest.mark.parametrize(
+        "args,track_series",
+        [
+            ((), False),
+            (("--debug-cardinality",), True),
+            (("--series-hard-limit", "100"), True),
+            (("--memory-soft-limit", "1000"), True),
+        ],
+    )
+    def test_track_series(
+        self,
+        script: PrometheusExporterScript,
+        invoke_cli: Callable[..., Result],
+        args: tuple[str, ...],
+        track_series: bool,
+    ) -> None:
+        result = invoke_cli(*args)
+        assert result.exit_code == 0
+        assert script.registry.track_series == track_series
+
+    def test_update_queue_interval(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments("--update-queue-interval", "0.5")
+        config = get_exporter_config(script, args)
+        assert config.update_queue_interval == 0.5
+
+    def test_update_queue_size(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments("--update-queue-size", "10")
+        config = get_exporter_config(script, args)
+        assert config.update_queue_size == 10
+
+    def test_series_budget(
+        self,
+        script: PrometheusExporterScript,
+        parse_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = parse_arguments(
+            "--series-soft-limit",
+            "100",
+            "--series-hard-limit",
+            "200",
+            "--memory-soft-limit",
+            "1000",
+            "--memory-hard-limit",
+            "2000",
+        )
+        script.registry.track_series = True
+        config = get_exporter_config(script, args)
+        assert config.series_budget == SeriesBudget(
+            soft_max_series=100,
+            max_series=200,
+            soft_max_memory=1000,
+            max_memory=2000,
+        )
+
+    def test_event_loop(
+        self,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(event_loop=EventLoop.UVLOOP)
+        config = get_exporter_config(script, args)
+        assert config.event_loop == EventLoop.UVLOOP
+
     def test_only_ssl_key(
         self,
         script: PrometheusExporterScript,
@@ -386,6 +604,170 @@ class TestPrometheusExporterScript:
             in script.registry.registry._names_to_collectors
         )
 
+    def test_metrics_config(
+        self,
+        tmp_path: Path,
+        script: PrometheusExporterScript,
+        invoke_cli: Callable[..., Result],
+    ) -> None:
+        metrics_config = tmp_path / "metrics.yaml"
+        metrics_config.write_text(
+            dedent(
+                """\
+                metrics:
+                  - name: m1
+                    description: a metric
+                    type: gauge
+                """
+            )
+        )
+        result = invoke_cli(
+            "--metrics-config",
+            str(metrics_config),
+            "--metrics-config-cache",
+            str(tmp_path / "cache"),
+        )
+        assert result.exit_code == 0
+        assert script.registry.get_metric("m1")._type == "gauge"
+        assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    def test_metrics_config_registers_reloader(
+        self,
+        tmp_path: Path,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        metrics_config = tmp_path / "metrics.json"
+        metrics_config.write_text('{"metrics": []}')
+        args = make_arguments(metrics_config=metrics_config)
+        script._load_metrics_config(args)
+        reloader = script._metrics_config_reloader
+        assert reloader is not None
+        exporter = script._get_exporter(args)
+        assert reloader.start in exporter.app.on_startup
+        assert reloader.stop in exporter.app.on_cleanup
+
+    def test_log_queue(
+        self,
+        mocker: MockerFixture,
+        script: PrometheusExporterScript,
+        invoke_cli: Callable[..., Result],
+    ) -> None:
+        writer = QueueLogWriter(mocker.Mock())
+        mock_setup_logging = mocker.patch(
+            "prometheus_aioexporter._script.setup_logging",
+            return_value=writer,
+        )
+        result = invoke_cli(
+            "--log-queue-size", "100", "--access-log-sample-rate", "0.1"
+        )
+        assert result.exit_code == 0
+        mock_setup_logging.assert_called_once_with(
+            LogFormat.PLAIN,
+            LogLevel.INFO,
+            queue_size=100,
+            access_log_sample_rate=0.1,
+        )
+        assert (
+            "exporter_log_entries_dropped"
+            in script.registry.registry._names_to_collectors
+        )
+
+    def test_push_gateway(
+        self,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(
+            push_gateway="http://gw:9091",
+            push_grouping={"instance": "foo"},
+        )
+        exporter = script._get_exporter(args)
+        [pusher] = [
+            owner
+            for handler in exporter.app.on_startup
+            if isinstance(
+                owner := getattr(handler, "__self__", None), MetricsPusher
+            )
+        ]
+        assert pusher.url == (
+            "http://gw:9091/metrics/job/sample-script/instance/foo"
+        )
+        # the final push happens before the script shutdown handler runs
+        shutdown = list(exporter.app.on_shutdown)
+        assert shutdown.index(pusher.stop) < shutdown.index(
+            script.on_application_shutdown
+        )
+
+    def test_remote_write(
+        self,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(
+            remote_write_url="http://receiver/api/v1/write",
+            remote_write_shards=2,
+        )
+        exporter = script._get_exporter(args)
+        [writer] = [
+            owner
+            for handler in exporter.app.on_startup
+            if isinstance(
+                owner := getattr(handler, "__self__", None), RemoteWriter
+            )
+        ]
+        assert writer.url == "http://receiver/api/v1/write"
+        assert len(writer._queues) == 2
+        # the final send happens before the script shutdown handler runs
+        shutdown = list(exporter.app.on_shutdown)
+        assert shutdown.index(writer.stop) < shutdown.index(
+            script.on_application_shutdown
+        )
+
+    def test_snapshot(
+        self,
+        tmp_path: Path,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        args = make_arguments(
+            snapshot_file=tmp_path / "snapshot", snapshot_interval=30.0
+        )
+        exporter = script._get_exporter(args)
+        startup = list(exporter.app.on_startup)
+        [snapshotter] = [
+            owner
+            for handler in startup
+            if isinstance(
+                owner := getattr(handler, "__self__", None),
+                MetricsSnapshotter,
+            )
+        ]
+        assert snapshotter.path == tmp_path / "snapshot"
+        assert snapshotter.interval == 30.0
+        # values are restored before the script startup handler, and saved
+        # after the shutdown one
+        assert startup.index(snapshotter.start) < startup.index(
+            script.on_application_startup
+        )
+        assert list(exporter.app.on_shutdown)[-1] == snapshotter.stop
+
+    def test_push_grouping(
+        self, parse_arguments: Callable[..., Arguments]
+    ) -> None:
+        args = parse_arguments(
+            "--push-grouping", "instance=foo", "--push-grouping", "empty="
+        )
+        assert args.push_grouping == {"instance": "foo", "empty": ""}
+
+    @pytest.mark.parametrize("value", ["foo", "=foo"])
+    def test_push_grouping_invalid(
+        self, invoke_cli: Callable[..., Result], value: str
+    ) -> None:
+        result = invoke_cli("--push-grouping", value)
+        assert result.exit_code == 2
+        assert "must be LABEL=VALUE" in result.output
+
     def test_get_exporter_registers_handlers(
         self,
         script: PrometheusExporterScript,
@@ -396,6 +778,29 @@ class TestPrometheusExporterScript:
         assert script.on_application_startup in exporter.app.on_startup
         assert script.on_application_shutdown in exporter.app.on_shutdown
 
+    def test_get_exporter_prober(
+        self,
+        script: PrometheusExporterScript,
+        make_arguments: Callable[..., Arguments],
+    ) -> None:
+        async def probe_handler(
+            target: str,
+            metrics: Mapping[str, MetricWrapperBase],
+            session: ClientSession,
+        ) -> None:
+            pass
+
+        script.prober = Prober([], probe_handler)
+        exporter = script._get_exporter(make_arguments())
+        [route] = [
+            route
+            for route in exporter.app.router.routes()
+            if route.method == "GET"
+            and route.resource
+            and route.resource.canonical == "/probe"
+        ]
+        assert route.handler == script.prober.handle_probe
+
     def test_script_run_exporter_ssl(
         self,
         mock_run_app: mock.MagicMock,
@@ -428,6 +833,8 @@ class TestPrometheusExporterScript:
             mock.ANY,
             host=("localhost",),
             port=12345,
+            backlog=128,
+            keepalive_timeout=75.0,
             print=mock.ANY,
             access_log_class=AccessLogger,
             ssl_context=None,
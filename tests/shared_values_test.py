@@ -0,0 +1,396 @@
+from collections.abc import Callable, Iterator
+import multiprocessing
+import os
+from pathlib import Path
+import typing as t
+
+from prometheus_client import Counter, Enum, Gauge, Histogram, Summary
+import pytest
+from pytest_mock import MockerFixture
+
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._shared_values import (
+    SharedValueStore,
+    SharedValueStoreError,
+)
+
+
+@pytest.fixture
+def make_store(
+    tmp_path: Path,
+) -> Iterator[Callable[..., SharedValueStore]]:
+    stores = []
+
+    def make(**kwargs: t.Any) -> SharedValueStore:
+        store = SharedValueStore(tmp_path / "values", **kwargs)
+        stores.append(store)
+        return store
+
+    yield make
+    for store in stores:
+        store.close()
+
+
+@pytest.fixture
+def store(make_store: Callable[..., SharedValueStore]) -> SharedValueStore:
+    return make_store()
+
+
+def sample_values(store: SharedValueStore) -> dict[str, float]:
+    return {
+        sample.name + str(sorted(sample.labels.items())): sample.value
+        for metric in store.read_metrics()
+        for sample in metric.samples
+    }
+
+
+def increment_in_process(counter: Counter, amount: float) -> None:
+    counter.labels(l="a").inc(amount)
+
+
+class TestSharedValueStore:
+    def test_file_created(
+        self, tmp_path: Path, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        make_store(initial_size=4096)
+        data = (tmp_path / "values").read_bytes()
+        assert len(data) == 4096
+        assert data.startswith(b"PAEXVALS")
+
+    def test_invalid_file(
+        self, tmp_path: Path, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        (tmp_path / "values").write_bytes(b"x" * 100)
+        with pytest.raises(SharedValueStoreError) as error:
+            make_store()
+        assert error.value.details == "unknown file format"
+        assert str(error.value) == (
+            f"Invalid shared values file {tmp_path / 'values'}: "
+            "unknown file format"
+        )
+
+    def test_short_file(
+        self, tmp_path: Path, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        (tmp_path / "values").write_bytes(b"x")
+        with pytest.raises(SharedValueStoreError) as error:
+            make_store()
+        assert error.value.details == "file too short"
+
+    def test_values(self, store: SharedValueStore) -> None:
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", ["l"], registry=None
+        )
+        counter.labels(l="a").inc(3)
+        counter.labels(l="a").inc(2)
+        gauge = store.metric_class(Gauge)("gauge", "A gauge", registry=None)
+        gauge.set(5)
+        gauge.set_to_current_time()
+        gauge.set(7)
+        histogram = store.metric_class(Histogram)(
+            "histogram", "A histogram", registry=None, buckets=[1, 5]
+        )
+        histogram.observe(2)
+        summary = store.metric_class(Summary)(
+            "summary", "A summary", registry=None
+        )
+        summary.observe(4)
+        assert counter.labels(l="a")._value.get() == 5
+        assert sample_values(store) == {
+            "counter_total[('l', 'a')]": 5.0,
+            f"gauge[('pid', '{os.getpid()}')]": 7.0,
+            "histogram_bucket[('le', '1.0')]": 0.0,
+            "histogram_bucket[('le', '5.0')]": 1.0,
+            "histogram_bucket[('le', '+Inf')]": 1.0,
+            "histogram_count[]": 1.0,
+            "histogram_sum[]": 2.0,
+            "summary_count[]": 1.0,
+            "summary_sum[]": 4.0,
+        }
+
+    def test_metric_class(self, store: SharedValueStore) -> None:
+        cls = store.metric_class(Counter)
+        assert issubclass(cls, Counter)
+        assert cls.__name__ == "Counter"
+        assert store.metric_class(Counter) is cls
+
+    def test_other_metrics_unaffected(self, store: SharedValueStore) -> None:
+        store.metric_class(Counter)("shared", "A counter", registry=None)
+        Counter("other", "A counter", registry=None).inc()
+        assert [metric.name for metric in store.read_metrics()] == ["shared"]
+
+    def test_exemplar(self, store: SharedValueStore) -> None:
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", registry=None
+        )
+        counter.inc(exemplar={"trace_id": "abc"})
+        assert counter._value.get_exemplar() is None
+
+    def test_read_metrics_names(self, store: SharedValueStore) -> None:
+        store.metric_class(Counter)(
+            "counter", "A counter", registry=None
+        ).inc()
+        store.metric_class(Gauge)("gauge", "A gauge", registry=None).set(1)
+        [metric] = store.read_metrics(names={"counter"})
+        assert metric.name == "counter"
+
+    def test_shared_across_stores(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        # a store for the same file in another process
+        other = make_store(initial_size=64)
+        store = make_store(initial_size=64)
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", ["l"], registry=None
+        )
+        # the file grows to fit records
+        for i in range(20):
+            counter.labels(l=str(i)).inc(i)
+        [metric] = other.read_metrics()
+        assert len(metric.samples) == 20
+        assert sum(sample.value for sample in metric.samples) == 190
+
+    def test_existing_records_reused(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        store = make_store()
+        store.metric_class(Counter)("counter", "A counter", registry=None).inc(
+            3
+        )
+        # a new store for the same process, e.g. after a restart
+        counter = make_store().metric_class(Counter)(
+            "counter", "A counter", registry=None
+        )
+        assert counter._value.get() == 3
+        counter.inc()
+        [metric] = store.read_metrics()
+        [sample] = metric.samples
+        assert sample.value == 4
+
+    def test_fork(
+        self, store: SharedValueStore, mocker: MockerFixture
+    ) -> None:
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", registry=None
+        )
+        counter.inc(3)
+        gauge = store.metric_class(Gauge)("gauge", "A gauge", registry=None)
+        gauge.set(3)
+        # values are moved to new records when the process ID changes
+        mocker.patch("os.getpid", return_value=os.getpid() + 100000)
+        assert counter._value.get() == 3
+        counter.inc(2)
+        gauge.set(5)
+        assert counter._value.get() == 2
+        values = sample_values(store)
+        assert values["counter_total[]"] == 5
+        assert {
+            name: value
+            for name, value in values.items()
+            if name.startswith("gauge")
+        } == {
+            f"gauge[('pid', '{os.getpid() - 100000}')]": 3,
+            f"gauge[('pid', '{os.getpid()}')]": 5,
+        }
+
+    def test_gauge_multiprocess_mode(
+        self, store: SharedValueStore, mocker: MockerFixture
+    ) -> None:
+        gauge = store.metric_class(Gauge)(
+            "gauge", "A gauge", registry=None, multiprocess_mode="max"
+        )
+        gauge.set(5)
+        mocker.patch("os.getpid", return_value=os.getpid() + 100000)
+        gauge.set(3)
+        assert sample_values(store) == {"gauge[]": 5}
+
+    def test_multiple_processes(self, store: SharedValueStore) -> None:
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", ["l"], registry=None
+        )
+        counter.labels(l="a").inc(1)
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=increment_in_process, args=(counter, 2))
+            for _ in range(3)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert sample_values(store) == {"counter_total[('l', 'a')]": 7}
+
+    def test_dead_process_records_taken_over(
+        self, store: SharedValueStore
+    ) -> None:
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", ["l"], registry=None
+        )
+        counter.labels(l="a").inc(1)
+        context = multiprocessing.get_context("fork")
+        for _ in range(3):
+            process = context.Process(
+                target=increment_in_process, args=(counter, 2)
+            )
+            process.start()
+            process.join()
+        assert sample_values(store) == {"counter_total[('l', 'a')]": 7}
+        # later processes reuse the record of the first one
+        assert len(store._records) == 2
+
+    def test_dead_process_values(
+        self, store: SharedValueStore, mocker: MockerFixture
+    ) -> None:
+        # a process ID that is not running
+        mocker.patch("os.getpid", return_value=os.getpid() + 100000)
+        counter = store.metric_class(Counter)(
+            "counter", "A counter", registry=None
+        )
+        counter.inc(3)
+        gauge = store.metric_class(Gauge)("gauge", "A gauge", registry=None)
+        gauge.set(3)
+        mocker.patch("os.getpid", return_value=os.getpid() + 1)
+        counter.inc(2)
+        gauge.inc(1)
+        # the counter value is kept, the gauge is reset
+        assert counter._value.get() == 5
+        assert gauge._value.get() == 1
+        assert sample_values(store) == {
+            "counter_total[]": 5,
+            f"gauge[('pid', '{os.getpid()}')]": 1,
+        }
+        assert len(store._records) == 2
+
+    def test_live_gauge_dead_process(
+        self, store: SharedValueStore, mocker: MockerFixture
+    ) -> None:
+        gauge = store.metric_class(Gauge)(
+            "gauge", "A gauge", registry=None, multiprocess_mode="livesum"
+        )
+        gauge.set(5)
+        # values from processes no longer running are not included
+        mocker.patch("os.getpid", return_value=os.getpid() + 100000)
+        gauge.set(3)
+        assert sample_values(store) == {"gauge[]": 5}
+
+    def test_process_of_other_user(
+        self, store: SharedValueStore, mocker: MockerFixture
+    ) -> None:
+        gauge = store.metric_class(Gauge)(
+            "gauge", "A gauge", registry=None, multiprocess_mode="livesum"
+        )
+        gauge.set(5)
+        mocker.patch("os.getpid", return_value=os.getpid() + 100000)
+        gauge.set(3)
+        mocker.patch("os.kill", side_effect=PermissionError)
+        assert sample_values(store) == {"gauge[]": 8}
+
+
+class TestMetricsRegistrySharedValues:
+    def test_metrics(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        store = make_store()
+        registry = MetricsRegistry(value_store=store)
+        registry.create_metrics(
+            [
+                MetricConfig("counter", "A counter", "counter"),
+                MetricConfig(
+                    "enum", "An enum", "enum", config={"states": ["a", "b"]}
+                ),
+            ]
+        )
+        t.cast(Counter, registry.get_metric("counter")).inc(3)
+        t.cast(Enum, registry.get_metric("enum")).state("b")
+        value = registry.registry.get_sample_value
+        assert value("counter_total") == 3
+        assert value("counter_created") is None
+        assert value("enum", {"enum": "b"}) == 1
+
+    def test_other_metrics_not_shared(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        store = make_store()
+        registry = MetricsRegistry(value_store=store)
+        registry.create_metrics([MetricConfig("shared", "A gauge", "gauge")])
+        # metrics from other registries don't use the store
+        other = MetricsRegistry()
+        other.create_metrics([MetricConfig("other", "A gauge", "gauge")])
+        t.cast(Gauge, other.get_metric("other")).set(3)
+        assert [metric.name for metric in store.read_metrics()] == ["shared"]
+        assert other.registry.get_sample_value("other") == 3
+
+    def test_gauge_multiprocess_mode(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        registry = MetricsRegistry(value_store=make_store())
+        registry.create_metrics(
+            [
+                MetricConfig(
+                    "gauge",
+                    "A gauge",
+                    "gauge",
+                    config={"multiprocess_mode": "livesum"},
+                )
+            ]
+        )
+        t.cast(Gauge, registry.get_metric("gauge")).set(3)
+        assert registry.registry.get_sample_value("gauge") == 3
+
+    def test_reconcile(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        registry = MetricsRegistry(value_store=make_store())
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig("m2", "desc2", "counter"),
+            ]
+        )
+        t.cast(Gauge, registry.get_metric("m1")).set(3)
+        t.cast(Counter, registry.get_metric("m2")).inc()
+        changes = registry.reconcile_metrics(
+            [MetricConfig("m1", "desc1", "counter")]
+        )
+        assert changes.updated == ("m1",)
+        assert changes.removed == ("m2",)
+        t.cast(Counter, registry.get_metric("m1")).inc(2)
+        # values for the removed metric, and the gauge replaced by a
+        # counter, are not included
+        assert [
+            (metric.name, metric.type)
+            for metric in registry.registry.collect()
+        ] == [("m1", "counter")]
+        assert registry.registry.get_sample_value("m1_total") == 2
+
+    def test_reconcile_rollback(
+        self, make_store: Callable[..., SharedValueStore]
+    ) -> None:
+        registry = MetricsRegistry(value_store=make_store())
+        registry.create_metrics(
+            [
+                MetricConfig("m1", "desc1", "gauge"),
+                MetricConfig(
+                    "m2", "desc2", "enum", config={"states": ["a", "b"]}
+                ),
+            ]
+        )
+        metrics = registry.get_metrics()
+        registry.register_additional_collector(
+            Gauge("conflict", "conflicting metric", registry=None)
+        )
+        with pytest.raises(ValueError):
+            registry.reconcile_metrics(
+                [
+                    MetricConfig("m1", "desc1", "counter"),
+                    MetricConfig("m2", "desc2", "gauge"),
+                    MetricConfig(
+                        "conflict",
+                        "desc",
+                        "enum",
+                        config={"states": ["a"]},
+                    ),
+                ]
+            )
+        assert registry.get_metrics() == metrics
+        assert "m2" in registry.registry._names_to_collectors
@@ -0,0 +1,333 @@
+import asyncio
+from collections.abc import Callable, Iterator
+import json
+from pathlib import Path
+import struct
+import sys
+import typing as t
+
+from aiohttp.web import Application
+from prometheus_client import Counter, Gauge, Histogram, Summary
+from prometheus_client.exposition import generate_latest
+import pytest
+from pytest_structlog import StructuredLogCapture
+
+from prometheus_aioexporter._metric import MetricConfig, MetricsRegistry
+from prometheus_aioexporter._snapshot import (
+    MetricsSnapshotter,
+    SnapshotError,
+    dump_snapshot,
+    load_snapshot,
+    save_snapshot,
+)
+
+METRIC_CONFIGS = [
+    MetricConfig("counter", "A counter", "counter", labels=("l",)),
+    MetricConfig("gauge", "A gauge", "gauge"),
+    MetricConfig(
+        "histogram", "A histogram", "histogram", config={"buckets": [1, 5]}
+    ),
+    MetricConfig("summary", "A summary", "summary"),
+    MetricConfig("enum", "An enum", "enum", config={"states": ["a", "b"]}),
+    MetricConfig("info", "An info", "info"),
+]
+
+
+@pytest.fixture
+def make_registry() -> Iterator[Callable[..., MetricsRegistry]]:
+    def make(
+        configs: list[MetricConfig] = METRIC_CONFIGS, lazy: bool = False
+    ) -> MetricsRegistry:
+        registry = MetricsRegistry(lazy=lazy)
+        registry.create_metrics(configs)
+        return registry
+
+    yield make
+
+
+@pytest.fixture
+def registry(
+    make_registry: Callable[..., MetricsRegistry],
+) -> MetricsRegistry:
+    registry = make_registry()
+    counter = t.cast(Counter, registry.get_metric("counter"))
+    counter.labels(l="a").inc(3)
+    counter.labels(l="b").inc(5)
+    t.cast(Gauge, registry.get_metric("gauge")).set(12.5)
+    t.cast(Histogram, registry.get_metric("histogram")).observe(2)
+    t.cast(Summary, registry.get_metric("summary")).observe(4)
+    return registry
+
+
+@pytest.fixture
+def snapshot_file(tmp_path: Path) -> Path:
+    return tmp_path / "snapshot"
+
+
+class TestSnapshot:
+    def test_save_load(
+        self,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        save_snapshot(registry, snapshot_file)
+        restored = make_registry()
+        assert load_snapshot(restored, snapshot_file) == 5
+        assert generate_latest(restored.registry) == generate_latest(
+            registry.registry
+        )
+
+    def test_load_lazy(
+        self,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        save_snapshot(registry, snapshot_file)
+        restored = make_registry(lazy=True)
+        load_snapshot(restored, snapshot_file)
+        # only metrics with values in the snapshot are instantiated
+        assert set(restored._metrics) == {
+            "counter",
+            "gauge",
+            "histogram",
+            "summary",
+        }
+
+    def test_load_changed_metrics(
+        self,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        save_snapshot(registry, snapshot_file)
+        restored = make_registry(
+            [
+                # different labels
+                MetricConfig("counter", "A counter", "counter"),
+                # different type
+                MetricConfig("gauge", "A gauge", "counter"),
+                # different buckets
+                MetricConfig(
+                    "histogram",
+                    "A histogram",
+                    "histogram",
+                    config={"buckets": [1]},
+                ),
+                MetricConfig("summary", "A summary", "summary"),
+            ]
+        )
+        assert load_snapshot(restored, snapshot_file) == 1
+        value = restored.registry.get_sample_value
+        assert value("summary_sum") == 4
+        assert value("gauge_total") == 0
+        assert value("histogram_sum") == 0
+
+    def test_load_missing(
+        self, registry: MetricsRegistry, snapshot_file: Path
+    ) -> None:
+        with pytest.raises(FileNotFoundError):
+            load_snapshot(registry, snapshot_file)
+
+    @pytest.mark.parametrize(
+        "data,details",
+        [
+            (b"short", "file too short"),
+            (
+                struct.pack("<8sII", b"NOTASNAP", 1, 0),
+                "unknown file format",
+            ),
+            (
+                struct.pack("<8sII", b"PAEXSNAP", 2, 0),
+                "unsupported version 2",
+            ),
+            (
+                struct.pack("<8sII", b"PAEXSNAP", 1, 100),
+                "truncated file",
+            ),
+            (
+                struct.pack("<8sII", b"PAEXSNAP", 1, 8) + b"not json",
+                "invalid index",
+            ),
+            (
+                struct.pack("<8sII", b"PAEXSNAP", 1, 24)
+                + b'{"byteorder":"other"}   ',
+                "incompatible byte order",
+            ),
+        ],
+    )
+    def test_load_invalid(
+        self,
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+        data: bytes,
+        details: str,
+    ) -> None:
+        snapshot_file.write_bytes(data)
+        with pytest.raises(SnapshotError) as error:
+            load_snapshot(registry, snapshot_file)
+        assert error.value.details == details
+        assert (
+            str(error.value) == f"Invalid snapshot {snapshot_file}: {details}"
+        )
+
+    def test_load_truncated_values(
+        self,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        snapshot_file.write_bytes(dump_snapshot(registry)[:-8])
+        with pytest.raises(SnapshotError) as error:
+            load_snapshot(make_registry(), snapshot_file)
+        assert error.value.details == "truncated values"
+
+    @pytest.mark.parametrize(
+        "metrics",
+        [
+            # not a list of metrics
+            {"counter": []},
+            # missing series
+            [["counter", "counter", ["l"]]],
+            # unknown type
+            [["counter", "unknown", ["l"], []]],
+            # label names not a list
+            [["counter", "counter", "l", []]],
+            # label values count doesn't match names
+            [["counter", "counter", ["l"], [[["a", "b"], 0, 2]]]],
+            # invalid offset
+            [["counter", "counter", ["l"], [[["a"], -1, 2]]]],
+            # too few values for the type
+            [["counter", "counter", ["l"], [[["a"], 0, 1]]]],
+        ],
+    )
+    def test_load_invalid_index(
+        self,
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+        metrics: t.Any,
+    ) -> None:
+        index = json.dumps(
+            {"byteorder": sys.byteorder, "metrics": metrics}
+        ).encode()
+        index += b" " * (-len(index) % 8)
+        snapshot_file.write_bytes(
+            struct.pack("<8sII", b"PAEXSNAP", 1, len(index))
+            + index
+            + struct.pack("<dd", 1, 2)
+        )
+        with pytest.raises(SnapshotError) as error:
+            load_snapshot(registry, snapshot_file)
+        assert error.value.details == "invalid index"
+
+    def test_load_invalid_not_restored(
+        self,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        # the last series (for the summary) is truncated
+        snapshot_file.write_bytes(dump_snapshot(registry)[:-8])
+        restored = make_registry()
+        with pytest.raises(SnapshotError):
+            load_snapshot(restored, snapshot_file)
+        # values for other metrics are not restored either
+        assert restored.registry.get_sample_value("gauge") == 0
+        assert (
+            restored.registry.get_sample_value("counter_total", {"l": "a"})
+            is None
+        )
+
+    def test_dump_aligned_values(self, registry: MetricsRegistry) -> None:
+        data = dump_snapshot(registry)
+        index_size = struct.unpack_from("<8sII", data)[2]
+        # 2 counter series, gauge, histogram, summary
+        values_count = 2 * 2 + 1 + (2 + 3) + 3
+        assert (16 + index_size) % 8 == 0
+        assert len(data) == 16 + index_size + values_count * 8
+
+
+class TestMetricsSnapshotter:
+    async def test_start_restores(
+        self,
+        log: StructuredLogCapture,
+        make_registry: Callable[..., MetricsRegistry],
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        save_snapshot(registry, snapshot_file)
+        restored = make_registry()
+        snapshotter = MetricsSnapshotter(restored, snapshot_file)
+        await snapshotter.start(Application())
+        assert restored.registry.get_sample_value("gauge") == 12.5
+        assert log.has("snapshot restored", path=str(snapshot_file), series=5)
+        await snapshotter.stop(Application())
+
+    def test_load_missing(
+        self, registry: MetricsRegistry, snapshot_file: Path
+    ) -> None:
+        snapshotter = MetricsSnapshotter(registry, snapshot_file)
+        assert snapshotter.load() == 0
+
+    def test_load_invalid(
+        self,
+        log: StructuredLogCapture,
+        registry: MetricsRegistry,
+        snapshot_file: Path,
+    ) -> None:
+        snapshot_file.write_bytes(b"invalid")
+        snapshotter = MetricsSnapshotter(registry, snapshot_file)
+        assert snapshotter.load() == 0
+        assert log.has(
+            "snapshot restore failed",
+            path=str(snapshot_file),
+            error=f"Invalid snapshot {snapshot_file}: file too short",
+            level="warning",
+        )
+
+    async def test_save_periodically(
+        self, registry: MetricsRegistry, snapshot_file: Path
+    ) -> None:
+        snapshotter = MetricsSnapshotter(
+            registry, snapshot_file, interval=0.01
+        )
+        await snapshotter.start(Application())
+        await asyncio.sleep(0.05)
+        assert snapshot_file.read_bytes() == dump_snapshot(registry)
+        await snapshotter.stop(Application())
+
+    async def test_stop_saves(
+        self, registry: MetricsRegistry, snapshot_file: Path
+    ) -> None:
+        snapshotter = MetricsSnapshotter(registry, snapshot_file)
+        await snapshotter.start(Application())
+        t.cast(Gauge, registry.get_metric("gauge")).set(20)
+        await snapshotter.stop(Application())
+        assert snapshot_file.read_bytes() == dump_snapshot(registry)
+        assert snapshotter._task is None
+
+    async def test_save_failed(
+        self,
+        log: StructuredLogCapture,
+        registry: MetricsRegistry,
+        tmp_path: Path,
+    ) -> None:
+        path = tmp_path / "missing" / "snapshot"
+        snapshotter = MetricsSnapshotter(registry, path)
+        await snapshotter.save()
+        assert log.has("snapshot save failed", path=str(path), level="warning")
+
+    async def test_save_replace_failed(
+        self,
+        log: StructuredLogCapture,
+        registry: MetricsRegistry,
+        tmp_path: Path,
+    ) -> None:
+        # the destination is a directory, so it can't be replaced
+        path = tmp_path / "snapshot"
+        path.mkdir()
+        snapshotter = MetricsSnapshotter(registry, path)
+        await snapshotter.save()
+        assert log.has("snapshot save failed", path=str(path))
+        assert list(tmp_path.iterdir()) == [path]
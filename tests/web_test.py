@@ -1,10 +1,17 @@
+import asyncio
 from collections.abc import (
+    AsyncIterator,
     Awaitable,
     Callable,
     Coroutine,
     Iterator,
+    Mapping,
 )
+import os
+from pathlib import Path
+import socket
 from ssl import SSLContext
+import sys
 import typing as t
 from unittest import mock
 
@@ -14,20 +21,35 @@ from aiohttp.test_utils import (
 )
 from aiohttp.web import Application, Request
 from prometheus_client import Gauge
+from prometheus_client.core import GaugeMetricFamily
 from prometheus_client.metrics import MetricWrapperBase
+from prometheus_client.metrics_core import Metric
+from prometheus_client.openmetrics.exposition import (
+    ALLOWUTF8,
+    UNDERSCORES,
+    generate_latest as generate_latest_openmetrics,
+)
 import pytest
 from pytest_mock import MockerFixture
 from pytest_structlog import StructuredLogCapture
 
+from prometheus_aioexporter._cardinality import SeriesBudget
 from prometheus_aioexporter._log import AccessLogger
 from prometheus_aioexporter._metric import (
+    AsyncCollector,
     MetricConfig,
+    MetricDelta,
+    MetricRemoval,
     MetricsRegistry,
+    MetricUpdate,
 )
 from prometheus_aioexporter._web import (
+    COMPRESS_LEVEL,
     EXPORTER_APP_KEY,
+    EventLoop,
     PrometheusExporter,
     PrometheusExporterConfig,
+    get_systemd_sockets,
 )
 
 from .conftest import ssl_context
@@ -36,6 +58,14 @@ AiohttpTestClient = TestClient[Request, Application]
 AiohttpClientFixture = Callable[
     [Application | TestServer], Awaitable[AiohttpTestClient]
 ]
+# Accept header sent by Prometheus with default scrape protocols
+PROMETHEUS_ACCEPT = (
+    "application/openmetrics-text;version=1.0.0;escaping=allow-utf-8;q=0.5,"
+    "application/openmetrics-text;version=0.0.1;q=0.4,"
+    "text/plain;version=1.0.0;escaping=allow-utf-8;q=0.3,"
+    "text/plain;version=0.0.4;q=0.2,*/*;q=0.1"
+)
+
 AiohttpServerFixture = Callable[..., Awaitable[TestServer]]
 CreateExporterClient = Callable[
     [PrometheusExporter], Coroutine[t.Any, t.Any, AiohttpTestClient]
@@ -109,11 +139,129 @@ class TestPrometheusExporter:
             mock.ANY,
             host=["localhost"],
             port=8000,
+            backlog=128,
+            keepalive_timeout=75.0,
             print=mock.ANY,
             access_log_class=AccessLogger,
             ssl_context=exporter.config.ssl_context,
         )
 
+    def test_run_unix_socket(
+        self,
+        mocker: MockerFixture,
+        tmp_path: Path,
+        registry: MetricsRegistry,
+    ) -> None:
+        mock_run_app = mocker.patch("prometheus_aioexporter._web.run_app")
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            unix_socket=tmp_path / "exporter.sock",
+            backlog=10,
+            keepalive_timeout=5.0,
+        )
+        exporter = PrometheusExporter(config, registry)
+        exporter.run()
+        mock_run_app.assert_called_with(
+            mock.ANY,
+            path=tmp_path / "exporter.sock",
+            sock=None,
+            backlog=10,
+            keepalive_timeout=5.0,
+            print=mock.ANY,
+            access_log_class=AccessLogger,
+            ssl_context=None,
+        )
+
+    @pytest.mark.parametrize("activated", [True, False])
+    def test_run_socket_activation(
+        self,
+        mocker: MockerFixture,
+        registry: MetricsRegistry,
+        activated: bool,
+    ) -> None:
+        mock_run_app = mocker.patch("prometheus_aioexporter._web.run_app")
+        sockets = [mock.Mock()] if activated else []
+        mocker.patch(
+            "prometheus_aioexporter._web.get_systemd_sockets",
+            return_value=sockets,
+        )
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            socket_activation=True,
+        )
+        exporter = PrometheusExporter(config, registry)
+        exporter.run()
+        if activated:
+            listen = {"path": None, "sock": sockets}
+        else:
+            listen = {"host": ["localhost"], "port": 8000}
+        mock_run_app.assert_called_with(
+            mock.ANY,
+            **listen,
+            backlog=128,
+            keepalive_timeout=75.0,
+            print=mock.ANY,
+            access_log_class=AccessLogger,
+            ssl_context=None,
+        )
+
+    def test_run_uvloop(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        mocker: MockerFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        mock_run_app = mocker.patch("prometheus_aioexporter._web.run_app")
+        loop = mock.Mock()
+        monkeypatch.setitem(
+            sys.modules, "uvloop", mock.Mock(new_event_loop=lambda: loop)
+        )
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            event_loop=EventLoop.UVLOOP,
+        )
+        exporter = PrometheusExporter(config, registry)
+        exporter.run()
+        assert mock_run_app.call_args.kwargs["loop"] is loop
+
+    def test_run_uvloop_not_available(
+        self,
+        monkeypatch: pytest.MonkeyPatch,
+        mocker: MockerFixture,
+        log: StructuredLogCapture,
+        registry: MetricsRegistry,
+    ) -> None:
+        mock_run_app = mocker.patch("prometheus_aioexporter._web.run_app")
+        monkeypatch.setitem(sys.modules, "uvloop", None)
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            event_loop=EventLoop.UVLOOP,
+        )
+        exporter = PrometheusExporter(config, registry)
+        exporter.run()
+        assert "loop" not in mock_run_app.call_args.kwargs
+        assert log.has(
+            "event loop not available, using default",
+            event_loop=EventLoop.UVLOOP,
+            level="warning",
+        )
+
     @pytest.mark.parametrize("exporter", [ssl_context, False], indirect=True)
     async def test_homepage(
         self,
@@ -218,6 +366,37 @@ class TestPrometheusExporter:
         text = await response.text()
         assert metric_text in text
 
+    @pytest.mark.parametrize(
+        "accept_header,escaping",
+        [
+            (PROMETHEUS_ACCEPT, ALLOWUTF8),
+            ("application/openmetrics-text;version=1.0.0", UNDERSCORES),
+        ],
+    )
+    async def test_metrics_openmetrics(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+        accept_header: str,
+        escaping: str,
+    ) -> None:
+        metrics = registry.create_metrics(
+            [MetricConfig("test_gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        t.cast(Gauge, metrics["test_gauge"]).labels(l="a").set(1)
+        client = await aiohttp_client(exporter.app)
+        for _ in range(2):
+            response = await client.request(
+                "GET", "/metrics", headers={"Accept": accept_header}
+            )
+            assert response.status == 200
+            assert await response.read() == generate_latest_openmetrics(
+                registry.registry, escaping=escaping
+            )
+        # the encoder is reused across scrapes
+        assert list(exporter._openmetrics_encoders) == [escaping]
+
     async def test_metrics_different_path(
         self,
         aiohttp_client: AiohttpClientFixture,
@@ -249,6 +428,196 @@ class TestPrometheusExporter:
         response = await client.request("GET", "/metrics")
         assert response.status == 404
 
+    async def test_metrics_filtered(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [
+                MetricConfig("metric1", "A test gauge", "gauge"),
+                MetricConfig("metric2", "A test gauge", "gauge"),
+            ]
+        )
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET", "/metrics", params={"name[]": "metric2"}
+        )
+        text = await response.text()
+        assert "metric1" not in text
+        assert "metric2 0.0" in text
+        # cached series are not affected by filtered requests
+        assert exporter._encoder._prefixes == {}
+
+    async def test_metrics_compressed(
+        self,
+        mocker: MockerFixture,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        to_thread = mocker.spy(asyncio, "to_thread")
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge")]
+        )
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET", "/metrics", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert "metric 0.0" in await response.text()
+        # small outputs are compressed in the event loop
+        to_thread.assert_not_called()
+
+    async def test_metrics_not_compressed(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge")]
+        )
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET",
+            "/metrics",
+            headers={"Accept-Encoding": "identity"},
+            auto_decompress=False,
+        )
+        assert "Content-Encoding" not in response.headers
+        assert response.headers["Vary"] == "Accept-Encoding"
+        assert "metric 0.0" in await response.text()
+
+    async def test_metrics_compressed_in_thread(
+        self,
+        mocker: MockerFixture,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        to_thread = mocker.spy(asyncio, "to_thread")
+        [metric] = registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=["l"])]
+        ).values()
+        for index in range(200):
+            t.cast(Gauge, metric).labels(l=str(index)).set(index)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET", "/metrics", headers={"Accept-Encoding": "gzip"}
+        )
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert 'metric{l="199"} 199.0' in await response.text()
+        to_thread.assert_called_once_with(mock.ANY, mock.ANY, COMPRESS_LEVEL)
+
+    @pytest.mark.parametrize(
+        "headers,params,phases",
+        [
+            (
+                {"Accept-Encoding": "gzip"},
+                {},
+                ["admission", "update", "collect", "encode", "compress"],
+            ),
+            (
+                {"Accept-Encoding": "identity"},
+                {},
+                ["admission", "update", "collect", "encode"],
+            ),
+            (
+                {"Accept-Encoding": "identity", "Accept": PROMETHEUS_ACCEPT},
+                {},
+                ["admission", "update", "collect", "encode"],
+            ),
+            (
+                {"Accept-Encoding": "identity"},
+                {"name[]": "metric"},
+                ["admission", "update", "collect", "encode"],
+            ),
+            (
+                {
+                    "Accept-Encoding": "identity",
+                    "Accept": "text/plain;version=1.0.0",
+                },
+                {},
+                ["admission", "update", "collect", "encode"],
+            ),
+        ],
+    )
+    async def test_metrics_phases_logged(
+        self,
+        log: StructuredLogCapture,
+        aiohttp_client: AiohttpClientFixture,
+        aiohttp_server: AiohttpServerFixture,
+        exporter: PrometheusExporter,
+        headers: dict[str, str],
+        params: dict[str, str],
+        phases: list[str],
+    ) -> None:
+        server = await aiohttp_server(
+            exporter.app, access_log_class=AccessLogger
+        )
+        client = await aiohttp_client(server)
+        response = await client.request(
+            "GET", "/metrics", headers=headers, params=params
+        )
+        # no header by default
+        assert "Server-Timing" not in response.headers
+        # the entry for the first request is logged before the second one is
+        # handled
+        await client.request("GET", "/-/healthy")
+        event = next(
+            event for event in log.events if event["event"] == "request"
+        )
+        # the time to write the response is only known after headers are
+        # sent
+        phases.append("write")
+        assert list(event["phases"]) == phases
+        assert all(duration >= 0 for duration in event["phases"].values())
+
+    @pytest.mark.parametrize(
+        "headers,params",
+        [
+            ({}, {}),
+            ({"Accept": PROMETHEUS_ACCEPT}, {}),
+            ({"Accept": "text/plain;version=1.0.0"}, {}),
+            ({}, {"name[]": "metric"}),
+        ],
+    )
+    async def test_metrics_server_timing(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+        headers: dict[str, str],
+        params: dict[str, str],
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            server_timing=True,
+        )
+        exporter = PrometheusExporter(config, registry)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET",
+            "/metrics",
+            headers={"Accept-Encoding": "gzip", **headers},
+            params=params,
+        )
+        entries = response.headers["Server-Timing"].split(", ")
+        assert [entry.split(";")[0] for entry in entries] == [
+            "admission",
+            "update",
+            "collect",
+            "encode",
+            "compress",
+        ]
+        assert all(entry.split(";")[1].startswith("dur=") for entry in entries)
+
     async def test_metrics_update_handler(
         self,
         aiohttp_client: AiohttpClientFixture,
@@ -258,7 +627,7 @@ class TestPrometheusExporter:
         args = []
 
         async def update_handler(
-            metrics: dict[str, MetricWrapperBase],
+            metrics: Mapping[str, MetricWrapperBase],
         ) -> None:
             args.append(metrics)
 
@@ -273,6 +642,450 @@ class TestPrometheusExporter:
         await client.request("GET", "/metrics")
         assert args == [metrics]
 
+    async def test_metrics_update_handler_double_buffered(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        config: PrometheusExporterConfig,
+    ) -> None:
+        registry = MetricsRegistry(double_buffered=True)
+        exporter = PrometheusExporter(config, registry)
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=["l"])]
+        )
+        values = iter(["a", "b"])
+
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            value = next(values, None)
+            if value is None:
+                raise Exception("update failed")
+            t.cast(Gauge, metrics["metric"]).labels(l=value).set(1)
+
+        exporter.set_metric_update_handler(update_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        assert 'metric{l="a"} 1.0' in await response.text()
+        # each update replaces metrics from the previous one
+        response = await client.request("GET", "/metrics")
+        text = await response.text()
+        assert 'metric{l="a"}' not in text
+        assert 'metric{l="b"} 1.0' in text
+        # metrics from a failed update are not published
+        response = await client.request("GET", "/metrics")
+        assert response.status == 500
+        assert registry.registry.get_sample_value("metric", {"l": "b"}) == 1
+
+    def test_delta_handler_double_buffered(
+        self, config: PrometheusExporterConfig
+    ) -> None:
+        exporter = PrometheusExporter(
+            config, MetricsRegistry(double_buffered=True)
+        )
+
+        async def delta_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> list[MetricDelta]:
+            return []
+
+        with pytest.raises(ValueError) as error:
+            exporter.set_metric_delta_handler(delta_handler)
+        assert (
+            str(error.value)
+            == "Updates are not supported for double-buffered registries"
+        )
+
+    async def test_update_metrics_double_buffered_concurrent(
+        self, config: PrometheusExporterConfig
+    ) -> None:
+        registry = MetricsRegistry(double_buffered=True)
+        exporter = PrometheusExporter(config, registry)
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=["l"])]
+        )
+        events = {"a": asyncio.Event(), "b": asyncio.Event()}
+        values = iter(events)
+
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            value = next(values)
+            await events[value].wait()
+            t.cast(Gauge, metrics["metric"]).labels(l=value).set(1)
+
+        exporter.set_metric_update_handler(update_handler)
+        first = asyncio.create_task(exporter.update_metrics())
+        second = asyncio.create_task(exporter.update_metrics())
+        await asyncio.sleep(0)
+        # the second update completes first
+        events["b"].set()
+        await second
+        value = registry.registry.get_sample_value
+        assert value("metric", {"l": "b"}) == 1
+        events["a"].set()
+        await first
+        # the older generation doesn't replace the newer one
+        assert value("metric", {"l": "a"}) is None
+        assert value("metric", {"l": "b"}) == 1
+
+    async def test_metrics_queued_updates(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [MetricConfig("metric", "A test counter", "counter")]
+        )
+        registry.queue_updates([MetricUpdate("metric", 3)])
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        assert "metric_total 3.0" in await response.text()
+
+    async def test_update_writer(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            update_queue_interval=0.01,
+            update_queue_size=10,
+        )
+        exporter = PrometheusExporter(config, registry)
+        assert registry.update_queue_size == 10
+        registry.create_metrics(
+            [MetricConfig("metric", "A test counter", "counter")]
+        )
+        await aiohttp_client(exporter.app)
+        registry.queue_updates([MetricUpdate("metric", 3)])
+        await asyncio.sleep(0.05)
+        assert registry.registry.get_sample_value("metric_total") == 3
+
+    async def test_metrics_delta_handler(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=("l",))]
+        )
+        calls = []
+
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            calls.append("update")
+
+        async def delta_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> list[MetricDelta]:
+            calls.append("delta")
+            return [MetricUpdate("metric", len(calls), {"l": "a"})]
+
+        exporter.set_metric_update_handler(update_handler)
+        exporter.set_metric_delta_handler(delta_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        assert 'metric{l="a"} 2.0' in await response.text()
+        assert calls == ["update", "delta"]
+
+    async def test_metrics_delta_handler_generator(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=("l",))]
+        )
+        registry.apply_updates([MetricUpdate("metric", 1, {"l": "old"})])
+
+        async def delta_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> AsyncIterator[MetricDelta]:
+            yield MetricRemoval("metric", {"l": "old"})
+            yield MetricUpdate("metric", 3, {"l": "new"})
+
+        exporter.set_metric_delta_handler(delta_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        text = await response.text()
+        assert 'metric{l="old"}' not in text
+        assert 'metric{l="new"} 3.0' in text
+
+    async def test_metrics_delta_handler_failed(
+        self,
+        log: StructuredLogCapture,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        registry.create_metrics(
+            [MetricConfig("metric", "A test gauge", "gauge", labels=("l",))]
+        )
+
+        async def delta_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> list[MetricDelta]:
+            return [
+                MetricUpdate("metric", 1, {"wrong": "a"}),
+                MetricUpdate("metric", 2, {"l": "b"}),
+            ]
+
+        exporter.set_metric_delta_handler(delta_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        # the failed delta is logged and skipped, as for queued ones
+        assert response.status == 200
+        assert 'metric{l="b"} 2.0' in await response.text()
+        assert log.has("metric update failed", metric="metric")
+
+    async def test_loop_monitor(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            loop_monitor_interval=0.01,
+        )
+        exporter = PrometheusExporter(config, registry)
+        client = await aiohttp_client(exporter.app)
+        await asyncio.sleep(0.03)
+        response = await client.request("GET", "/metrics")
+        text = await response.text()
+        assert "exporter_event_loop_lag_seconds_count" in text
+        assert "exporter_event_loop_slow_callbacks_total 0.0" in text
+
+    async def test_cardinality(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            debug_cardinality=True,
+        )
+        registry.track_series = True
+        exporter = PrometheusExporter(config, registry)
+        metrics = registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+        gauge = t.cast(Gauge, metrics["gauge"])
+        for value in ("a", "b", "c"):
+            gauge.labels(l=value)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET", "/debug/cardinality", params={"top": "2"}
+        )
+        assert response.status == 200
+        [family] = (await response.json())["families"]
+        assert family["name"] == "gauge"
+        assert family["series"] == 3
+        assert family["growth"] == 3
+        assert family["estimated_bytes"] > 0
+        assert family["labels"] == [
+            {"name": "l", "values": 3, "top": [["a", 1], ["b", 1]]}
+        ]
+        # growth is relative to the previous report
+        gauge.remove("a")
+        response = await client.request("GET", "/debug/cardinality")
+        [family] = (await response.json())["families"]
+        assert family["growth"] == -1
+        assert len(family["labels"][0]["top"]) == 2
+
+    def test_cardinality_not_tracked(self, registry: MetricsRegistry) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            debug_cardinality=True,
+        )
+        with pytest.raises(ValueError, match="Series tracking is not enabled"):
+            PrometheusExporter(config, registry)
+
+    @pytest.mark.parametrize("top", ["-1", "foo"])
+    async def test_cardinality_invalid_top(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+        top: str,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            debug_cardinality=True,
+        )
+        registry.track_series = True
+        exporter = PrometheusExporter(config, registry)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request(
+            "GET", "/debug/cardinality", params={"top": top}
+        )
+        assert response.status == 400
+        assert await response.text() == "Invalid top values count"
+
+    async def test_series_budget(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            series_budget=SeriesBudget(soft_max_series=2),
+        )
+        registry.track_series = True
+        exporter = PrometheusExporter(config, registry)
+        metrics = registry.create_metrics(
+            [MetricConfig("gauge", "A gauge", "gauge", labels=["l"])]
+        )
+
+        async def update_handler(
+            metrics: Mapping[str, MetricWrapperBase],
+        ) -> None:
+            gauge = t.cast(Gauge, metrics["gauge"])
+            for value in ("a", "b", "c"):
+                gauge.labels(l=value).set(1)
+
+        exporter.set_metric_update_handler(update_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        text = await response.text()
+        # the metric is shed after the update
+        assert 'gauge{l="a"}' not in text
+        assert "exporter_budget_shed_metrics 1.0" in text
+        assert 'exporter_budget_series_limit{limit="soft"} 2.0' in text
+        assert metrics["gauge"]._metrics == {}
+
+    async def test_cardinality_disabled(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+    ) -> None:
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/debug/cardinality")
+        assert response.status == 404
+
+    async def test_healthy(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+    ) -> None:
+        update_handler = mock.AsyncMock()
+        exporter.set_metric_update_handler(update_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/-/healthy")
+        assert response.status == 200
+        assert await response.text() == "OK"
+        update_handler.assert_not_called()
+
+    async def test_ready(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+    ) -> None:
+        update_handler = mock.AsyncMock()
+        exporter.set_metric_update_handler(update_handler)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/-/ready")
+        assert response.status == 503
+        assert await response.text() == "Metrics not collected yet"
+        update_handler.assert_not_called()
+        await client.request("GET", "/metrics")
+        response = await client.request("GET", "/-/ready")
+        assert response.status == 200
+        assert await response.text() == "OK"
+
+    async def test_ready_max_age(
+        self,
+        mocker: MockerFixture,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            ready_max_age=30.0,
+        )
+        exporter = PrometheusExporter(config, registry)
+        client = await aiohttp_client(exporter.app)
+        await exporter.update_metrics()
+        response = await client.request("GET", "/-/ready")
+        assert response.status == 200
+        assert exporter._last_update is not None
+        mocker.patch("time.monotonic", return_value=exporter._last_update + 31)
+        response = await client.request("GET", "/-/ready")
+        assert response.status == 503
+        assert await response.text() == "Metrics are stale"
+
+    async def test_metrics_admission(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            scrape_min_interval=60.0,
+        )
+        exporter = PrometheusExporter(config, registry)
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        assert response.status == 200
+        response = await client.request("GET", "/metrics")
+        assert response.status == 429
+        assert response.headers["Retry-After"] == "60"
+        assert (
+            registry.registry.get_sample_value(
+                "exporter_scrapes_rejected_total", {"reason": "rate_limited"}
+            )
+            == 1
+        )
+
+    async def test_metrics_async_collector(
+        self,
+        aiohttp_client: AiohttpClientFixture,
+        exporter: PrometheusExporter,
+        registry: MetricsRegistry,
+    ) -> None:
+        class SampleCollector(AsyncCollector):
+            async def collect(self) -> AsyncIterator[Metric]:
+                yield GaugeMetricFamily("async_gauge", "a gauge", value=3)
+
+        registry.register_additional_collector(SampleCollector())
+        client = await aiohttp_client(exporter.app)
+        response = await client.request("GET", "/metrics")
+        assert "async_gauge 3.0" in await response.text()
+
     @pytest.mark.parametrize(
         ["ssl_context", "protocol"], [(ssl_context, "https"), (None, "http")]
     )
@@ -293,9 +1106,98 @@ class TestPrometheusExporter:
         )
         exporter = PrometheusExporter(config, registry)
         await exporter._log_startup_message(exporter.app)
+        assert log.has("event loop", event_loop="asyncio", level="info")
         assert log.has(
             "listening", url=f"{protocol}://0.0.0.0:8000", level="info"
         )
         assert log.has(
             "listening", url=f"{protocol}://[::1]:8000", level="info"
         )
+
+    async def test_startup_logger_unix_socket(
+        self,
+        log: StructuredLogCapture,
+        tmp_path: Path,
+        registry: MetricsRegistry,
+    ) -> None:
+        config = PrometheusExporterConfig(
+            "test-exporter",
+            "1.2.3",
+            "A test exporter",
+            ["localhost"],
+            8000,
+            unix_socket=tmp_path / "exporter.sock",
+        )
+        exporter = PrometheusExporter(config, registry)
+        await exporter._log_startup_message(exporter.app)
+        [_, event] = log.events
+        assert event["event"] == "listening"
+        assert event["url"] == f"http+unix://{tmp_path}/exporter.sock"
+
+    async def test_startup_logger_activated_sockets(
+        self,
+        log: StructuredLogCapture,
+        tmp_path: Path,
+        exporter: PrometheusExporter,
+    ) -> None:
+        unix_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        unix_sock.bind(str(tmp_path / "exporter.sock"))
+        tcp_sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        tcp_sock.bind(("::1", 0))
+        port = tcp_sock.getsockname()[1]
+        exporter._sockets = [unix_sock, tcp_sock]
+        try:
+            await exporter._log_startup_message(exporter.app)
+        finally:
+            unix_sock.close()
+            tcp_sock.close()
+        assert log.has(
+            "listening",
+            url=f"http+unix://{tmp_path}/exporter.sock",
+            level="info",
+        )
+        assert log.has("listening", url=f"http://[::1]:{port}", level="info")
+
+
+class TestGetSystemdSockets:
+    @pytest.fixture(autouse=True)
+    def environ(
+        self, monkeypatch: pytest.MonkeyPatch
+    ) -> Iterator[dict[str, str]]:
+        environ: dict[str, str] = {}
+        monkeypatch.setattr("os.environ", environ)
+        yield environ
+
+    def test_sockets(
+        self, mocker: MockerFixture, environ: dict[str, str]
+    ) -> None:
+        mock_socket = mocker.patch("socket.socket")
+        environ.update(
+            {
+                "LISTEN_PID": str(os.getpid()),
+                "LISTEN_FDS": "2",
+                "LISTEN_FDNAMES": "a:b",
+            }
+        )
+        sockets = get_systemd_sockets()
+        assert len(sockets) == 2
+        mock_socket.assert_has_calls(
+            [mock.call(fileno=3), mock.call(fileno=4)]
+        )
+        assert not environ.keys() & {
+            "LISTEN_PID",
+            "LISTEN_FDS",
+            "LISTEN_FDNAMES",
+        }
+
+    def test_no_sockets(self) -> None:
+        assert get_systemd_sockets() == []
+
+    def test_other_pid(self, environ: dict[str, str]) -> None:
+        environ.update({"LISTEN_PID": "1", "LISTEN_FDS": "2"})
+        assert get_systemd_sockets() == []
+        assert not environ.keys() & {
+            "LISTEN_PID",
+            "LISTEN_FDS",
+            "LISTEN_FDNAMES",
+        }